@@ -3,6 +3,9 @@ ASGI config for TherapistGPT project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Besides Django, it serves the Server-Sent Events stream of the therapist replies on /therapy/stream/<task_id>/,
+which needs the project to run on an ASGI server.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -12,5 +15,16 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TherapistGPT.settings")
+os.environ.setdefault("THERAPY_STREAMING", "1")  # settings.THERAPY_STREAMING, this server serves the stream
+
+django_application = get_asgi_application()
+
+from therapy.streaming import STREAM_PATH, stream_application  # noqa: E402  (needs the Django settings)
+
+
+async def application(scope, receive, send):
+
+    if scope['type'] == 'http' and STREAM_PATH.match(scope['path']):
+        return await stream_application(scope, receive, send)
 
-application = get_asgi_application()
+    return await django_application(scope, receive, send)
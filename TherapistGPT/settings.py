@@ -142,5 +142,15 @@ if is_on_heroku:
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379') if is_on_heroku else 'redis://localhost:6379/0'
+
+# Server-side storage of the therapy sessions: 'redis', 'database' or 'memory' (single process only)
+THERAPY_STATE_STORE = os.environ.get('THERAPY_STATE_STORE', 'redis')
+THERAPY_STATE_TTL = 60 * 60 * 24 * 14  # seconds, like the session cookie
+
+# Display the therapist replies while they are generated. The stream is served by TherapistGPT/asgi.py only, which
+# turns it on: it stays off on a WSGI server
+THERAPY_STREAMING = os.environ.get('THERAPY_STREAMING', '0') == '1'
+
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379') if is_on_heroku else 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://localhost:6379') if is_on_heroku else 'redis://localhost:6379'
@@ -2,6 +2,8 @@ let user_name = 'user';
 let user_name_changed = false;
 let valid_api_key = false;
 const DEBUG = false;
+// Display the therapist replies while they are generated, when the server serves the stream (settings.THERAPY_STREAMING)
+const STREAMING = JSON.parse(document.getElementById('streaming')?.textContent ?? 'false');
 
 document.addEventListener('DOMContentLoaded', () => {
     const messageForm = document.getElementById('message-form');
@@ -131,11 +133,17 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // Send user message to TherapistGPT and handle the response asynchronously
 
+            let stream = null;
+
             try {
                 const taskId = await TaskIDSendMessageToTherapist(userMessage);
 
+                stream = streamTherapistMessage(taskId);
+
                 const response = await getTaskResult(taskId);
 
+                stream.close();
+
                 if (response.response === false) {
                     alert('Please provide a valid OpenAI API Key, with the blue button on the bottom right of the window.');}
 
@@ -148,9 +156,17 @@ document.addEventListener('DOMContentLoaded', () => {
                     // pass
                 }
 
-                await addMessageToChat('therapist', response.response['response'], true);
+                if (stream.textElement) {
+                    // The final message replaces the streamed one
+                    stream.textElement.innerHTML = response.response['response'].replace(/\n/g, '<br>');
+                } else {
+                    await addMessageToChat('therapist', response.response['response'], true);
+                }
 
             } catch (error) {
+                if (stream) {
+                    stream.close();
+                }
                 console.error('Error getting therapist message:', error);
             }
 
@@ -159,7 +175,60 @@ document.addEventListener('DOMContentLoaded', () => {
         // Sending first message totherapist
         sendMessageToTherapist('Start_conversation', true)
 
+        // Show the reply tokens as they are generated, the stream is closed once the task result is received
+        function streamTherapistMessage(task_id) {
+            const stream = {textElement: null, source: null, close: () => {
+                if (stream.source) {
+                    stream.source.close();
+                }
+            }};
+
+            if (!STREAMING || !window.EventSource) {
+                return stream;
+            }
+
+            stream.source = new EventSource('/therapy/stream/' + task_id + '/');
+
+            stream.source.addEventListener('token', (event) => {
+                if (!stream.textElement) {
+                    stream.textElement = createMessageElement('therapist').querySelector('.message-text');
+                }
+                stream.textElement.innerHTML += JSON.parse(event.data).replace(/\n/g, '<br>');
+                messagesContainer.scrollTo({top: messagesContainer.scrollHeight});
+            });
+
+            stream.source.addEventListener('done', stream.close);
+            stream.source.addEventListener('error', stream.close);
+
+            return stream;
+        }
+
         async function addMessageToChat(sender, message, withTypingEffect = false) {
+
+            message = message.replace(/\n/g, '<br>')
+
+            const messageElement = createMessageElement(sender);
+
+            const messageTextElement = messageElement.querySelector('.message-text');
+            if (withTypingEffect && !DEBUG) {
+                for (const word of message.split(' ')) {
+                    messageTextElement.innerHTML += word + ' ';
+                    await new Promise((resolve) => setTimeout(resolve, 75));
+                }
+            } else {
+                messageTextElement.innerHTML = message;
+            }
+
+            messagesContainer.scrollTo({
+                top: messagesContainer.scrollHeight,
+                behavior: 'smooth',
+            });
+
+            messageElement.scrollIntoView({behavior: "smooth", block: "end"});
+
+        }
+
+        function createMessageElement(sender) {
             let sender_name;
             const messageElement = document.createElement('div');
             messageElement.classList.add('message', sender);
@@ -178,8 +247,6 @@ document.addEventListener('DOMContentLoaded', () => {
 
             }
 
-            message = message.replace(/\n/g, '<br>')
-
             if (sender === 'user') {
                 sender_name = user_name;
             } else {
@@ -206,23 +273,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             messagesContainer.appendChild(messageElement);
 
-            const messageTextElement = messageElement.querySelector('.message-text');
-            if (withTypingEffect && !DEBUG) {
-                for (const word of message.split(' ')) {
-                    messageTextElement.innerHTML += word + ' ';
-                    await new Promise((resolve) => setTimeout(resolve, 75));
-                }
-            } else {
-                messageTextElement.innerHTML = message;
-            }
-
-            messagesContainer.scrollTo({
-                top: messagesContainer.scrollHeight,
-                behavior: 'smooth',
-            });
-
-            messageElement.scrollIntoView({behavior: "smooth", block: "end"});
-
+            return messageElement;
         }
 
         async function TaskIDSendMessageToTherapist(message, first_msg=false) {
@@ -234,7 +285,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     'Content-Type': 'application/x-www-form-urlencoded',
                     'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value,
                 },
-                body: new URLSearchParams({input_text: message}),
+                body: new URLSearchParams({input_text: message, stream: STREAMING ? '1' : '0'}),
             });
             const data = await response.json();
 
@@ -242,12 +293,12 @@ document.addEventListener('DOMContentLoaded', () => {
 
         }
 
-        // Check periodically if the Therapist answer has been computed
+        // Wait for the Therapist answer: the server holds the request until the task is done or its wait times out
         async function getTaskResult(task_id) {
             return new Promise(async (resolve, reject) => {
                 const checkStatus = async () => {
 
-                    const response = await fetch('/therapy/check-task-status/', {
+                    const response = await fetch('/therapy/wait-task-status/', {
                         method: 'POST',
                         headers: {
                             'Content-Type': 'application/x-www-form-urlencoded',
@@ -264,7 +315,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         console.log('Failed to retrieve therapist message')
                         reject(new Error('Task failed'));
                     } else {
-                        setTimeout(checkStatus, 2000);} // Check status every 2000 milisecond / 2s
+                        setTimeout(checkStatus, json.retry_after || 0);} // Retry hint given by the server
 
                 }
                 checkStatus();
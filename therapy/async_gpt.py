@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import threading
+import time
+import warnings
+from typing import Union, Tuple, Dict
+
+import aiohttp
+import openai
+
+from .gpt_utils import GPT, APIQueryError, PRIORITY_SIDE, PRIORITY_BACKGROUND
+
+OPENAI_API_BASE = 'https://api.openai.com/v1'
+
+
+class ClientPool:
+
+    """
+    Keep-alive HTTP connection pools to the OpenAI API, one aiohttp session per API key.
+
+    The sessions live on a dedicated event loop running in a daemon thread, so they survive between tasks and are
+    shared by every caller of the process whatever its own event loop (or lack thereof). Nothing is stored in the
+    openai module: the key is sent with each request and the session is only bound to the running task's context.
+    """
+
+    def __init__(self, limit_per_key: int = 20, keepalive_timeout: float = 60.0):
+        self.limit_per_key = limit_per_key
+        self.keepalive_timeout = keepalive_timeout
+
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sessions: dict[str, aiohttp.ClientSession] = {}  # sha256 of the API key -> session
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name='gpt-client-pool', daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+
+        return self._loop
+
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def get_session(self, api_key: str) -> aiohttp.ClientSession:
+
+        """
+        Get the pooled session of an API key. Must be called from the pool's loop.
+        """
+
+        key_id = self.key_id(api_key)
+        session = self._sessions.get(key_id)
+
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit_per_key, keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[key_id] = session
+
+        return session
+
+    async def call(self, coroutine):
+
+        """
+        Await a coroutine on the pool's loop, from any loop
+        """
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            return await coroutine
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def run(self, coroutine, timeout: float = None):
+
+        """
+        Run a coroutine on the pool's loop from synchronous code and wait for its result
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    async def _warm(self, api_key: str) -> None:
+
+        session = self.get_session(api_key)
+
+        try:
+            async with session.get(f'{OPENAI_API_BASE}/models',
+                                   headers={'Authorization': f'Bearer {api_key}'}) as response:
+                await response.read()
+
+        except aiohttp.ClientError as e:
+            warnings.warn(f'Could not warm the OpenAI connection pool: {e}')
+
+    def warm(self, api_keys: list[str]) -> None:
+
+        """
+        Open the connections (TCP + TLS) of the given keys in the background, before their first calls
+        """
+
+        for api_key in api_keys:
+            if api_key:
+                asyncio.run_coroutine_threadsafe(self._warm(api_key), self.loop)
+
+    async def _close(self) -> None:
+
+        for session in self._sessions.values():
+            await session.close()
+
+        self._sessions = {}
+
+    def close(self) -> None:
+
+        if self._loop is not None:
+            self.run(self._close())
+
+
+CLIENT_POOL = ClientPool()
+
+
+class AsyncGPT(GPT):
+
+    """
+    Asynchronous counterpart of GPT, with the same query_API / paraphrase / summarize surface.
+
+    Requests go through the keep-alive session of the API key in CLIENT_POOL, so many sessions' calls can run
+    concurrently in one process without racing on openai.api_key nor paying a TLS handshake per call.
+    """
+
+    def __init__(self, api_key: str, pool: ClientPool = None, **kwargs):
+        super().__init__(api_key, **kwargs)
+
+        self.pool = pool or CLIENT_POOL
+
+    async def _create(self, query: dict, timeout: float):
+
+        token = openai.aiosession.set(self.pool.get_session(self.api_key))
+
+        try:
+            return await openai.ChatCompletion.acreate(api_key=self.api_key, request_timeout=timeout, **query)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def query_API(self,
+                        messages: list[dict],
+                        key_to_protect: str = 'CONTEXT',
+                        only_content: bool = True,
+                        fast_model: bool = False,
+                        rate_priority: int = PRIORITY_SIDE,
+                        **kwargs) -> Union[dict, str] or str:
+
+        """
+        See GPT.query_API, the calls are retried but never hedged
+        """
+
+        query, packing = self.pack_query(messages, key_to_protect=key_to_protect, fast_model=fast_model, **kwargs)
+
+        async def send(timeout: float):
+
+            # The limiter waits by sleeping, off the event loop
+            estimated_tokens = packing.tokens + query['max_tokens']
+            admission = await asyncio.to_thread(self.rate_limiter.acquire, self.api_key, query['model'],
+                                                estimated_tokens, rate_priority)
+
+            start = time.monotonic()
+
+            # The circuit breaker is updated off the event loop too
+            try:
+                created = await self.pool.call(self._create(query, timeout))
+            except Exception as e:
+                await asyncio.to_thread(self.circuit_breaker.record, query['model'], time.monotonic() - start, 0, e)
+                raise
+
+            await asyncio.to_thread(self.circuit_breaker.record, query['model'], time.monotonic() - start,
+                                    created.get('usage', {}).get('completion_tokens', 0))
+
+            if 'usage' in created:
+                await asyncio.to_thread(self.rate_limiter.adjust, self.api_key, query['model'], admission.tokens,
+                                        created['usage']['total_tokens'])
+
+            return created
+
+        response = await self.api_caller.acall(send, timeout=self.api_caller.timeout(query['max_tokens']))
+
+        self.last_model_used = query['model']
+
+        return self.read_response(response, only_content=only_content)
+
+    async def summarize(self, content: str,
+                        target_tokens: int = 2048,
+                        max_rounds: int = 3,
+                        return_process: bool = False,
+                        fast_model: bool = False) -> Union[str, Tuple[str, Dict[str, Dict[str, int]]]]:
+
+        """
+        See GPT.summarize, the chunks of a round are summarized concurrently on the event loop
+        """
+
+        async def aquery(messages: list[dict], target: int) -> str or APIQueryError:
+            try:
+                return await self.query_API(messages, key_to_protect='Please', fast_model=fast_model, temperature=0,
+                                            max_tokens=2 * target, rate_priority=PRIORITY_BACKGROUND)
+            except APIQueryError as e:
+                return e
+
+        return await self.get_summarizer(fast_model=fast_model, max_rounds=max_rounds).asummarize(
+            content, target_tokens=target_tokens, return_process=return_process, aquery=aquery)
+
+    async def paraphrase(self, content: str, context: str = None) -> str:
+
+        return await self.query_API(self.paraphrase_messages(content, context=context),
+                                    key_to_protect='Please',
+                                    only_content=True,
+                                    rate_priority=PRIORITY_BACKGROUND)
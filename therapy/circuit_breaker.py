@@ -0,0 +1,296 @@
+import threading
+import warnings
+from typing import Callable
+
+import openai
+import yaml
+
+from .resilience import is_retryable
+
+CIRCUIT_PREFIX = 'therapy:circuit:'
+N_BUCKETS = 6  # The window is a ring of buckets, the oldest one is replaced as the window slides
+
+CLOSED, OPEN, PROBE = 0, 1, 2
+
+CIRCUIT_BREAKER_STATS = {'allowed': 0, 'diverted': 0, 'probes': 0}  # Turns of this process
+CIRCUIT_BREAKER_STATS_LOCK = threading.Lock()
+
+# Whether a turn can use the model. An open breaker lets a probe through every probe interval once its open time
+# is over (half-open).
+#   KEYS: state
+#   ARGV: probe interval (ms)
+#   Returns CLOSED, OPEN or PROBE
+ALLOW_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'state', 'until', 'last_probe')
+
+if state[1] == 'open' then
+    if now < tonumber(state[2]) then
+        return 1
+    end
+
+    redis.call('HSET', KEYS[1], 'state', 'half-open', 'successes', '0', 'last_probe', tostring(now))
+    return 2
+end
+
+if state[1] == 'half-open' then
+    if now - tonumber(state[3]) < tonumber(ARGV[1]) then
+        return 1
+    end
+
+    redis.call('HSET', KEYS[1], 'last_probe', tostring(now))
+    return 2
+end
+
+return 0
+"""
+
+# Counts a call in the rolling window and updates the breaker: a closed breaker opens when the error or slow rate of
+# the window is too high, a half-open one closes after enough good calls in a row and opens again at the first bad one.
+#   KEYS: state, window
+#   ARGV: error (0/1), slow (0/1), bucket (ms), min calls, max error rate, max slow rate, open time (ms),
+#         successes closing the breaker
+#   Returns the state after the call, CLOSED, OPEN or PROBE (half-open)
+RECORD_SCRIPT = """
+local error = tonumber(ARGV[1]) == 1
+local slow = tonumber(ARGV[2]) == 1
+local bucket_ms = tonumber(ARGV[3])
+local n_buckets = """ + str(N_BUCKETS) + """
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = math.floor(now / bucket_ms)
+local slot = (bucket % n_buckets) .. ':'
+
+if tonumber(redis.call('HGET', KEYS[2], slot .. 'bucket')) ~= bucket then
+    redis.call('HSET', KEYS[2], slot .. 'bucket', bucket, slot .. 'calls', 0, slot .. 'errors', 0, slot .. 'slow', 0)
+end
+
+redis.call('HINCRBY', KEYS[2], slot .. 'calls', 1)
+if error then
+    redis.call('HINCRBY', KEYS[2], slot .. 'errors', 1)
+end
+if slow then
+    redis.call('HINCRBY', KEYS[2], slot .. 'slow', 1)
+end
+redis.call('PEXPIRE', KEYS[2], bucket_ms * n_buckets)
+
+local state = redis.call('HGET', KEYS[1], 'state')
+
+if state == 'half-open' then
+    if not error and not slow then
+        if redis.call('HINCRBY', KEYS[1], 'successes', 1) >= tonumber(ARGV[8]) then
+            -- The window of the outage is forgotten with it, the times the breaker opened are kept
+            redis.call('HDEL', KEYS[1], 'state', 'successes', 'until')
+            redis.call('DEL', KEYS[2])
+            return 0
+        end
+        return 2
+    end
+
+    redis.call('HSET', KEYS[1], 'state', 'open', 'until', tostring(now + tonumber(ARGV[7])))
+    return 1
+end
+
+if state == 'open' then
+    return 1
+end
+
+local calls, errors, slows = 0, 0, 0
+for i = 0, n_buckets - 1 do
+    local counts = redis.call('HMGET', KEYS[2], i .. ':bucket', i .. ':calls', i .. ':errors', i .. ':slow')
+
+    if counts[1] and tonumber(counts[1]) > bucket - n_buckets then
+        calls = calls + tonumber(counts[2])
+        errors = errors + tonumber(counts[3])
+        slows = slows + tonumber(counts[4])
+    end
+end
+
+if calls >= tonumber(ARGV[4]) and (errors >= calls * tonumber(ARGV[5]) or slows >= calls * tonumber(ARGV[6])) then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'until', tostring(now + tonumber(ARGV[7])))
+    redis.call('HINCRBY', KEYS[1], 'opened', 1)
+    return 1
+end
+
+return 0
+"""
+
+
+def get_default_redis():
+
+    from .redis_utils import get_redis
+
+    return get_redis()
+
+
+class CircuitBreaker:
+
+    """
+    Per model circuit breaker of the API calls, on the latency SLO and the error rate of the whole fleet.
+
+    Every call to the API is counted in a rolling window kept in Redis, shared by the workers: its errors (timeouts,
+    connection and server errors, not the ones of the request itself) and whether it broke the latency SLO (first
+    token or whole answer later than latency_slo, plus seconds_per_token per token of a complete answer). When too
+    many calls of the window failed or were slow, the breaker opens: the turns stop using the model (see
+    Therapy.play_conversation, they run on the fast model) for open_seconds. Then it's half-open: a turn every
+    probe_interval uses the model again, probe_successes good calls in a row close the breaker and a bad one opens
+    it again.
+
+    Without Redis the breaker is always closed.
+
+    :param enabled: False never opens the breaker
+    :param window: Seconds of the rolling window
+    :param min_calls: Calls in the window before the breaker can open
+    :param max_error_rate: Share of failed calls opening the breaker
+    :param max_slow_rate: Share of calls over the latency SLO opening the breaker
+    :param latency_slo: Seconds to the first token, or to a complete answer without its tokens
+    :param seconds_per_token: Seconds per token of a complete answer added to the SLO
+    :param open_seconds: Seconds before the first probe of an open breaker
+    :param probe_interval: Seconds between two probes of a half-open breaker
+    :param probe_successes: Good calls in a row closing a half-open breaker
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 window: float = 60.0,
+                 min_calls: int = 20,
+                 max_error_rate: float = 0.2,
+                 max_slow_rate: float = 0.3,
+                 latency_slo: float = 10.0,
+                 seconds_per_token: float = 0.06,
+                 open_seconds: float = 30.0,
+                 probe_interval: float = 5.0,
+                 probe_successes: int = 3,
+                 redis_factory: Callable = get_default_redis):
+
+        self.enabled = enabled
+        self.window = window
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.max_slow_rate = max_slow_rate
+        self.latency_slo = latency_slo
+        self.seconds_per_token = seconds_per_token
+        self.open_seconds = open_seconds
+        self.probe_interval = probe_interval
+        self.probe_successes = probe_successes
+        self.redis_factory = redis_factory if enabled else None
+
+        self._scripts = None
+
+    def _redis(self):
+
+        try:
+            redis = self.redis_factory() if self.redis_factory else None
+        except Exception as e:
+            warnings.warn(f'Circuit breaker disabled, Redis unavailable: {e}')
+            self.redis_factory = None
+            return None
+
+        if redis is not None and self._scripts is None:
+            self._scripts = redis.register_script(ALLOW_SCRIPT), redis.register_script(RECORD_SCRIPT)
+
+        return redis
+
+    @staticmethod
+    def state_key(model: str) -> str:
+        return f'{CIRCUIT_PREFIX}{model}'
+
+    @staticmethod
+    def window_key(model: str) -> str:
+        return f'{CIRCUIT_PREFIX}{model}:window'
+
+    def allow(self, model: str) -> bool:
+
+        """
+        :return: True if the turn can use the model, False if it should run on the fast model
+        """
+
+        state = CLOSED
+
+        if self._redis() is not None:
+            try:
+                state = self._scripts[0](keys=[self.state_key(model)], args=[int(self.probe_interval * 1000)])
+            except Exception as e:
+                warnings.warn(f'Circuit breaker unavailable: {e}')
+
+        with CIRCUIT_BREAKER_STATS_LOCK:
+            CIRCUIT_BREAKER_STATS[{CLOSED: 'allowed', OPEN: 'diverted', PROBE: 'probes'}[state]] += 1
+
+        return state != OPEN
+
+    def record(self, model: str, seconds: float, tokens: int = 0, error: Exception = None) -> None:
+
+        """
+        Count a call to the API
+
+        :param seconds: Latency of the call
+        :param tokens: Tokens of the answer if it was complete, 0 if it's streamed
+        :param error: Error of the call, if it failed
+        """
+
+        # Errors of the request itself (invalid, authentication) or of the limits of its key say nothing of the model
+        if error is not None and (not is_retryable(error) or isinstance(error, openai.error.RateLimitError)):
+            return
+
+        if self._redis() is None:
+            return
+
+        slow = seconds > self.latency_slo + self.seconds_per_token * tokens
+
+        try:
+            self._scripts[1](keys=[self.state_key(model), self.window_key(model)],
+                             args=[int(error is not None), int(slow), int(self.window * 1000 / N_BUCKETS),
+                                   self.min_calls, self.max_error_rate, self.max_slow_rate,
+                                   int(self.open_seconds * 1000), self.probe_successes])
+        except Exception as e:
+            warnings.warn(f'Circuit breaker unavailable: {e}')
+
+    def status(self, model: str) -> dict:
+
+        """
+        :return: State of the breaker of the model ('closed', 'open' or 'half-open'), times it opened, and the calls,
+         error rate and slow rate of the window
+        """
+
+        redis = self._redis()
+
+        if redis is None:
+            return {'state': 'disabled', 'opened': 0, 'calls': 0, 'error_rate': 0.0, 'slow_rate': 0.0}
+
+        state = {key.decode(): value.decode() for key, value in redis.hgetall(self.state_key(model)).items()}
+        window = {key.decode(): int(value) for key, value in redis.hgetall(self.window_key(model)).items()}
+
+        # The buckets of the window, relative to the latest one
+        latest = max((value for key, value in window.items() if key.endswith(':bucket')), default=0)
+        counts = {counter: sum(window.get(f'{i}:{counter}', 0) for i in range(N_BUCKETS)
+                               if window.get(f'{i}:bucket', -N_BUCKETS) > latest - N_BUCKETS)
+                  for counter in ('calls', 'errors', 'slow')}
+
+        return {'state': state.get('state', 'closed'),
+                'opened': int(state.get('opened', 0)),
+                'calls': counts['calls'],
+                'error_rate': counts['errors'] / counts['calls'] if counts['calls'] else 0.0,
+                'slow_rate': counts['slow'] / counts['calls'] if counts['calls'] else 0.0}
+
+
+def load_circuit_breaker(path: str = 'parameters.yaml') -> CircuitBreaker:
+
+    parameters = (yaml.safe_load(open(path, 'r')) or {}).get('circuit-breaker', {})
+
+    return CircuitBreaker(enabled=parameters.get('enabled', True),
+                          window=parameters.get('window', 60.0),
+                          min_calls=parameters.get('min-calls', 20),
+                          max_error_rate=parameters.get('max-error-rate', 0.2),
+                          max_slow_rate=parameters.get('max-slow-rate', 0.3),
+                          latency_slo=parameters.get('latency-slo', 10.0),
+                          seconds_per_token=parameters.get('seconds-per-token', 0.06),
+                          open_seconds=parameters.get('open-seconds', 30.0),
+                          probe_interval=parameters.get('probe-interval', 5.0),
+                          probe_successes=parameters.get('probe-successes', 3))
+
+
+CIRCUIT_BREAKER = load_circuit_breaker()
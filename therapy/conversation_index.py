@@ -0,0 +1,87 @@
+import heapq
+import math
+import zlib
+from bisect import bisect_left
+from collections import defaultdict
+
+from .retrieval import terms, N_FEATURES
+
+
+def message_terms(content: str) -> set[int]:
+
+    """
+    Hashed terms of a message, the features of the guidelines index (see retrieval.hash_terms)
+    """
+
+    return {zlib.crc32(term.encode()) % N_FEATURES for term in terms(content)}
+
+
+class ConversationIndex:
+
+    """
+    Inverted index of the messages of a conversation, to recall the past turns relevant to the current one (the
+    client referring to something said long ago) instead of sending ever more history.
+
+    The index maps the hashed terms of the messages to the ascending positions of the messages holding them. It's
+    updated with the messages appended since the last query, so indexing a turn costs O(new messages), and a query
+    reads the postings of its own terms only. It's derived from the conversation rather than stored next to it: it
+    lives with the Therapy in the worker's pool (see TherapyPool), only a cold load indexes the stored conversation
+    again, and the state doesn't grow by the terms of every message.
+    """
+
+    def __init__(self):
+        self._conversation = None
+        self.postings: dict[int, list[int]] = defaultdict(list)
+        self.lengths: list[int] = []  # Number of terms of each indexed message
+        self.total_terms = 0
+
+    def _sync(self, conversation: list[dict]) -> None:
+
+        if conversation is not self._conversation or len(conversation) < len(self.lengths):
+            self._conversation = conversation
+            self.postings = defaultdict(list)
+            self.lengths = []
+            self.total_terms = 0
+
+        for position in range(len(self.lengths), len(conversation)):
+            message = conversation[position]
+
+            # System messages of the conversation are commands, not something the client said
+            terms = message_terms(message['content']) if message['role'] != 'system' else []
+
+            for term in terms:
+                self.postings[term].append(position)
+
+            self.lengths.append(len(terms))
+            self.total_terms += len(terms)
+
+    def search(self, conversation: list[dict], query: str, end: int, k: int = 3) -> list[tuple[float, int]]:
+
+        """
+        :param conversation: Messages of the conversation
+        :param query: Text the messages should be relevant to
+        :param end: Only search the messages before this position
+        :param k: Maximum number of messages
+        :return: The positions of the best messages with their score (BM25 on the presence of terms), best first
+        """
+
+        self._sync(conversation)
+
+        n_messages = len(self.lengths)
+        average_length = (self.total_terms / n_messages if n_messages else 0) or 1
+
+        scores = defaultdict(float)
+
+        for term in message_terms(query):
+            positions = self.postings.get(term)
+
+            if not positions:
+                continue
+
+            idf = math.log(1 + (n_messages - len(positions) + 0.5) / (len(positions) + 0.5))
+
+            for position in positions[:bisect_left(positions, end)]:
+                # b = 0.75, k1 = 1.2 with a term frequency of 1
+                scores[position] += idf * 2.2 / (1 + 1.2 * (0.25 + 0.75 * self.lengths[position] / average_length))
+
+        return heapq.nlargest(k, ((score, position) for position, score in scores.items()))
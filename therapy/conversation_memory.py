@@ -0,0 +1,92 @@
+from typing import Optional
+
+
+class ConversationMemory:
+
+    """
+    Tiered memory of a conversation: the last messages are kept verbatim, the older ones are folded, segment by
+    segment, into summaries. Folding calls the API and happens off the hot path (see tasks.fold_conversation_memory),
+    so until a segment is folded its messages are still read verbatim.
+
+    The summaries are bounded: when they exceed max_summary_tokens the two oldest segments are merged into one.
+
+    :param recent_messages: Number of last messages never folded
+    :param segment_messages: Number of messages folded together in a segment
+    :param max_summary_tokens: Maximum length of all the summaries
+    """
+
+    def __init__(self, recent_messages: int = 12, segment_messages: int = 8, max_summary_tokens: int = 600):
+        self.recent_messages = recent_messages
+        self.segment_messages = segment_messages
+        self.max_summary_tokens = max_summary_tokens
+
+        self.folded_until = 0  # Messages before this index are covered by the segments
+        self.segments: list[dict] = []  # {'start', 'end', 'summary', 'tokens'}, in conversation order
+
+    def to_dict(self) -> dict:
+        return {'folded_until': self.folded_until, 'segments': self.segments}
+
+    def load(self, state: Optional[dict]) -> None:
+
+        state = state or {}
+
+        self.folded_until = state.get('folded_until', 0)
+        self.segments = state.get('segments', [])
+
+    @property
+    def summary_tokens(self) -> int:
+        return sum(segment['tokens'] for segment in self.segments)
+
+    def get_summaries(self, token_limit: int) -> tuple[list[str], int]:
+
+        """
+        :return: The newest summaries whose total length fits in token_limit, in conversation order, and their length
+        """
+
+        summaries = []
+        tokens = 0
+
+        for segment in reversed(self.segments):
+            if tokens + segment['tokens'] > token_limit:
+                break
+
+            summaries.insert(0, segment['summary'])
+            tokens += segment['tokens']
+
+        return summaries, tokens
+
+    def next_segment(self, n_messages: int) -> Optional[tuple[int, int]]:
+
+        """
+        :param n_messages: Length of the conversation
+        :return: Start and end of the next segment to fold, None if the unfolded messages are all recent ones
+        """
+
+        if n_messages - self.recent_messages - self.folded_until < self.segment_messages:
+            return None
+
+        return self.folded_until, self.folded_until + self.segment_messages
+
+    def add_segment(self, start: int, end: int, summary: str, tokens: int) -> None:
+
+        if start != self.folded_until:
+            raise ValueError(f'Segment starts at message {start}, the memory is folded until {self.folded_until}.')
+
+        self.segments.append({'start': start, 'end': end, 'summary': summary, 'tokens': tokens})
+        self.folded_until = end
+
+    def needs_merge(self) -> bool:
+        return len(self.segments) > 1 and self.summary_tokens > self.max_summary_tokens
+
+    def merge_oldest(self, summary: str, tokens: int) -> None:
+
+        """
+        Replace the two oldest segments by one, summarized by summary
+        """
+
+        first, second = self.segments[:2]
+
+        self.segments[:2] = [{'start': first['start'], 'end': second['end'], 'summary': summary, 'tokens': tokens}]
+
+    def pending_work(self, n_messages: int) -> bool:
+        return self.next_segment(n_messages) is not None or self.needs_merge()
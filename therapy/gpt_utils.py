@@ -1,9 +1,39 @@
-from typing import Union, Tuple, Dict
+from typing import Union, Tuple, Dict, NamedTuple, Callable, Iterable
+from array import array
+from bisect import bisect_right
 import openai
 import tiktoken
 import os
 from datetime import datetime
+import threading
+import time
 import warnings
+import json
+
+from .response_cache import RESPONSE_CACHE
+from .rate_limiter import RATE_LIMITER, PRIORITY_INTERACTIVE, PRIORITY_SIDE, PRIORITY_BACKGROUND
+from .resilience import API_CALLER, APIQueryError
+from .circuit_breaker import CIRCUIT_BREAKER
+from .summarizer import Summarizer
+from .conversation_memory import ConversationMemory
+from .conversation_index import ConversationIndex
+from .transcript import TranscriptRenderer
+
+DEFAULT_ENCODING = 'cl100k_base'  # Tokenizer of gpt-4 and gpt-3.5-turbo
+
+ENCODERS = {}  # Process-wide tokenizer registry, model name -> tiktoken encoder
+ENCODERS_LOCK = threading.Lock()
+
+MODEL_CONTEXT_WINDOWS = {'gpt-4': 8192, 'gpt-3.5-turbo': 4096}
+
+TOKENS_PER_MESSAGE = 4  # Role and separators added around each message by the chat format
+TOKENS_PER_REPLY = 3  # Priming of the assistant reply
+
+PRIORITY_PINNED = 100  # Never dropped by the packer
+PRIORITY_DEFAULT = 0
+
+PACKING_STATS = {'queries': 0, 'truncated': 0, 'messages_dropped': 0, 'tokens_dropped': 0}
+PACKING_STATS_LOCK = threading.Lock()
 
 
 def MessageTooLong(message_length: int, max_length: int = 8192):
@@ -11,6 +41,120 @@ def MessageTooLong(message_length: int, max_length: int = 8192):
                   f'{max_length} tokens. Please shorten your message.')
 
 
+def get_encoder(model: str = 'gpt-4') -> tiktoken.Encoding:
+
+    """
+    Get the tokenizer of a model from the process-wide registry, building it on first use only
+    :param model: Name of the model, unknown models fall back on the gpt-4/gpt-3.5 tokenizer
+    :return: The tiktoken encoder
+    """
+
+    encoder = ENCODERS.get(model)
+
+    if encoder is None:
+        with ENCODERS_LOCK:
+            if model not in ENCODERS:
+                try:
+                    ENCODERS[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    ENCODERS[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+
+            encoder = ENCODERS[model]
+
+    return encoder
+
+
+def count_tokens(text: str, model: str = 'gpt-4') -> int:
+
+    return len(get_encoder(model).encode_ordinary(text))
+
+
+def count_tokens_batch(texts: list[str], model: str = 'gpt-4') -> list[int]:
+
+    """
+    Token count of several texts, encoded in one batch
+    """
+
+    if not texts:
+        return []
+
+    return [len(tokens) for tokens in get_encoder(model).encode_ordinary_batch(texts)]
+
+
+class PackedMessages(NamedTuple):
+    messages: list[dict]  # Ready for the API: only 'role' and 'content'
+    tokens: int
+    dropped: list[dict]
+    dropped_tokens: int
+
+
+def pack_messages(messages: list[dict],
+                  budget: int,
+                  answer_reserve: int = 0,
+                  key_to_protect: str = 'CONTEXT',
+                  model: str = 'gpt-4') -> PackedMessages:
+
+    """
+    Fit role-tagged messages into a token budget in a single pass over their cached token counts.
+
+    System messages and the first non-system message containing key_to_protect are pinned, as is any message with a
+    'priority' of PRIORITY_PINNED. Other messages are dropped by ascending 'priority' (default PRIORITY_DEFAULT),
+    oldest first.
+
+    :param messages: Messages with 'role' and 'content', and optionally 'tokens' and 'priority'
+    :param budget: Total tokens available for the query and its answer
+    :param answer_reserve: Tokens to keep available for the answer
+    :param key_to_protect: Keyword of the message that must not be dropped
+    :param model: Model whose tokenizer counts the messages without a 'tokens' field
+    :return: The packed messages in their original order, and what was dropped
+    """
+
+    available = budget - answer_reserve - TOKENS_PER_REPLY
+
+    counts = []
+    # Droppable indexes by priority, in ascending order: priorities are a few fixed values, so the drop order is
+    # read from the buckets without sorting the messages
+    buckets = {}
+    protected_found = False
+    for i, message in enumerate(messages):
+        tokens = message['tokens'] if 'tokens' in message else count_tokens(message['content'], model=model)
+        counts.append(tokens + TOKENS_PER_MESSAGE)
+
+        priority = message.get('priority', PRIORITY_DEFAULT)
+        if message['role'] == 'system':
+            priority = PRIORITY_PINNED
+        elif not protected_found and key_to_protect and key_to_protect in message['content']:
+            protected_found = True
+            priority = PRIORITY_PINNED
+
+        if priority < PRIORITY_PINNED:
+            buckets.setdefault(priority, []).append(i)
+
+    total = sum(counts)
+    dropped_indexes = set()
+
+    if total > available:
+        for priority in sorted(buckets):
+            for i in buckets[priority]:
+                if total <= available:
+                    break
+
+                dropped_indexes.add(i)
+                total -= counts[i]
+
+        if total > available:
+            MessageTooLong(total + answer_reserve, max_length=budget)
+
+    packed = [{'role': message['role'], 'content': message['content']}
+              for i, message in enumerate(messages) if i not in dropped_indexes]
+    dropped = [message for i, message in enumerate(messages) if i in dropped_indexes]
+
+    return PackedMessages(messages=packed,
+                          tokens=total,
+                          dropped=dropped,
+                          dropped_tokens=sum(counts[i] for i in dropped_indexes))
+
+
 class GPT:
     def __init__(self,
                  api_key: str,
@@ -29,12 +173,12 @@ class GPT:
 
         self.base_max_token_query = self.max_token_per_message - self.max_token_answer  # Base we can send to the API
 
-        self.MessagesHandler = MessagesHandler()
+        self.MessagesHandler = MessagesHandler(model=self.model)
 
         self.GPT_model = openai.ChatCompletion(model=self.model)
         self.GPT_fast_model = openai.ChatCompletion(model=self.fast_model)
 
-        self.ENCODER = tiktoken.encoding_for_model('text-davinci-003')
+        self.ENCODER = get_encoder(self.model)
 
         self.prompt_paths = 'prompts'
         self.assistant_path = os.path.join(self.prompt_paths, 'assistant')
@@ -42,12 +186,16 @@ class GPT:
         self.prebuilt_path = os.path.join(self.prompt_paths, 'prebuilt')
         self.evidence_based_path = os.path.join(self.prompt_paths, 'evidence_based_data')
 
-        openai.api_key = self.api_key
-
         self.anamnesis = ''
         self.demand = ''
 
         self.last_model_used = None
+        self.last_packing = None
+
+        self.response_cache = RESPONSE_CACHE
+        self.rate_limiter = RATE_LIMITER
+        self.api_caller = API_CALLER
+        self.circuit_breaker = CIRCUIT_BREAKER
 
     @staticmethod
     def get_content_api_query(content: dict) -> str:
@@ -63,18 +211,22 @@ class GPT:
     def get_token(self, text: str):
 
         """
-        Get the amount of token in a text for model davinci-003
+        Get the amount of token in a text for the model in use
         :param text:
         :return:
         """
 
-        return len(self.ENCODER.encode(text))
+        return count_tokens(text, model=self.model)
 
     def query_API(self,
                   messages: list[dict],
                   key_to_protect: str = 'CONTEXT',
                   only_content: bool = True,
                   fast_model: bool = False,
+                  stream_callback: Callable[[str], None] = None,
+                  deterministic: bool = False,
+                  hedge: bool = False,
+                  rate_priority: int = None,
                   **kwargs) -> Union[dict, str] or str:
 
         """
@@ -82,60 +234,159 @@ class GPT:
          limit.
 
         :param fast_model: Runs on GPT-3.5 if True, otherwise runs on GPT-4.
+        :param stream_callback: If given, the answer is streamed and each new piece of content is passed to it as soon
+         as it is received. The full answer is still returned at the end.
+        :param deterministic: The answer only depends on the request (classification calls): identical requests are
+         served from the response cache and concurrent ones make a single API call.
+        :param hedge: For the deterministic calls answered in a few tokens only, the request is sent again when it's
+         slower than usual and the first answer is used (see resilience.APICaller).
+        :param rate_priority: Priority of the call for the rate limiter (see rate_limiter), PRIORITY_INTERACTIVE for a
+         streamed reply and PRIORITY_SIDE otherwise by default.
         :param only_content: Returns only the content of the API response if True, otherwise returns the full response.
         :param messages: A list of dictionaries, each containing a 'role' and 'content' key representing the role
          (system or user) and the content of the message, respectively.
         :param key_to_protect: A string representing the keyword in the content that should be protected from being
          removed when reducing the token count. Default value is 'CONTEXT'.
-        :return: The API response if the query is successful, otherwise None.
+        :return: The API response.
+        :raise APIQueryError: If the call failed, after the retries of the errors that may not happen again.
         """
 
-        # DEBUG
+        query, packing = self.pack_query(messages, key_to_protect=key_to_protect, fast_model=fast_model, **kwargs)
 
-        content = ''.join(message['content'] + ' ' for message in messages)
+        if rate_priority is None:
+            rate_priority = PRIORITY_INTERACTIVE if stream_callback is not None else PRIORITY_SIDE
 
-        if len_content := self.get_token(content) > self.max_token_per_message:
-            MessageTooLong(len_content)
+        # The key is passed with the request: openai.api_key is shared by every session of the process
+        completion = self.GPT_fast_model if fast_model else self.GPT_model
 
-        # get which message to pop out. Not system!
-        for index_to_pop, message in enumerate(messages):
-            if message['role'] != 'system' and key_to_protect in message['content']:
-                break
+        def create(timeout: float, **options):
 
-        # Cut the content
-        while len_content > self.max_token_per_message:
+            # Only the calls reaching the API are limited, not the cache hits
+            estimated_tokens = packing.tokens + query['max_tokens']
+            admission = self.rate_limiter.acquire(self.api_key, query['model'], estimated_tokens,
+                                                  priority=rate_priority)
+            self.api_caller.mark_admitted()
 
-            first_msg = messages.pop(index_to_pop)
-            len_content -= self.get_token(first_msg['content'])
+            start = time.monotonic()
 
-        # Check if a max_token has been passed and override the self parameter
-        if 'max_tokens' in kwargs:
-            max_token_answer = kwargs['max_tokens']
-            del kwargs['max_tokens']
+            try:
+                created = completion.create(api_key=self.api_key, request_timeout=timeout, **query, **options)
+            except Exception as e:
+                self.circuit_breaker.record(query['model'], time.monotonic() - start, error=e)
+                raise
 
-        else:
-            max_token_answer = self.max_token_answer
-
-        # QUERY
-        try:
-            if fast_model:
-                response = self.GPT_fast_model.create(messages=messages,
-                                                      model='gpt-3.5-turbo',
-                                                      max_tokens=max_token_answer,
-                                                      **kwargs)
+            # A stream has no usage, and testing a generator would consume it
+            if isinstance(created, dict) and 'usage' in created:
+                # Every request of a hedged call is counted, the one that lost the race too: the quantile is the one
+                # of single requests, without the wait of the rate limiter
+                if hedge:
+                    self.api_caller.latencies.record(query['model'], time.monotonic() - start)
+
+                self.circuit_breaker.record(query['model'], time.monotonic() - start,
+                                            tokens=created['usage']['completion_tokens'])
+                self.rate_limiter.adjust(self.api_key, query['model'], admission.tokens,
+                                         created['usage']['total_tokens'])
             else:
-                response = self.GPT_model.create(messages=messages,
-                                                 model='gpt-4',
-                                                 max_tokens=max_token_answer,
-                                                 **kwargs)
+                # A stream returns once its first chunk is ready
+                self.circuit_breaker.record(query['model'], time.monotonic() - start)
 
-            self.last_model_used = 'gpt-3.5-turbo' if fast_model else 'gpt-4'
+            return created
 
-        except Exception as e:  # TODO: Proper error handling
+        if stream_callback is not None:
+            def send(timeout: float) -> dict:
 
-            response = None
+                forwarded = False
 
-            return e
+                def forward(delta: str) -> None:
+                    nonlocal forwarded
+                    forwarded = True
+                    stream_callback(delta)
+
+                try:
+                    return self.read_stream(create(timeout, stream=True), forward)
+
+                except Exception as e:
+                    # The client already read the beginning of the answer, it can't be sent again
+                    if forwarded:
+                        raise APIQueryError(f'The answer was interrupted: {type(e).__name__}: {e}') from e
+                    raise
+
+            response = self.api_caller.call(send, timeout=self.api_caller.timeout())
+
+        elif deterministic:
+            response = self.response_cache.get_or_compute(
+                query, lambda: json.loads(json.dumps(self.api_caller.call(
+                    create, timeout=self.api_caller.timeout(query['max_tokens']),
+                    hedge_key=query['model'] if hedge else None))))
+
+        else:
+            response = self.api_caller.call(create, timeout=self.api_caller.timeout(query['max_tokens']))
+
+        self.last_model_used = query['model']
+
+        return self.read_response(response, only_content=only_content)
+
+    def prepare_query(self,
+                      messages: list[dict],
+                      key_to_protect: str = 'CONTEXT',
+                      fast_model: bool = False,
+                      **kwargs) -> dict:
+
+        """
+        Pack the messages for the model to query and build the arguments of the ChatCompletion request
+        """
+
+        return self.pack_query(messages, key_to_protect=key_to_protect, fast_model=fast_model, **kwargs)[0]
+
+    def pack_query(self,
+                   messages: list[dict],
+                   key_to_protect: str = 'CONTEXT',
+                   fast_model: bool = False,
+                   **kwargs) -> tuple[dict, PackedMessages]:
+
+        """
+        See prepare_query, also returns the packing of the messages
+        """
+
+        model = self.fast_model if fast_model else self.model
+
+        # Check if a max_token has been passed and override the self parameter
+        max_token_answer = kwargs.pop('max_tokens', self.max_token_answer)
+
+        # Drop the oldest droppable messages until the query and the answer fit in the context window
+        packing = pack_messages(messages,
+                                budget=min(self.max_token_per_message,
+                                           MODEL_CONTEXT_WINDOWS.get(model, self.max_token_per_message)),
+                                answer_reserve=max_token_answer,
+                                key_to_protect=key_to_protect,
+                                model=model)
+        self.last_packing = packing
+        self.record_packing(packing)
+
+        return {'model': model,
+                'messages': packing.messages,
+                'max_tokens': max_token_answer,
+                **kwargs}, packing
+
+    @staticmethod
+    def read_stream(chunks: Iterable[dict], stream_callback: Callable[[str], None]) -> dict:
+
+        """
+        Forward the content of a streamed completion to stream_callback and rebuild the full response
+        """
+
+        parts = []
+        for chunk in chunks:
+            delta = chunk['choices'][0].get('delta', {}).get('content')
+
+            if delta:
+                parts.append(delta)
+                stream_callback(delta)
+
+        return {'choices': [{'message': {'role': 'assistant', 'content': ''.join(parts)}}]}
+
+    @staticmethod
+    def read_response(response: dict or None, only_content: bool = True) -> Union[dict, str]:
 
         if response is None:
 
@@ -144,58 +395,71 @@ class GPT:
         else:
             return response['choices'][0]['message']['content'] if only_content else response
 
+    @staticmethod
+    def record_packing(packing: PackedMessages) -> None:
+
+        """
+        Update the process-wide truncation counters
+        """
+
+        with PACKING_STATS_LOCK:
+            PACKING_STATS['queries'] += 1
+
+            if packing.dropped:
+                PACKING_STATS['truncated'] += 1
+                PACKING_STATS['messages_dropped'] += len(packing.dropped)
+                PACKING_STATS['tokens_dropped'] += packing.dropped_tokens
+
+    def get_summarizer(self, fast_model: bool = False, max_rounds: int = 3) -> Summarizer:
+
+        def query(messages: list[dict], target: int) -> str or APIQueryError:
+
+            # A chunk that couldn't be summarized is kept as is (see Summarizer.read_summary)
+            try:
+                return self.query_API(messages, key_to_protect='Please', fast_model=fast_model, deterministic=True,
+                                      rate_priority=PRIORITY_BACKGROUND, temperature=0, max_tokens=2 * target)
+            except APIQueryError as e:
+                return e
+
+        # Chunks leave room for the summary prompt and the answer in a query
+        return Summarizer(query=query,
+                          token_counter=self.get_token,
+                          chunk_tokens=min(1024, self.base_max_token_query // 2),
+                          max_rounds=max_rounds)
+
     def summarize(self, content: str,
                   target_tokens: int = 2048,
-                  max_loop: int = 10,
-                  return_process: bool = False) -> Union[str, Tuple[str, Dict[str, Dict[str, int]]]]:
+                  max_rounds: int = 3,
+                  return_process: bool = False,
+                  fast_model: bool = False) -> Union[str, Tuple[str, Dict[str, Dict[str, int]]]]:
 
         """
-        Summarizes the given content to fit within the specified target token count by repeatedly querying the GPT API.
+        Summarizes the given content to fit within the specified target token count, see summarizer.Summarizer.
 
         :param content: A string containing the content to be summarized.
         :param target_tokens: An integer representing the target token count for the summarized content. Default value
          is 2048.
-        :param max_loop: An integer representing the maximum number of iterations to perform when summarizing the
-         content. Default value is 10.
+        :param max_rounds: Maximum number of map-reduce rounds, each summarizing the chunks of the content in
+         parallel. Default value is 3.
         :param return_process: A boolean indicating whether to return the summarization process information along
         with the summarized content. Default value is False.
+        :param fast_model: Runs on GPT-3.5 if True, otherwise runs on GPT-4.
         :return: If return_process is False, returns the summarized content as a string. If return_process is True,
          returns a tuple containing the summarized content and a dictionary with the summarization process details.
         """
 
-        if self.get_token(content) <= self.base_max_token_query:
-            MessageTooLong(self.get_token(content), max_length=self.base_max_token_query)
-
-        process_content = content[:self.base_max_token_query]
-
-        msg_handler = MessagesHandler()
-
-        reduced_data = {}
-        i_loop = 0
-        while (
-            len_content := self.get_token(process_content) > target_tokens
-        ) and i_loop <= max_loop:
-
-            msg = [msg_handler.create_message(role='user',
-                                              message=f'Please make the following content shorter: {content}',
-                                              time=False,
-                                              update_conv=False)]
+        return self.get_summarizer(fast_model=fast_model, max_rounds=max_rounds).summarize(
+            content, target_tokens=target_tokens, return_process=return_process)
 
-            process_content = self.get_content_api_query(self.query_API(msg, key_to_protect='Please'))
-
-            new_len_content = self.get_token(process_content)
-
-            reduced_data[f'Loop {i_loop}'] = {'Query': len_content,
-                                              'Answer': new_len_content,
-                                              'Difference': len_content - new_len_content}
-
-            len_content = new_len_content
-
-            i_loop += 1
+    def paraphrase(self, content: str, context: str = None) -> str:
 
-        return (process_content, reduced_data) if return_process else process_content
+        return self.query_API(self.paraphrase_messages(content, context=context),
+                              key_to_protect='Please',
+                              only_content=True,
+                              rate_priority=PRIORITY_BACKGROUND)
 
-    def paraphrase(self, content: str, context: str = None) -> str:
+    @staticmethod
+    def paraphrase_messages(content: str, context: str = None) -> list[dict]:
 
         if context:
             prompt = f'CONTEXT:\n{context}\n' \
@@ -210,12 +474,10 @@ class GPT:
 
         msg_handler = MessagesHandler()
 
-        msg = [msg_handler.create_message(role='user',
-                                          message=prompt,
-                                          time=False,
-                                          update_conv=False)]
-
-        return self.query_API(msg, key_to_protect='Please', only_content=True)
+        return [msg_handler.create_message(role='user',
+                                           message=prompt,
+                                           time=False,
+                                           update_conv=False)]
 
     @staticmethod
     def replace_conten_lists(tags: list[str], contents: list[str], replacements: list[str]) -> list[str]:
@@ -238,20 +500,72 @@ class GPT:
         return content
 
 
+SUMMARY_OVERHEAD = 16  # tokens of the header and the message around the summaries of a memory view
+
+
 class MessagesHandler:
-    def __init__(self):
+    def __init__(self, model: str = 'gpt-4', memory: ConversationMemory = None):
         self.time = TimeHandling()
 
-        self.ENCODER = tiktoken.encoding_for_model('text-davinci-003')
+        self.model = model
+        self.ENCODER = get_encoder(self.model)
+
+        self._conversation = []
+        self._token_prefix = array('q', [0])  # _token_prefix[i] = tokens of the i first messages
+
+        self.memory = memory or ConversationMemory()
+        self.transcript = TranscriptRenderer(token_counter=self.get_token)
+        self.index = ConversationIndex()
+
+    @property
+    def conversation(self) -> list[dict]:
+        return self._conversation
+
+    @conversation.setter
+    def conversation(self, conversation: list[dict]):
+        self.load_conversation(conversation)
+
+    def load_conversation(self, conversation: list[dict]) -> None:
+
+        """
+        Rehydrate a conversation, tokenizing in one batch only the messages that don't carry their token count yet
+        """
+
+        missing = [message for message in conversation if 'tokens' not in message]
+
+        for message, tokens in zip(missing, count_tokens_batch([message['content'] for message in missing],
+                                                               model=self.model)):
+            message['tokens'] = tokens
+
+        self._conversation = conversation
+        self._build_token_index()
+
+    def _build_token_index(self) -> None:
+
+        prefix = array('q', [0])
+        total = 0
+        for message in self._conversation:
+            total += message['tokens']
+            prefix.append(total)
+
+        self._token_prefix = prefix
+
+    def _sync_token_index(self) -> None:
 
-        self.conversation = []
+        """
+        Rebuild the index if the conversation list was modified without going through create_message
+        """
+
+        if len(self._token_prefix) != len(self._conversation) + 1:
+            self._build_token_index()
 
     def create_message(self, role: str,
                        message: str,
                        time: bool = True,
                        full_time: bool = False,
                        command: str = 'not_given',
-                       update_conv: bool = True):
+                       update_conv: bool = True,
+                       priority: int = None):
 
         assert role in {
             'assistant',
@@ -270,8 +584,15 @@ class MessagesHandler:
         if command != 'not_given':
             return_message['command'] = command
 
+        if priority is not None:
+            return_message['priority'] = priority
+
         if update_conv:
+            # Conversation messages are tokenized once, when created
+            return_message['tokens'] = self.get_token(message)
+            self._sync_token_index()
             self.conversation.append(return_message)
+            self._token_prefix.append(self._token_prefix[-1] + return_message['tokens'])
 
         return return_message
 
@@ -284,55 +605,113 @@ class MessagesHandler:
         return [
             {'role': message['role'], 'content': message['content']}
             for message in chat
-        ] if chat else [
+        ] if chat is not None else [
             {'role': message['role'], 'content': message['content']}
             for message in self.conversation
         ]
 
-    def get_last_messages(self, token_limit: int = 2048, n_messages: int = 0):
+    def get_last_messages(self, token_limit: int = 2048, n_messages: int = 0) -> list[dict]:
 
         """
         Warning: Token limit ovverrides n_messages.
 
         :param token_limit:
         :param n_messages:
-        :return:
+        :return: The last messages in chronological order with full meta-data
         """
 
         if token_limit and n_messages:
             warnings.warn(f'Token limit ovverrides n_messages.'
                           f' Messages returned will be defined by token limit of {token_limit}')
 
-        token = bool(token_limit)
+        if token_limit:
+            return self.get_messages_window(0, len(self.conversation), token_limit)
 
-        messages = []
+        return self.conversation[-n_messages:] if n_messages > 0 else []
 
-        if token:
+    def get_messages_window(self, start: int, end: int, token_limit: int) -> list[dict]:
 
-            token_count = 0
+        """
+        Latest messages of conversation[start:end] whose total token count stays under token_limit, found by binary
+        search on the cumulative token index: the cost doesn't depend on the length of the conversation.
 
-            for message in reversed(self.conversation):
+        :param start: Index of the first message that can be returned
+        :param end: Index after the last message that can be returned
+        :param token_limit: Budget, the returned messages count strictly less tokens
+        :return: The messages in chronological order with full meta-data
+        """
 
-                token_count += self.get_token(message['content'])
+        self._sync_token_index()
 
-                if token_count >= token_limit:
-                    break
+        end = min(end, len(self.conversation))
 
-                messages.append(message)
+        if token_limit <= 0 or start >= end:
+            return []
 
-        else:
+        # First index i in [start, end] such that tokens of conversation[i:end] < token_limit
+        first = bisect_right(self._token_prefix, self._token_prefix[end] - token_limit, start, end + 1)
 
-            for message in reversed(self.conversation):
-                if len(messages) < n_messages:
-                    messages.append(message)
-                else:
-                    break
+        return self.conversation[first:end]
+
+    def get_memory_view(self, token_limit: int) -> tuple[str, list[dict]]:
+
+        """
+        Bounded view of the whole conversation: the summaries of the folded segments, then the latest messages after
+        them that fit in what's left of token_limit. The summaries take at most half of token_limit, the oldest ones
+        are left out first.
+
+        :return: The summaries (empty if there are none or none fits) and the messages in chronological order
+        """
+
+        summaries, summary_tokens = self.memory.get_summaries(token_limit // 2 - SUMMARY_OVERHEAD)
+
+        if summaries:
+            summary_tokens += SUMMARY_OVERHEAD
+
+        return '\n'.join(summaries), self.get_messages_window(self.memory.folded_until, len(self.conversation),
+                                                             token_limit - summary_tokens)
+
+    def recall(self, query: str, end: int, k: int = 3, token_limit: int = 300) -> list[dict]:
+
+        """
+        Messages before end most relevant to query, at most k of them and token_limit tokens, in chronological order
+        """
+
+        positions = []
+        tokens = 0
+
+        for _, position in self.index.search(self.conversation, query, end=end, k=k):
+            if tokens + self.conversation[position]['tokens'] > token_limit:
+                continue
+
+            positions.append(position)
+            tokens += self.conversation[position]['tokens']
+
+        return [self.conversation[position] for position in sorted(positions)]
+
+    def render_transcript(self, token_limit: int) -> str:
+
+        """
+        Memory view of the conversation as a compact transcript of at most token_limit tokens, see TranscriptRenderer
+        """
+
+        return self.transcript.render(self.conversation, self.memory, token_limit)
+
+    def tokens_between(self, start: int, end: int) -> int:
+
+        """
+        Token count of conversation[start:end]
+        """
+
+        self._sync_token_index()
+
+        end = min(end, len(self.conversation))
 
-        return reversed(messages)  # Return conversation in chronological order with full meta-data
+        return self._token_prefix[end] - self._token_prefix[start] if start < end else 0
 
     def get_token(self, content: str) -> int:
 
-        return len(self.ENCODER.encode(content))
+        return count_tokens(content, model=self.model)
 
     def __len__(self):
         return len(self.conversation)
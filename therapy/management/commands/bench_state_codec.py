@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from therapy.state_codec import encode_state, decode_state
+from therapy.therapist import Therapy, PromptHandler, SERVER_PARAMETERS
+
+
+def build_parameters(n_messages: int) -> dict:
+
+    """
+    Parameters of a therapy in its therapy phase, with n_messages messages of realistic length
+    """
+
+    therapy = Therapy(api_key=SERVER_PARAMETERS['api-key'])
+
+    therapy_type = therapy.therapy_types[0]
+    therapy.therapy_informations = {
+        'type': therapy_type,
+        'guidelines': PromptHandler().get_prompt_content(prompt_type='evidence_based_data', prompt_name=therapy_type),
+    }
+
+    parameters = therapy.collect_parameters()
+
+    user_message = 'I have been feeling anxious at work lately, especially before the weekly meetings with my team. '
+    assistant_message = 'Thank you for sharing this. Could you tell me more about what goes through your mind ' \
+                        'right before those meetings, and how your body feels at that moment? '
+
+    parameters['conversation'] = [{'role': 'user' if i % 2 else 'assistant',
+                                   'content': (user_message if i % 2 else assistant_message) * (1 + i % 3),
+                                   'time': '2023-04-30 18:42:07',
+                                   'tokens': 40 * (1 + i % 3)}
+                                  for i in range(n_messages)]
+
+    return parameters
+
+
+def timeit(function, repeat: int) -> float:
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = 'Compare the size and speed of the state codec with get_parameters / update_parameters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+
+        self.stdout.write(f"{'messages':>8} {'format':<12} {'bytes':>9} {'encode ms':>10} {'decode ms':>10}")
+
+        for n_messages in options['sizes']:
+            parameters = build_parameters(n_messages)
+
+            therapy = Therapy(api_key=SERVER_PARAMETERS['api-key'])
+            therapy.update_parameters(dict(parameters))
+
+            json_state = therapy.get_parameters()
+
+            def json_decode():
+                Therapy(api_key=SERVER_PARAMETERS['api-key']).update_parameters(json_state)
+
+            results = [('json', len(json_state.encode()), timeit(therapy.get_parameters, options['repeat']),
+                        timeit(json_decode, options['repeat']))]
+
+            for name, compress in (('codec', False), ('codec+zlib', True)):
+                encoded = encode_state(parameters, compress=compress)
+
+                results.append((name, len(encoded),
+                                timeit(lambda: encode_state(parameters, compress=compress), options['repeat']),
+                                timeit(lambda: decode_state(encoded), options['repeat'])))
+
+            for name, size, encode_ms, decode_ms in results:
+                self.stdout.write(f'{n_messages:>8} {name:<12} {size:>9} {encode_ms:>10.3f} {decode_ms:>10.3f}')
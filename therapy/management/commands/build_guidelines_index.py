@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from therapy.therapist import GUIDELINE_INDEX
+
+
+class Command(BaseCommand):
+    help = 'Build the retrieval index of evidence_based_data and measure its query latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--query', default='I feel anxious before meetings and avoid talking to my colleagues')
+        parser.add_argument('--repeat', type=int, default=1000)
+
+    def handle(self, *args, **options):
+
+        start = time.perf_counter()
+        n_passages = GUIDELINE_INDEX.build()
+        self.stdout.write(f'{n_passages} passages indexed in {(time.perf_counter() - start) * 1000:.1f} ms '
+                          f'({GUIDELINE_INDEX.index_dir})')
+
+        GUIDELINE_INDEX.load()
+
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            GUIDELINE_INDEX.search(options['query'])
+        self.stdout.write(f"query: {(time.perf_counter() - start) / options['repeat'] * 1000:.3f} ms")
+
+        for score, passage in GUIDELINE_INDEX.search(options['query']):
+            self.stdout.write(f'{score:.3f} [{passage.source}] {passage.text[:100]}')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from therapy.circuit_breaker import CIRCUIT_BREAKER
+from therapy.rate_limiter import RATE_LIMITER
+from therapy.therapist import SERVER_PARAMETERS
+
+
+class Command(BaseCommand):
+    help = 'Show the circuit breaker of each model, with the error and slow rates of its window across the fleet'
+
+    def handle(self, *args, **options):
+
+        models = dict.fromkeys([SERVER_PARAMETERS.get('therapist', {}).get('model', 'gpt-4'), *RATE_LIMITER.limits])
+
+        self.stdout.write(f"{'model':<16} {'state':<10} {'opened':>7} {'calls':>7} {'errors':>7} {'slow':>7}")
+
+        for model in models:
+            status = CIRCUIT_BREAKER.status(model)
+
+            self.stdout.write(f"{model:<16} {status['state']:<10} {status['opened']:>7} {status['calls']:>7} "
+                              f"{status['error_rate']:>7.1%} {status['slow_rate']:>7.1%}")
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from therapy.router import read_decisions
+from therapy.therapist import ROUTER, ROUTER_PARAMETERS
+
+
+class Command(BaseCommand):
+    help = 'Report the agreement of the routing models with the logged LLM decisions, and their latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=ROUTER_PARAMETERS.get('log-path'))
+        parser.add_argument('--threshold', type=float, default=ROUTER.threshold)
+
+    def handle(self, *args, **options):
+
+        if not options['log']:
+            raise CommandError('No decision log, set router.log-path in parameters.yaml or use --log.')
+
+        for question, decisions in read_decisions(options['log']).items():
+            model = ROUTER.get_model(question)
+
+            if model is None:
+                self.stdout.write(f'{question}: no model at {ROUTER.model_path(question)}')
+                continue
+
+            start = time.perf_counter()
+            predictions = [model.predict(text) for text, _ in decisions]
+            latency = (time.perf_counter() - start) / len(decisions) * 1e6
+
+            self.stdout.write(f'{question}: {len(decisions)} decisions, {latency:.0f} us per decision')
+            self.stdout.write(f"{'threshold':>10} {'local':>8} {'agreement':>10}")
+
+            for threshold in sorted({0.5, 0.7, 0.8, 0.9, 0.95, options['threshold']}):
+                local = [(predicted, label) for (predicted, probability), (_, label) in zip(predictions, decisions)
+                         if probability >= threshold]
+                agreement = sum(predicted == label for predicted, label in local) / max(1, len(local))
+
+                self.stdout.write(f'{threshold:>10.2f} {len(local) / len(decisions):>8.1%} {agreement:>10.1%}')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from therapy.gpt_utils import GPT, APIQueryError, PRIORITY_BACKGROUND
+from therapy.therapist import PromptHandler, PARAPHRASE_POOL, POOLED_PROMPTS, OPERATOR_API_KEY
+
+
+class Command(BaseCommand):
+    help = 'Generate the paraphrase pools of the prebuilt prompts, ahead of the first sessions'
+
+    def handle(self, *args, **options):
+
+        if OPERATOR_API_KEY is None:
+            raise CommandError('Set api-key in parameters.yaml to fill the pools ahead of the sessions, otherwise '
+                               'they are filled with the keys of the sessions as they are used.')
+
+        prompter = PromptHandler()
+        gpt = GPT(api_key=OPERATOR_API_KEY)
+
+        for prompt_type, prompt_name in POOLED_PROMPTS:
+            try:
+                added = PARAPHRASE_POOL.fill(prompt_type, prompt_name,
+                                             prompter.get_prompt_content(prompt_type=prompt_type,
+                                                                         prompt_name=prompt_name),
+                                             query=lambda prompt: gpt.query_API([{'role': 'user', 'content': prompt}],
+                                                                                key_to_protect='Please',
+                                                                                rate_priority=PRIORITY_BACKGROUND))
+            except APIQueryError as e:
+                self.stderr.write(f'{prompt_type}/{prompt_name}: {e}')
+                continue
+
+            self.stdout.write(f'{prompt_type}/{prompt_name}: {added} variants added')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from therapy.rate_limiter import RATE_LIMITER
+
+
+class Command(BaseCommand):
+    help = 'Show the requests and queueing delay of the API calls of the whole fleet, per model and priority'
+
+    def handle(self, *args, **options):
+
+        self.stdout.write(f"{'model':<16} {'priority':<12} {'requests':>9} {'delayed':>8} {'timeouts':>8} "
+                          f"{'mean wait s':>12}")
+
+        for model, priorities in RATE_LIMITER.fleet_stats().items():
+            for priority, stats in priorities.items():
+                delayed = stats['delayed'] / stats['requests'] if stats['requests'] else 0.0
+
+                self.stdout.write(f"{model:<16} {priority:<12} {stats['requests']:>9} {delayed:>8.1%} "
+                                  f"{stats['timeouts']:>8} {stats['mean_wait']:>12.3f}")
@@ -0,0 +1,50 @@
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from therapy.router import LinearRouter, read_decisions
+from therapy.therapist import ROUTER, ROUTER_PARAMETERS
+
+
+class Command(BaseCommand):
+    help = 'Train the routing models on the logged LLM decisions, and report their agreement on held-out decisions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=ROUTER_PARAMETERS.get('log-path'))
+        parser.add_argument('--holdout', type=float, default=0.2, help='Fraction of the decisions kept for evaluation')
+        parser.add_argument('--epochs', type=int, default=300)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        if not options['log']:
+            raise CommandError('No decision log, set router.log-path in parameters.yaml or use --log.')
+
+        for question, decisions in read_decisions(options['log']).items():
+            random.Random(options['seed']).shuffle(decisions)
+
+            n_holdout = int(len(decisions) * options['holdout'])
+            train, holdout = decisions[n_holdout:], decisions[:n_holdout]
+
+            if len({label for _, label in train}) < 2:
+                self.stdout.write(f'{question}: skipped, the training decisions have less than 2 labels')
+                continue
+
+            model = LinearRouter.fit([text for text, _ in train], [label for _, label in train],
+                                     epochs=options['epochs'])
+
+            if holdout:
+                predictions = [model.predict(text) for text, _ in holdout]
+                confident = [(predicted, label) for (predicted, probability), (_, label) in zip(predictions, holdout)
+                             if probability >= ROUTER.threshold]
+
+                agreement = sum(predicted == label for (predicted, _), (_, label) in zip(predictions, holdout))
+                confident_agreement = sum(predicted == label for predicted, label in confident)
+
+                self.stdout.write(f'{question}: {len(train)} trained, {len(holdout)} held out, '
+                                  f'agreement {agreement / len(holdout):.1%}, '
+                                  f'decided locally {len(confident) / len(holdout):.1%} '
+                                  f'with agreement {confident_agreement / max(1, len(confident)):.1%}')
+
+            model.save(ROUTER.model_path(question))
+            self.stdout.write(f'{question}: saved to {ROUTER.model_path(question)}')
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="TherapyState",
+            fields=[
+                ("session_id", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("version", models.PositiveIntegerField(default=1)),
+                ("parameters", models.TextField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def copy_parameters(apps, schema_editor):
+
+    # The JSON parameters are kept as they are: state_codec.decode_state still reads them
+    TherapyState = apps.get_model('therapy', 'TherapyState')
+
+    for therapy_state in TherapyState.objects.all():
+        therapy_state.state = therapy_state.parameters.encode()
+        therapy_state.save(update_fields=['state'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("therapy", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="therapystate",
+            name="state",
+            field=models.BinaryField(default=b""),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_parameters, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="therapystate",
+            name="parameters",
+        ),
+    ]
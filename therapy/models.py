@@ -1,3 +1,13 @@
 from django.db import models
 
-# Create your models here.
+
+class TherapyState(models.Model):
+
+    """
+    Parameters of a therapy session, for the database state store (see therapy.state_store)
+    """
+
+    session_id = models.CharField(max_length=64, primary_key=True)
+    version = models.PositiveIntegerField(default=1)
+    state = models.BinaryField()  # See therapy.state_codec
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import random
+import re
+import time
+import warnings
+from typing import Callable
+
+POOL_KEY = 'therapy:paraphrase:{prompt_type}:{prompt_name}:{digest}'
+REFILL_LOCK = 'therapy:paraphrase:{prompt_type}:{prompt_name}:refill'
+REFILL_LOCK_TTL = 300  # seconds
+
+NAME_TAG = '### CLIENT NAME ###'
+NAME_TAG_PATTERN = re.compile(r',?\s*' + NAME_TAG + r',?')
+
+GENERATION_PROMPT = 'Please write {size} different paraphrases of the following message from a digital ' \
+                    'psychotherapist to its client:\n' \
+                    'CONTENT:\n{content}\n' \
+                    'Where it is natural, address the client by writing exactly "' + NAME_TAG + '" once in place ' \
+                    'of their name, never more than once.\n' \
+                    'Only answer with a JSON list of {size} strings and absolutely nothing else.'
+
+
+def get_default_redis():
+
+    from .redis_utils import get_redis
+
+    return get_redis()
+
+
+def personalize(variant: str, name: str = None) -> str:
+
+    """
+    Fill the client name placeholder of a variant, or remove it with its punctuation when the name isn't known
+    """
+
+    if NAME_TAG not in variant:
+        return variant
+
+    if name:
+        return variant.replace(NAME_TAG, name)
+
+    cleaned = NAME_TAG_PATTERN.sub('', variant, count=1).strip()
+
+    return cleaned[:1].upper() + cleaned[1:]
+
+
+class ParaphrasePool:
+
+    """
+    Pre-generated paraphrases of the prebuilt and assistant prompts, so the turns that only need a rewording of a
+    fixed prompt don't wait on the API.
+
+    Each prompt has a Redis sorted set of variants scored by creation time, keyed by a digest of the prompt content:
+    editing a prompt file starts a new, empty pool. Variants older than max_age are dropped, and the pool is refilled
+    in the background when it holds less than low_water variants.
+
+    The sessions bring their own API key: a refill is generated with the operator key if there is one, otherwise with
+    the key of the session that found the pool low. Without either, the pool isn't refilled.
+
+    :param operator_refills: True if an operator key can refill the pools for the lookups without a session
+    """
+
+    def __init__(self,
+                 size: int = 8,
+                 low_water: int = 4,
+                 max_age: int = 86400,
+                 operator_refills: bool = False,
+                 redis_factory: Callable = get_default_redis):
+
+        self.size = size
+        self.low_water = low_water
+        self.max_age = max_age
+        self.operator_refills = operator_refills
+        self.redis_factory = redis_factory
+
+        self.stats = {'hits': 0, 'misses': 0, 'refills': 0}
+
+    @staticmethod
+    def pool_key(prompt_type: str, prompt_name: str, content: str) -> str:
+
+        digest = hashlib.sha256(content.encode()).hexdigest()[:16]
+
+        return POOL_KEY.format(prompt_type=prompt_type, prompt_name=prompt_name, digest=digest)
+
+    def _redis(self):
+
+        try:
+            return self.redis_factory()
+        except Exception as e:
+            warnings.warn(f'Paraphrase pool unavailable: {e}')
+            return None
+
+    def get_variant(self, prompt_type: str, prompt_name: str, content: str, name: str = None,
+                    session_id: str = None) -> str or None:
+
+        """
+        Pick a variant of a prompt without calling the API
+        :param prompt_type: Sub-directory of prompts/ of the prompt
+        :param prompt_name: Name of the prompt
+        :param content: Current content of the prompt
+        :param name: Name of the client to personalize the variant with, if known
+        :param session_id: Session in the state store whose API key can refill the pool
+        :return: The variant, or None if the pool is empty: the caller has to paraphrase by itself
+        """
+
+        redis_client = self._redis()
+
+        if redis_client is None:
+            self.stats['misses'] += 1
+            return None
+
+        key = self.pool_key(prompt_type, prompt_name, content)
+
+        try:
+            pipe = redis_client.pipeline()
+            pipe.zremrangebyscore(key, '-inf', time.time() - self.max_age)
+            pipe.zrange(key, 0, -1)
+            variants = pipe.execute()[1]
+
+        except Exception as e:
+            warnings.warn(f'Paraphrase pool lookup failed: {e}')
+            self.stats['misses'] += 1
+            return None
+
+        if len(variants) < self.low_water and (session_id is not None or self.operator_refills):
+            self.request_refill(prompt_type, prompt_name, session_id)
+
+        if not variants:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+
+        return personalize(random.choice(variants).decode(), name=name)
+
+    def request_refill(self, prompt_type: str, prompt_name: str, session_id: str = None) -> None:
+
+        """
+        Queue a background refill of a pool, at most one per REFILL_LOCK_TTL. Only the session id travels through the
+        broker, the task reads its key from the state store.
+        """
+
+        redis_client = self._redis()
+
+        lock_key = REFILL_LOCK.format(prompt_type=prompt_type, prompt_name=prompt_name)
+
+        try:
+            if not redis_client.set(lock_key, 1, nx=True, ex=REFILL_LOCK_TTL):
+                return
+        except Exception as e:
+            warnings.warn(f'Paraphrase pool refill not queued: {e}')
+            return
+
+        from .tasks import refill_paraphrase_pool
+
+        refill_paraphrase_pool.delay(prompt_type, prompt_name, session_id)
+
+    @staticmethod
+    def parse_variants(answer: str) -> list[str]:
+
+        try:
+            variants = json.loads(answer)
+        except (TypeError, ValueError):
+            return []
+
+        if not isinstance(variants, list):
+            return []
+
+        return [variant.strip() for variant in variants
+                if isinstance(variant, str) and variant.strip() and variant.count(NAME_TAG) <= 1]
+
+    def fill(self, prompt_type: str, prompt_name: str, content: str, query: Callable[[str], str]) -> int:
+
+        """
+        Generate variants of a prompt until the pool is full
+        :param prompt_type: Sub-directory of prompts/ of the prompt
+        :param prompt_name: Name of the prompt
+        :param content: Current content of the prompt
+        :param query: Sends a prompt to the API and returns the content of the answer
+        :return: The number of variants added
+        """
+
+        redis_client = self.redis_factory()
+
+        key = self.pool_key(prompt_type, prompt_name, content)
+
+        try:
+            redis_client.zremrangebyscore(key, '-inf', time.time() - self.max_age)
+            missing = self.size - redis_client.zcard(key)
+
+            if missing <= 0:
+                return 0
+
+            variants = self.parse_variants(query(GENERATION_PROMPT.format(size=missing, content=content)))[:missing]
+
+            if variants:
+                now = time.time()
+                redis_client.zadd(key, {variant: now for variant in variants})
+                redis_client.expire(key, self.max_age)
+
+            self.stats['refills'] += 1
+
+            return len(variants)
+
+        finally:
+            redis_client.delete(REFILL_LOCK.format(prompt_type=prompt_type, prompt_name=prompt_name))
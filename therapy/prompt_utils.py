@@ -0,0 +1,214 @@
+import os
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+
+TEMPLATE_TAG = re.compile(r'### ([A-Z][A-Z_ ]*[A-Z]) ###')
+
+
+class PromptTemplate:
+
+    """
+    A prompt parsed once into static segments and `### TAG ###` slots.
+
+    Rendering is a single join over the segments instead of one str.replace per tag over the whole prompt. The token
+    count of the static segments is computed once, so a render only has to encode the substituted values.
+    Note that BPE merges across segment boundaries are ignored: counts are a close upper estimate, not exact.
+    """
+
+    def __init__(self, content: str, token_counter: Optional[Callable[[str], int]] = None):
+        self.content = content
+        self.token_counter = token_counter
+
+        self.segments: list[str] = []  # static text, len(segments) == len(slots) + 1
+        self.slots: list[str] = []  # tag names, in order of appearance
+
+        position = 0
+        for match in TEMPLATE_TAG.finditer(content):
+            self.segments.append(content[position:match.start()])
+            self.slots.append(match.group(1))
+            position = match.end()
+
+        self.segments.append(content[position:])
+
+        self._static_tokens = None
+
+    @property
+    def static_tokens(self) -> int:
+
+        if self._static_tokens is None:
+            self._static_tokens = sum(self.token_counter(segment) for segment in self.segments if segment)
+
+        return self._static_tokens
+
+    def render(self, values: dict[str, str] = None) -> str:
+
+        """
+        Substitute the slots in one pass. Slots without a value are left as is.
+        :param values: Tag name (without the ### markers) to replacement
+        :return: The rendered prompt
+        """
+
+        if not self.slots:
+            return self.content
+
+        values = values or {}
+
+        parts = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            parts.append(values[slot] if slot in values else f'### {slot} ###')
+            parts.append(segment)
+
+        return ''.join(parts)
+
+    def count_tokens(self, values: dict[str, str] = None) -> int:
+
+        """
+        Token count of the rendered prompt, only encoding the substituted values
+        """
+
+        values = values or {}
+
+        return self.static_tokens + sum(
+            self.token_counter(values[slot] if slot in values else f'### {slot} ###')
+            for slot in self.slots
+        )
+
+    def render_with_tokens(self, values: dict[str, str] = None) -> tuple[str, int]:
+        return self.render(values), self.count_tokens(values)
+
+
+class PromptCache:
+
+    """
+    Process-wide, read-mostly cache of the prompts/ tree.
+
+    Every prompt file is read once per worker and then served from memory. The directories are re-scanned at most
+    once every `check_interval` seconds and a file is only read again when its mtime changed, so a turn served from a
+    warm cache does no prompt-file I/O at all.
+    """
+
+    def __init__(self, root: str, check_interval: float = 2.0, token_counter: Callable[[str], int] = None):
+        self.root = root
+        self.check_interval = check_interval
+        self.token_counter = token_counter
+
+        self._lock = threading.Lock()
+        # (prompt_type, prompt_name) -> {'mtime', 'content', 'template'}
+        self._entries: dict[tuple[str, str], dict] = {}
+        self._listing: dict[str, list[str]] = {}  # prompt_type -> prompt names
+        self._last_check = 0.0
+
+        self.stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+
+    def _scan(self) -> None:
+
+        """
+        Re-list the prompt directories and re-read the files whose mtime changed. Must be called with the lock held.
+        """
+
+        listing = {}
+        entries = {}
+
+        for prompt_type in sorted(os.listdir(self.root)):
+            type_path = os.path.join(self.root, prompt_type)
+
+            if not os.path.isdir(type_path):
+                continue
+
+            names = []
+            for prompt_name in sorted(os.listdir(type_path)):
+                path = os.path.join(type_path, prompt_name)
+
+                if prompt_name.startswith('.') or not os.path.isfile(path):
+                    continue
+
+                names.append(prompt_name)
+
+                mtime = os.stat(path).st_mtime_ns
+                entry = self._entries.get((prompt_type, prompt_name))
+
+                if entry is None or entry['mtime'] != mtime:
+                    with open(path, 'r') as f:
+                        entry = {'mtime': mtime, 'content': f.read(), 'template': None}
+
+                    self.stats['misses'] += 1
+                    if (prompt_type, prompt_name) in self._entries:
+                        self.stats['reloads'] += 1
+
+                entries[(prompt_type, prompt_name)] = entry
+
+            listing[prompt_type] = names
+
+        self._entries = entries
+        self._listing = listing
+        self._last_check = time.monotonic()
+
+    def _refresh(self) -> None:
+
+        if time.monotonic() - self._last_check < self.check_interval and self._entries:
+            return
+
+        with self._lock:
+            if time.monotonic() - self._last_check >= self.check_interval or not self._entries:
+                self._scan()
+
+    def reload(self) -> None:
+
+        """
+        Force a re-scan of the prompts/ tree, regardless of `check_interval`.
+        """
+
+        with self._lock:
+            self._scan()
+
+    def list_prompts(self, prompt_type: str) -> list[str]:
+
+        self._refresh()
+
+        if prompt_type not in self._listing:
+            raise ValueError(f'Prompt type {prompt_type} does not exist.')
+
+        return list(self._listing[prompt_type])
+
+    def _get_entry(self, prompt_type: str, prompt_name: str) -> dict:
+
+        self._refresh()
+
+        entry = self._entries.get((prompt_type, prompt_name))
+
+        if entry is None:
+            raise FileNotFoundError(f'Prompt {prompt_type}/{prompt_name} does not exist.')
+
+        self.stats['hits'] += 1
+
+        return entry
+
+    def get(self, prompt_type: str, prompt_name: str) -> str:
+
+        """
+        Get the content of a prompt from memory
+        :param prompt_type: Name of the sub-directory of prompts/ (assistant, system, prebuilts, evidence_based_data)
+        :param prompt_name: Name of the prompt file
+        :return: The content of the prompt
+        """
+
+        return self._get_entry(prompt_type, prompt_name)['content']
+
+    def get_template(self, prompt_type: str, prompt_name: str) -> PromptTemplate:
+
+        """
+        Get the compiled template of a prompt. Templates are compiled once and dropped with their entry on reload.
+        """
+
+        entry = self._get_entry(prompt_type, prompt_name)
+
+        if entry['template'] is None:
+            entry['template'] = PromptTemplate(entry['content'], token_counter=self.token_counter)
+
+        return entry['template']
+
+    def reset_stats(self) -> None:
+        self.stats = {'hits': 0, 'misses': 0, 'reloads': 0}
@@ -0,0 +1,304 @@
+import hashlib
+import random
+import threading
+import time
+import warnings
+from typing import Callable, NamedTuple
+
+import yaml
+
+RATE_LIMIT_PREFIX = 'therapy:rate-limit:'
+BUCKET_TTL = 120  # seconds, an idle bucket is full again long before
+
+PRIORITY_INTERACTIVE = 0  # The reply the client is waiting for
+PRIORITY_SIDE = 1  # Analyses of a turn the reply depends on
+PRIORITY_BACKGROUND = 2  # Anamnesis, summaries, paraphrases
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_SIDE: 'side', PRIORITY_BACKGROUND: 'background'}
+
+RATE_LIMIT_STATS = {name: {'requests': 0, 'delayed': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                           'timeouts': 0}
+                    for name in PRIORITY_NAMES.values()}
+RATE_LIMIT_STATS_LOCK = threading.Lock()
+
+
+class Admission(NamedTuple):
+    admitted: bool  # False if the request waited its max wait and is sent anyway
+    tokens: int  # Tokens taken from the bucket, what adjust corrects
+    waited: float  # Seconds
+
+# Token buckets of the requests and of the tokens per minute, refilled continuously. A priority can't take the
+# buckets under its reserve, the share of the capacity kept for the higher priorities. A request sent after its max
+# wait is forced through: its cost is taken all the same, the buckets go negative and refill from there.
+#   KEYS: bucket, fleet-wide statistics
+#   ARGV: request capacity, token capacity, tokens of the request, reserve, ttl (ms), priority name, waited (ms),
+#         forced (0/1)
+#   Returns {0 if the request is admitted, otherwise the milliseconds to wait before trying again, tokens taken}
+TOKEN_BUCKET_SCRIPT = """
+local request_capacity = tonumber(ARGV[1])
+local token_capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[4])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+
+local requests = (tonumber(state[1]) or request_capacity) + elapsed * request_capacity / 60000
+local tokens = (tonumber(state[2]) or token_capacity) + elapsed * token_capacity / 60000
+requests = math.min(request_capacity, requests)
+tokens = math.min(token_capacity, tokens)
+
+-- A request larger than what the priority can take is admitted once the bucket is full
+local cost = math.floor(math.min(tonumber(ARGV[3]), token_capacity * (1 - reserve)))
+
+local wait = 0
+if requests - 1 < request_capacity * reserve then
+    wait = math.max(wait, (request_capacity * reserve + 1 - requests) * 60000 / request_capacity)
+end
+if tokens - cost < token_capacity * reserve then
+    wait = math.max(wait, (token_capacity * reserve + cost - tokens) * 60000 / token_capacity)
+end
+
+local taken = 0
+if wait == 0 or tonumber(ARGV[8]) == 1 then
+    requests = requests - 1
+    tokens = tokens - cost
+    taken = cost
+end
+
+-- The forced requests are counted by record_timeout
+if wait == 0 then
+    redis.call('HINCRBY', KEYS[2], ARGV[6] .. ':requests', 1)
+    if tonumber(ARGV[7]) > 0 then
+        redis.call('HINCRBY', KEYS[2], ARGV[6] .. ':delayed', 1)
+        redis.call('HINCRBY', KEYS[2], ARGV[6] .. ':wait_ms', ARGV[7])
+    end
+end
+
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+
+return {math.ceil(wait), taken}
+"""
+
+# Applies the correction of adjust, unless the bucket expired in the meantime (it's full again)
+ADJUST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', ARGV[1])
+end
+return 0
+"""
+
+
+def get_default_redis():
+
+    from .redis_utils import get_redis
+
+    return get_redis()
+
+
+class RateLimiter:
+
+    """
+    Cluster-wide limiter of the API calls: a token bucket of requests and one of tokens per minute, per API key and
+    model, kept in Redis and updated atomically by a Lua script, so every worker sharing a key draws from the same
+    buckets.
+
+    A request is admitted by its estimated tokens (prompt and max_tokens), corrected with the usage of the response
+    once it's known. Lower priorities can't use the share of the buckets reserved for the higher ones: under load the
+    background calls wait first and the replies the clients wait for go through. A request waits at most the max
+    wait of its priority, then is sent anyway and its cost is taken all the same, even if the buckets go negative.
+
+    The waiting time is counted per priority in RATE_LIMIT_STATS and, for the whole fleet, in Redis (see the
+    rate_limit_stats command). Without Redis the calls aren't limited.
+
+    :param limits: Model -> {'rpm': requests per minute, 'tpm': tokens per minute}, models without limits aren't
+     limited
+    :param reserves: Priority -> share of the capacity it can't use
+    :param max_wait: Priority -> seconds a request waits at most
+    """
+
+    def __init__(self,
+                 limits: dict[str, dict],
+                 reserves: dict[int, float] = None,
+                 max_wait: dict[int, float] = None,
+                 redis_factory: Callable = get_default_redis):
+
+        self.limits = limits
+        self.reserves = reserves or {PRIORITY_INTERACTIVE: 0.0, PRIORITY_SIDE: 0.1, PRIORITY_BACKGROUND: 0.3}
+        self.max_wait = max_wait or {PRIORITY_INTERACTIVE: 10, PRIORITY_SIDE: 20, PRIORITY_BACKGROUND: 60}
+        self.redis_factory = redis_factory
+
+        self._scripts = None
+
+    def _redis(self):
+
+        try:
+            return self.redis_factory() if self.redis_factory else None
+        except Exception as e:
+            warnings.warn(f'API calls not rate limited, Redis unavailable: {e}')
+            self.redis_factory = None
+            return None
+
+    @staticmethod
+    def bucket_key(api_key: str, model: str) -> str:
+
+        # The key itself is never stored
+        return f'{RATE_LIMIT_PREFIX}{hashlib.sha256(api_key.encode()).hexdigest()[:16]}:{model}'
+
+    @staticmethod
+    def stats_key(model: str) -> str:
+        return f'{RATE_LIMIT_PREFIX}stats:{model}'
+
+    @staticmethod
+    def record(priority: int, waited: float, timeout: bool) -> None:
+
+        with RATE_LIMIT_STATS_LOCK:
+            stats = RATE_LIMIT_STATS[PRIORITY_NAMES[priority]]
+
+            stats['requests'] += 1
+            stats['timeouts'] += timeout
+
+            if waited:
+                stats['delayed'] += 1
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+
+    def record_timeout(self, redis, model: str, priority: int, waited: float) -> None:
+
+        """
+        Count in the fleet-wide statistics a request sent without being admitted (the script counts the others)
+        """
+
+        name = PRIORITY_NAMES[priority]
+
+        try:
+            with redis.pipeline() as pipeline:
+                for counter, value in (('requests', 1), ('delayed', 1), ('timeouts', 1),
+                                       ('wait_ms', int(waited * 1000))):
+                    pipeline.hincrby(self.stats_key(model), f'{name}:{counter}', value)
+                pipeline.execute()
+        except Exception as e:
+            warnings.warn(f'Rate limiter unavailable: {e}')
+
+    def acquire(self, api_key: str, model: str, tokens: int, priority: int = PRIORITY_SIDE) -> Admission:
+
+        """
+        Wait until the request can be sent, and take its cost from the buckets
+
+        :param tokens: Estimated tokens of the request, prompt and answer
+        :return: Whether the request was admitted before its max wait, the tokens taken and the seconds waited
+        """
+
+        limits = self.limits.get(model)
+
+        if not limits or (redis := self._redis()) is None:
+            return Admission(True, 0, 0.0)
+
+        if self._scripts is None:
+            self._scripts = redis.register_script(TOKEN_BUCKET_SCRIPT), redis.register_script(ADJUST_SCRIPT)
+
+        start = time.monotonic()
+        deadline = start + self.max_wait.get(priority, 0)
+        waited = 0.0
+
+        def take(forced: bool) -> tuple[int, int]:
+            try:
+                wait_ms, taken = self._scripts[0](keys=[self.bucket_key(api_key, model), self.stats_key(model)],
+                                                  args=[limits['rpm'], limits['tpm'], tokens,
+                                                        self.reserves.get(priority, 0), BUCKET_TTL * 1000,
+                                                        PRIORITY_NAMES[priority], int(waited * 1000), int(forced)])
+            except Exception as e:
+                warnings.warn(f'Rate limiter unavailable: {e}')
+                return 0, 0
+
+            return wait_ms, taken
+
+        while True:
+            wait_ms, taken = take(forced=False)
+
+            if not wait_ms:
+                self.record(priority, waited, timeout=False)
+                return Admission(True, taken, waited)
+
+            # Jitter, so the waiting workers don't all try again at once
+            sleep = wait_ms / 1000 * random.uniform(1.0, 1.2)
+
+            if time.monotonic() + sleep > deadline:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+
+                waited = time.monotonic() - start
+                _, taken = take(forced=True)
+
+                self.record(priority, waited, timeout=True)
+                self.record_timeout(redis, model, priority, waited)
+                return Admission(False, taken, waited)
+
+            time.sleep(sleep)
+            waited = time.monotonic() - start
+
+    def adjust(self, api_key: str, model: str, taken_tokens: int, used_tokens: int) -> None:
+
+        """
+        Give back to the token bucket what the request didn't use of the tokens acquire took (or take what it used
+        above)
+        """
+
+        if not self.limits.get(model) or used_tokens == taken_tokens or (redis := self._redis()) is None:
+            return
+
+        if self._scripts is None:
+            self._scripts = redis.register_script(TOKEN_BUCKET_SCRIPT), redis.register_script(ADJUST_SCRIPT)
+
+        try:
+            self._scripts[1](keys=[self.bucket_key(api_key, model)], args=[taken_tokens - used_tokens])
+        except Exception as e:
+            warnings.warn(f'Rate limiter unavailable: {e}')
+
+    def fleet_stats(self) -> dict[str, dict[str, dict]]:
+
+        """
+        :return: Model -> priority -> requests, delayed requests, requests sent after their max wait and mean wait
+         (seconds) of the whole fleet
+        """
+
+        redis = self._redis()
+
+        if redis is None:
+            return {}
+
+        stats = {}
+
+        for model in self.limits:
+            counters = {key.decode(): int(value) for key, value in redis.hgetall(self.stats_key(model)).items()}
+
+            stats[model] = {}
+            for name in PRIORITY_NAMES.values():
+                requests = counters.get(f'{name}:requests', 0)
+                delayed = counters.get(f'{name}:delayed', 0)
+
+                stats[model][name] = {'requests': requests,
+                                      'delayed': delayed,
+                                      'timeouts': counters.get(f'{name}:timeouts', 0),
+                                      'mean_wait': counters.get(f'{name}:wait_ms', 0) / 1000 / requests
+                                      if requests else 0.0}
+
+        return stats
+
+
+def load_rate_limiter(path: str = 'parameters.yaml') -> RateLimiter:
+
+    parameters = (yaml.safe_load(open(path, 'r')) or {}).get('rate-limits', {})
+
+    priorities = {name: priority for priority, name in PRIORITY_NAMES.items()}
+
+    return RateLimiter(limits=parameters.get('models', {}) if parameters.get('enabled', True) else {},
+                       reserves={priorities[name]: share for name, share in parameters.get('reserves', {}).items()}
+                       or None,
+                       max_wait={priorities[name]: seconds for name, seconds in parameters.get('max-wait', {}).items()}
+                       or None)
+
+
+RATE_LIMITER = load_rate_limiter()
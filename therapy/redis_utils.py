@@ -0,0 +1,30 @@
+import threading
+
+import redis
+from django.conf import settings
+
+REDIS_CLIENT = None  # Process-wide client, its connection pool is shared by every thread
+REDIS_CLIENT_LOCK = threading.Lock()
+
+
+def get_redis() -> redis.Redis:
+
+    global REDIS_CLIENT
+
+    if REDIS_CLIENT is None:
+        with REDIS_CLIENT_LOCK:
+            if REDIS_CLIENT is None:
+                REDIS_CLIENT = redis.Redis.from_url(settings.REDIS_URL)
+
+    return REDIS_CLIENT
+
+
+def get_async_redis():
+
+    """
+    New asyncio client, to be closed by the caller: asyncio connections can't be shared between event loops
+    """
+
+    import redis.asyncio
+
+    return redis.asyncio.Redis.from_url(settings.REDIS_URL)
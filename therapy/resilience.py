@@ -0,0 +1,370 @@
+import asyncio
+import random
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Awaitable, Optional, TypeVar
+
+import openai
+import yaml
+
+T = TypeVar('T')
+
+MIN_ATTEMPT_SECONDS = 1.0  # No attempt is started with less time left before the deadline
+MIN_LATENCY_SAMPLES = 20  # Before that, the latency quantile isn't known and no call is hedged
+
+# Errors of the API a new attempt may not get, the others (invalid request, authentication, ...) would fail again
+RETRYABLE_ERRORS = (openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+                    openai.error.TryAgain)
+
+API_CALL_STATS = {'calls': 0, 'retries': 0, 'failures': 0, 'hedgeable': 0, 'hedged': 0, 'hedge_wins': 0}
+API_CALL_STATS_LOCK = threading.Lock()
+
+HEDGE_EXECUTOR = None  # Process-wide pool, created on first use (after the Celery worker forked)
+HEDGE_EXECUTOR_LOCK = threading.Lock()
+
+
+class APIQueryError(Exception):
+    pass
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+
+    global HEDGE_EXECUTOR
+
+    if HEDGE_EXECUTOR is None:
+        with HEDGE_EXECUTOR_LOCK:
+            if HEDGE_EXECUTOR is None:
+                HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedged-call')
+
+    return HEDGE_EXECUTOR
+
+
+def is_retryable(error: Exception) -> bool:
+
+    if isinstance(error, openai.error.RateLimitError):
+        # An exhausted quota isn't refilled by waiting a few seconds
+        return getattr(error, 'code', None) != 'insufficient_quota'
+
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, 'http_status', None)
+        return status is None or status >= 500 or status == 409
+
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def retry_after(error: Exception) -> float:
+
+    """
+    :return: The seconds the API asked to wait before trying again (Retry-After header), 0 if it didn't
+    """
+
+    try:
+        return float((getattr(error, 'headers', None) or {}).get('retry-after', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def record(**counters: int) -> None:
+
+    with API_CALL_STATS_LOCK:
+        for counter, value in counters.items():
+            API_CALL_STATS[counter] += value
+
+
+class LatencyTracker:
+
+    """
+    Latencies of the last calls of each key (model), to tell when a call is slower than usual
+
+    :param window: Number of calls kept per key
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+
+        self._latencies: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float) -> None:
+
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def quantile(self, key: str, q: float) -> Optional[float]:
+
+        """
+        :return: The q quantile of the latencies of the key, None while there are too few of them
+        """
+
+        with self._lock:
+            latencies = sorted(self._latencies.get(key, ()))
+
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class APICaller:
+
+    """
+    Deadlines, retries and hedging of the API calls.
+
+    Each attempt has a timeout, longer for the answers of more tokens, and all the attempts of a call share a
+    deadline, so a slow or failing upstream never holds a worker longer than that. The errors a new attempt may not
+    get (timeouts, connection errors, rate limits, 5xx) are retried with an exponential backoff and full jitter, at
+    least what the API asked for in Retry-After; the others fail at once. A call that failed is raised as an
+    APIQueryError.
+
+    Hedging is for the idempotent calls answered in a few tokens (classifications): when one is slower than the
+    hedge quantile of the latencies of its model, the same request is sent again and the first answer is used. The
+    delay starts once the request is admitted by the rate limiter (see mark_admitted): a call waiting for capacity is
+    never duplicated. The slowest calls only are duplicated, at most hedge_max_ratio of them, so the tail latency
+    drops for a few percent more tokens. The senders record the latencies of their API requests in latencies, after
+    the wait of the rate limiter (see GPT.query_API).
+
+    :param request_timeout: Seconds of an attempt, before the first chunk for a streamed answer
+    :param timeout_per_token: Seconds added to the timeout per token of the answer, for the calls not streamed
+    :param deadline: Seconds of all the attempts of a call
+    :param max_retries: Attempts after the first one
+    :param backoff_base: Seconds before the first retry, doubled at each retry
+    :param backoff_max: Maximum seconds between two attempts
+    :param hedging: False never duplicates a call
+    :param hedge_quantile: Quantile of the latencies after which a hedged call is duplicated
+    :param hedge_min_delay: Minimum seconds before a hedged call is duplicated
+    :param hedge_max_ratio: Maximum share of the hedged calls duplicated
+    """
+
+    def __init__(self,
+                 request_timeout: float = 20.0,
+                 timeout_per_token: float = 0.05,
+                 deadline: float = 120.0,
+                 max_retries: int = 3,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 8.0,
+                 hedging: bool = True,
+                 hedge_quantile: float = 0.95,
+                 hedge_min_delay: float = 1.0,
+                 hedge_max_ratio: float = 0.1):
+
+        self.request_timeout = request_timeout
+        self.timeout_per_token = timeout_per_token
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+
+        self.latencies = LatencyTracker()
+
+        # Event of the hedged attempt running in the thread, see mark_admitted
+        self._attempt = threading.local()
+
+    def timeout(self, max_tokens: int = 0) -> float:
+
+        """
+        :param max_tokens: Maximum tokens of the answer, 0 for a streamed answer
+        :return: The timeout of an attempt
+        """
+
+        return self.request_timeout + self.timeout_per_token * max_tokens
+
+    def retry_delay(self, attempt: int, error: Exception, deadline: float) -> Optional[float]:
+
+        """
+        :param attempt: Number of the attempt that failed, from 0
+        :param error: Error of the attempt
+        :param deadline: time.monotonic() deadline of the call
+        :return: The seconds to wait before the next attempt, None if the call failed
+        """
+
+        if isinstance(error, APIQueryError) or not is_retryable(error) or attempt >= self.max_retries:
+            return None
+
+        delay = max(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)), retry_after(error))
+
+        if time.monotonic() + delay > deadline - MIN_ATTEMPT_SECONDS:
+            return None
+
+        record(retries=1)
+
+        return delay
+
+    def failed(self, error: Exception, attempt: int) -> APIQueryError:
+
+        record(failures=1)
+
+        if isinstance(error, APIQueryError):
+            return error
+
+        return APIQueryError(f'API call failed after {attempt + 1} attempt(s): {type(error).__name__}: {error}')
+
+    def call(self, send: Callable[[float], T], timeout: float, hedge_key: str = None) -> T:
+
+        """
+        :param send: Sends the request with the given timeout (seconds) and returns the response. The timeout bounds
+         the API request, not the wait of the rate limiter before it.
+        :param timeout: Timeout of an attempt, see timeout
+        :param hedge_key: Key of the latencies (model) of an idempotent call that may be duplicated, None to never
+         duplicate the call. Its send calls mark_admitted once the request is admitted by the rate limiter.
+        :return: The response
+        """
+
+        record(calls=1)
+
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            attempt_timeout = min(timeout, deadline - time.monotonic())
+
+            try:
+                if hedge_key is not None:
+                    return self.hedged(send, attempt_timeout, hedge_key)
+
+                return send(attempt_timeout)
+
+            except Exception as e:
+                if (delay := self.retry_delay(attempt, e, deadline)) is None:
+                    raise self.failed(e, attempt) from e
+
+                warnings.warn(f'API call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s.')
+
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, send: Callable[[float], Awaitable[T]], timeout: float) -> T:
+
+        """
+        See call, without hedging
+        """
+
+        record(calls=1)
+
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            attempt_timeout = min(timeout, deadline - time.monotonic())
+
+            try:
+                return await send(attempt_timeout)
+
+            except Exception as e:
+                if (delay := self.retry_delay(attempt, e, deadline)) is None:
+                    raise self.failed(e, attempt) from e
+
+                warnings.warn(f'API call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s.')
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def mark_admitted(self) -> None:
+
+        """
+        Called by send once its request is admitted by the rate limiter: the hedge delay of the attempt starts then
+        """
+
+        admitted = getattr(self._attempt, 'admitted', None)
+
+        if admitted is not None:
+            admitted.set()
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+
+        """
+        :return: The seconds after which a call of the key is duplicated, None if it's not
+        """
+
+        if not self.hedging:
+            return None
+
+        with API_CALL_STATS_LOCK:
+            API_CALL_STATS['hedgeable'] += 1
+
+            if API_CALL_STATS['hedged'] >= self.hedge_max_ratio * API_CALL_STATS['hedgeable']:
+                return None
+
+        quantile = self.latencies.quantile(key, self.hedge_quantile)
+
+        return max(self.hedge_min_delay, quantile) if quantile is not None else None
+
+    def hedged(self, send: Callable[[float], T], timeout: float, key: str) -> T:
+
+        """
+        One attempt of an idempotent call, duplicated when it's slower than usual
+        """
+
+        delay = self.hedge_delay(key)
+
+        if delay is None or delay >= timeout - MIN_ATTEMPT_SECONDS:
+            return send(timeout)
+
+        executor = get_hedge_executor()
+        admitted = threading.Event()
+
+        def send_primary(request_timeout: float) -> T:
+            self._attempt.admitted = admitted
+
+            try:
+                return send(request_timeout)
+            finally:
+                self._attempt.admitted = None
+
+        primary = executor.submit(send_primary, timeout)
+        primary.add_done_callback(lambda _: admitted.set())
+
+        # A duplicate of a request still waiting for the rate limiter would take a second share of the capacity
+        # exactly when it's short
+        admitted.wait()
+
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        record(hedged=1)
+        hedge = executor.submit(send, timeout - delay)
+
+        # The first answer wins, an error only counts once both failed. The other request can't be cancelled, its
+        # answer is dropped.
+        pending = {primary, hedge}
+        error = None
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        record(hedge_wins=1)
+
+                    return future.result()
+
+                error = error or future.exception()
+
+        raise error
+
+
+def load_api_caller(path: str = 'parameters.yaml') -> APICaller:
+
+    parameters = (yaml.safe_load(open(path, 'r')) or {}).get('api-calls', {})
+
+    return APICaller(request_timeout=parameters.get('request-timeout', 20.0),
+                     timeout_per_token=parameters.get('timeout-per-token', 0.05),
+                     deadline=parameters.get('deadline', 120.0),
+                     max_retries=parameters.get('max-retries', 3),
+                     backoff_base=parameters.get('backoff-base', 0.5),
+                     backoff_max=parameters.get('backoff-max', 8.0),
+                     hedging=parameters.get('hedging', True),
+                     hedge_quantile=parameters.get('hedge-quantile', 0.95),
+                     hedge_min_delay=parameters.get('hedge-min-delay', 1.0),
+                     hedge_max_ratio=parameters.get('hedge-max-ratio', 0.1))
+
+
+API_CALLER = load_api_caller()
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+
+CACHE_PREFIX = 'therapy:gpt-cache:'
+CACHE_MAX_ENTRIES = 2048
+CACHE_TTL = 3600  # seconds
+LOCK_TTL = 30  # seconds a process can hold the right to compute a value for the whole cluster
+LOCK_POLL = 0.05  # seconds between two checks of a value computed by another process
+
+
+def get_default_redis():
+
+    from .redis_utils import get_redis
+
+    return get_redis()
+
+
+class ResponseCache:
+
+    """
+    Cache of API responses for deterministic calls: an in-memory LRU in front of Redis, both evicting by TTL.
+
+    Concurrent identical requests are coalesced (singleflight): in a process only one thread computes a missing value
+    while the others wait for it, and across processes a short Redis lock lets the other workers wait for the value
+    instead of calling the API too. Redis is optional, the cache falls back to memory only when it's unavailable.
+    """
+
+    def __init__(self,
+                 max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: int = CACHE_TTL,
+                 redis_factory: Callable = get_default_redis):
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis_factory = redis_factory
+
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()  # key -> (expiry, response)
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        self.stats = {'hits': 0, 'memory_hits': 0, 'redis_hits': 0, 'misses': 0, 'coalesced': 0,
+                      'saved_tokens': 0}
+
+    @staticmethod
+    def make_key(query: dict) -> str:
+
+        """
+        Hash of the model, the messages and the parameters of a request
+        """
+
+        return hashlib.sha256(json.dumps(query, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    @property
+    def hit_ratio(self) -> float:
+
+        lookups = self.stats['hits'] + self.stats['misses']
+
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def _redis(self):
+
+        try:
+            return self.redis_factory() if self.redis_factory else None
+        except Exception as e:
+            warnings.warn(f'Response cache running without Redis: {e}')
+            self.redis_factory = None
+            return None
+
+    def _get_memory(self, key: str) -> dict or None:
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+            return entry[1]
+
+    def _set_memory(self, key: str, response: dict) -> None:
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_redis(self, redis_client, key: str) -> dict or None:
+
+        if redis_client is None:
+            return None
+
+        try:
+            raw = redis_client.get(CACHE_PREFIX + key)
+        except Exception as e:
+            warnings.warn(f'Response cache lookup failed: {e}')
+            return None
+
+        return json.loads(raw) if raw is not None else None
+
+    def _record_hit(self, response: dict, level: str) -> dict:
+
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats[level] += 1
+            self.stats['saved_tokens'] += response.get('usage', {}).get('total_tokens', 0)
+
+        return response
+
+    def get_or_compute(self, query: dict, compute: Callable[[], dict]) -> dict:
+
+        """
+        Get the cached response of a request or compute it, making only one upstream call for concurrent identical
+        requests.
+
+        :param query: Arguments of the request, hashed into the cache key
+        :param compute: Makes the upstream call, returns a JSON serializable response
+        :return: The response
+        """
+
+        key = self.make_key(query)
+
+        if (response := self._get_memory(key)) is not None:
+            return self._record_hit(response, 'memory_hits')
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            response = future.result()
+            return self._record_hit(response, 'memory_hits')
+
+        try:
+            response = self._compute_cluster(key, compute)
+            future.set_result(response)
+            return response
+
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _compute_cluster(self, key: str, compute: Callable[[], dict]) -> dict:
+
+        redis_client = self._redis()
+
+        if (response := self._get_redis(redis_client, key)) is not None:
+            self._set_memory(key, response)
+            return self._record_hit(response, 'redis_hits')
+
+        lock_key = f'{CACHE_PREFIX}{key}:lock'
+        locked = False
+
+        if redis_client is not None:
+            try:
+                locked = bool(redis_client.set(lock_key, 1, nx=True, ex=LOCK_TTL))
+
+                if not locked:
+                    # Another worker is computing the same request: wait for its value, up to the lock TTL. The lock
+                    # is checked before the value, which is stored before the lock is released.
+                    deadline = time.monotonic() + LOCK_TTL
+                    while True:
+                        lock_held = redis_client.exists(lock_key)
+
+                        if (response := self._get_redis(redis_client, key)) is not None:
+                            self._set_memory(key, response)
+                            with self._lock:
+                                self.stats['coalesced'] += 1
+                            return self._record_hit(response, 'redis_hits')
+
+                        if not lock_held or time.monotonic() >= deadline:
+                            break
+
+                        time.sleep(LOCK_POLL)
+
+            except Exception as e:
+                warnings.warn(f'Response cache lock failed: {e}')
+
+        with self._lock:
+            self.stats['misses'] += 1
+
+        try:
+            response = compute()
+
+            self._set_memory(key, response)
+
+            if redis_client is not None:
+                try:
+                    redis_client.set(CACHE_PREFIX + key, json.dumps(response), ex=self.ttl)
+                except Exception as e:
+                    warnings.warn(f'Response cache store failed: {e}')
+
+            return response
+
+        finally:
+            if locked:
+                try:
+                    redis_client.delete(lock_key)
+                except Exception:
+                    pass
+
+
+RESPONSE_CACHE = ResponseCache()
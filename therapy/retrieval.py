@@ -0,0 +1,353 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+INDEX_VERSION = 1  # Part of the corpus digest, bump when the passages or vectors change
+N_FEATURES = 1 << 18  # Hashed unigrams and bigrams
+
+WORDS = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+SENTENCES = re.compile(r'(?<=[.!?])\s+')
+STOPWORDS = frozenset('a an and are as at be been but by can could did do does for from had has have he her his i if '
+                      'in into is it its me my no not of on or our she so than that the their them then there these '
+                      'they this to was we were what when which who will with would you your'.split())
+
+
+class Passage(NamedTuple):
+    source: str
+    text: str
+    tokens: int
+
+
+def terms(text: str) -> list[str]:
+
+    words = [word for word in WORDS.findall(text.lower()) if word not in STOPWORDS]
+
+    return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+
+def hash_terms(text: str) -> np.ndarray:
+    return np.array([zlib.crc32(term.encode()) % N_FEATURES for term in terms(text)], dtype=np.int64)
+
+
+class GuidelineIndex:
+
+    """
+    Offline TF-IDF index of the evidence_based_data passages, to send each prompt only the guidelines relevant to the
+    current turn instead of the whole text of the therapy.
+
+    The files are split into passages of about passage_tokens, vectorized with hashed unigrams and bigrams, and stored
+    by column (feature -> passages and weights) in .npy files opened memory-mapped: a query only reads the postings of
+    its own terms, so it stays well under a millisecond for thousands of passages. The corpus is checked at most every
+    check_interval seconds and the index is rebuilt when it changed (names, sizes or modification times of the files).
+
+    The processes sharing index_dir build it one at a time, under a file lock: each build is written to its own
+    directory, index_dir is a symlink swapped to the new one, so a reader never sees a partial index.
+
+    :param corpus_dir: Directory of the evidence-based files, one per therapy type
+    :param index_dir: Path of the index (symlink to the directory of the current build)
+    :param token_counter: Counts the tokens of a text
+    :param check_interval: Seconds between two checks of the corpus
+    """
+
+    def __init__(self, corpus_dir: str, index_dir: str, token_counter: Callable[[str], int],
+                 passage_tokens: int = 80, check_interval: float = 2.0):
+        self.corpus_dir = corpus_dir
+        self.index_dir = index_dir
+        self.get_token = token_counter
+        self.passage_tokens = passage_tokens
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._loaded_digest = None
+        self._last_check = 0.0
+
+        self.passages: list[Passage] = []
+        self.sources: dict[str, tuple[int, int]] = {}  # source -> range of its passages
+        self.idf = self.col_ptr = self.rows = self.weights = None
+
+    def corpus_digest(self) -> str:
+
+        digest = hashlib.sha256(f'{INDEX_VERSION}:{self.passage_tokens}'.encode())
+
+        for name in sorted(os.listdir(self.corpus_dir)):
+            path = os.path.join(self.corpus_dir, name)
+
+            if os.path.isfile(path) and not name.startswith('.'):
+                stat = os.stat(path)
+                digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+        return digest.hexdigest()
+
+    def split_passages(self, source: str, text: str) -> list[Passage]:
+
+        """
+        Pack the lines of a text (an item of the guidelines) into passages of about passage_tokens, long lines are
+        split on sentences
+        """
+
+        units = []
+        for line in text.splitlines():
+            line = ' '.join(line.split())
+
+            if self.get_token(line) <= self.passage_tokens:
+                units.append(line)
+            else:
+                units.extend(SENTENCES.split(line))
+
+        passages = []
+        current, current_tokens = [], 0
+
+        for unit in filter(None, units):
+            unit_tokens = self.get_token(unit)
+
+            if current and current_tokens + unit_tokens > self.passage_tokens:
+                passages.append(Passage(source, '\n'.join(current), current_tokens))
+                current, current_tokens = [], 0
+
+            current.append(unit)
+            current_tokens += unit_tokens + 1
+
+        if current:
+            passages.append(Passage(source, '\n'.join(current), current_tokens))
+
+        return passages
+
+    @contextmanager
+    def build_lock(self):
+
+        """
+        Lock of the builds of index_dir, shared by the processes
+        """
+
+        path = f'{os.path.abspath(self.index_dir)}.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def build(self) -> int:
+
+        """
+        Build the index of the corpus and publish it at index_dir
+        :return: The number of passages
+        """
+
+        with self.build_lock():
+            return self._build()
+
+    def _build(self) -> int:
+
+        digest = self.corpus_digest()
+
+        passages = []
+        for name in sorted(os.listdir(self.corpus_dir)):
+            path = os.path.join(self.corpus_dir, name)
+
+            if os.path.isfile(path) and not name.startswith('.'):
+                with open(path, 'r') as f:
+                    passages.extend(self.split_passages(name, f.read()))
+
+        # Term frequencies of each passage, sublinear
+        features = [np.unique(hash_terms(passage.text), return_counts=True) for passage in passages]
+
+        document_frequency = np.zeros(N_FEATURES, dtype=np.float32)
+        for passage_features, _ in features:
+            document_frequency[passage_features] += 1
+
+        idf = np.log((1 + len(passages)) / (1 + document_frequency)).astype(np.float32) + 1
+
+        rows, cols, weights = [], [], []
+        for row, (passage_features, counts) in enumerate(features):
+            vector = (1 + np.log(counts)) * idf[passage_features]
+            norm = np.linalg.norm(vector)
+
+            rows.append(np.full(len(passage_features), row, dtype=np.int32))
+            cols.append(passage_features)
+            weights.append((vector / norm if norm else vector).astype(np.float32))
+
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32)
+
+        # By column: the postings of feature f are rows[col_ptr[f]:col_ptr[f + 1]]
+        order = np.argsort(cols, kind='stable')
+        col_ptr = np.zeros(N_FEATURES + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=N_FEATURES), out=col_ptr[1:])
+
+        # Written to a directory of its own, then index_dir is swapped to it
+        index_path = os.path.abspath(self.index_dir)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        build_dir = tempfile.mkdtemp(dir=os.path.dirname(index_path), prefix=f'{os.path.basename(index_path)}.')
+
+        try:
+            np.save(os.path.join(build_dir, 'idf.npy'), idf)
+            np.save(os.path.join(build_dir, 'col_ptr.npy'), col_ptr)
+            np.save(os.path.join(build_dir, 'rows.npy'), rows[order])
+            np.save(os.path.join(build_dir, 'weights.npy'), weights[order])
+
+            with open(os.path.join(build_dir, 'passages.json'), 'w') as f:
+                json.dump({'digest': digest, 'passages': [passage._asdict() for passage in passages]}, f)
+
+            self.publish(build_dir)
+
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+
+        return len(passages)
+
+    def publish(self, build_dir: str) -> None:
+
+        """
+        Point index_dir to a new build and remove the older ones, keeping the previous build for the processes still
+        loading it. Called with the build lock held.
+        """
+
+        index_path = os.path.abspath(self.index_dir)
+        previous = os.path.realpath(index_path) if os.path.islink(index_path) else None
+
+        # An index_dir of the layout without symlink
+        if os.path.isdir(index_path) and not os.path.islink(index_path):
+            shutil.rmtree(index_path)
+
+        link = f'{build_dir}.link'
+        os.symlink(os.path.basename(build_dir), link)
+        os.replace(link, index_path)
+
+        for path in glob.glob(f'{glob.escape(index_path)}.*'):
+            if os.path.isdir(path) and path not in (build_dir, previous):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _read_digest(self) -> str or None:
+
+        try:
+            with open(os.path.join(self.index_dir, 'passages.json'), 'r') as f:
+                return json.load(f)['digest']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def load(self) -> None:
+
+        """
+        Open the index, building it first if it's missing or outdated
+        """
+
+        with self._lock:
+            self._last_check = time.monotonic()
+            digest = self.corpus_digest()
+
+            if self._loaded_digest == digest:
+                return
+
+            if self._read_digest() != digest:
+                with self.build_lock():
+                    # Another process may have built it while this one waited for the lock
+                    if self._read_digest() != digest:
+                        self._build()
+
+            # The files of one build, even if index_dir is swapped meanwhile
+            index_dir = os.path.realpath(self.index_dir)
+
+            with open(os.path.join(index_dir, 'passages.json'), 'r') as f:
+                self.passages = [Passage(**passage) for passage in json.load(f)['passages']]
+
+            self.sources = {}
+            for row, passage in enumerate(self.passages):
+                first, _ = self.sources.get(passage.source, (row, row))
+                self.sources[passage.source] = (first, row + 1)
+
+            self.idf = np.load(os.path.join(index_dir, 'idf.npy'), mmap_mode='r')
+            self.col_ptr = np.load(os.path.join(index_dir, 'col_ptr.npy'), mmap_mode='r')
+            self.rows = np.load(os.path.join(index_dir, 'rows.npy'), mmap_mode='r')
+            self.weights = np.load(os.path.join(index_dir, 'weights.npy'), mmap_mode='r')
+
+            self._loaded_digest = digest
+
+    def search_rows(self, query: str, source: str = None, k: int = 4) -> list[tuple[float, int]]:
+
+        """
+        :param query: Text the passages should be relevant to
+        :param source: Only search the passages of this file (therapy type)
+        :param k: Maximum number of passages
+        :return: The rows of the best passages with their cosine similarity to the query, best first
+        """
+
+        if self.idf is None or time.monotonic() - self._last_check >= self.check_interval:
+            self.load()
+
+        features, counts = np.unique(hash_terms(query), return_counts=True)
+
+        if not len(features) or not self.passages:
+            return []
+
+        query_weights = (1 + np.log(counts)) * self.idf[features]
+
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for feature, weight in zip(features, query_weights):
+            start, end = self.col_ptr[feature], self.col_ptr[feature + 1]
+
+            if start != end:
+                # A passage appears once in the postings of a feature
+                scores[self.rows[start:end]] += weight * self.weights[start:end]
+
+        first, last = self.source_range(source)
+        scores = scores[first:last]
+
+        if not len(scores):
+            return []
+
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+
+        norm = float(np.linalg.norm(query_weights)) or 1.0
+
+        return [(float(scores[i]) / norm, first + int(i)) for i in best if scores[i] > 0]
+
+    def source_range(self, source: str = None) -> tuple[int, int]:
+        return self.sources.get(source, (0, 0)) if source is not None else (0, len(self.passages))
+
+    def search(self, query: str, source: str = None, k: int = 4) -> list[tuple[float, Passage]]:
+        return [(score, self.passages[row]) for score, row in self.search_rows(query, source=source, k=k)]
+
+    def select(self, query: str, source: str = None, k: int = 4, token_budget: int = 300) -> list[Passage]:
+
+        """
+        Best passages for the query within a token budget, in the order of the corpus. When none matches the query
+        the first passages of the source are returned, they usually give the overview of the therapy
+        """
+
+        rows = [row for _, row in self.search_rows(query, source=source, k=k)]
+
+        if not rows:
+            first, last = self.source_range(source)
+            rows = list(range(first, min(last, first + k)))
+
+        selected = []
+        tokens = 0
+
+        for row in rows:
+            if tokens + self.passages[row].tokens > token_budget:
+                continue
+
+            selected.append(row)
+            tokens += self.passages[row].tokens
+
+        return [self.passages[row] for row in sorted(selected)]
@@ -0,0 +1,224 @@
+import json
+import os
+import threading
+import warnings
+import zlib
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from .retrieval import terms
+
+N_FEATURES = 1 << 14  # Hashed unigrams and bigrams, 64 KB of weights per label
+
+ROUTER_STATS = {'local': 0, 'fallback': 0}  # Decisions taken by the local models / left to the LLM
+ROUTER_STATS_LOCK = threading.Lock()
+
+
+def features(text: str) -> np.ndarray:
+    hashed = {zlib.crc32(term.encode()) % N_FEATURES for term in terms(text)}
+
+    return np.fromiter(hashed, dtype=np.int32, count=len(hashed))
+
+
+class LinearRouter:
+
+    """
+    Multinomial logistic regression over the hashed n-grams of a text, for one routing question. Predicting sums
+    a few hundred rows of the weights, tens of microseconds.
+
+    :param labels: Answers of the question
+    :param weights: (N_FEATURES, len(labels)) weights
+    :param bias: (len(labels),) bias
+    """
+
+    def __init__(self, labels: list[str], weights: np.ndarray, bias: np.ndarray):
+        self.labels = list(labels)
+        self.weights = weights
+        self.bias = bias
+
+    def probabilities(self, text: str) -> np.ndarray:
+
+        indices = features(text)
+
+        logits = self.bias.copy()
+        if len(indices):
+            # Each present feature weighs 1 / sqrt(number of features), as in fit
+            logits += self.weights[indices].sum(axis=0) / np.sqrt(len(indices))
+
+        exp = np.exp(logits - logits.max())
+
+        return exp / exp.sum()
+
+    def predict(self, text: str) -> tuple[str, float]:
+
+        """
+        :return: The most probable label and its probability
+        """
+
+        probabilities = self.probabilities(text)
+        best = int(probabilities.argmax())
+
+        return self.labels[best], float(probabilities[best])
+
+    @classmethod
+    def fit(cls, texts: list[str], labels: list[str], epochs: int = 300, learning_rate: float = 2.0,
+            l2: float = 1e-4) -> 'LinearRouter':
+
+        """
+        Train by full-batch gradient descent, the features are kept sparse
+        """
+
+        label_names = sorted(set(labels))
+        targets = np.zeros((len(texts), len(label_names)), dtype=np.float32)
+        targets[np.arange(len(texts)), [label_names.index(label) for label in labels]] = 1
+
+        rows = [features(text) for text in texts]
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        sample_of = np.repeat(np.arange(len(rows)), [len(row) for row in rows])
+        values = np.concatenate([np.full(len(row), 1 / np.sqrt(len(row)), dtype=np.float32) for row in rows if len(row)]
+                                or [np.zeros(0, dtype=np.float32)])
+
+        weights = np.zeros((N_FEATURES, len(label_names)), dtype=np.float32)
+        bias = np.zeros(len(label_names), dtype=np.float32)
+
+        for _ in range(epochs):
+            logits = np.tile(bias, (len(rows), 1))
+            np.add.at(logits, sample_of, weights[indices] * values[:, None])
+
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+            error = (probabilities - targets) / len(rows)
+
+            gradient = l2 * weights
+            np.add.at(gradient, indices, error[sample_of] * values[:, None])
+
+            weights -= learning_rate * gradient
+            bias -= learning_rate * error.sum(axis=0)
+
+        return cls(label_names, weights, bias)
+
+    def save(self, path: str) -> None:
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        # Weights are mostly zeros (features never seen in training)
+        np.savez_compressed(path, labels=np.array(self.labels), weights=self.weights, bias=self.bias)
+
+    @classmethod
+    def load(cls, path: str) -> 'LinearRouter':
+
+        with np.load(path) as data:
+            if data['weights'].shape[0] != N_FEATURES:
+                raise ValueError(f'{path} was trained with {data["weights"].shape[0]} features, not {N_FEATURES}.')
+
+            return cls(data['labels'].tolist(), data['weights'], data['bias'])
+
+
+class Router:
+
+    """
+    Local answers to the routing questions of the therapy (next action, therapy type), to skip an LLM round trip
+    when the local model is confident enough. Otherwise the caller asks the LLM and logs its decision, the training
+    data of the models (see the train_router and evaluate_router commands).
+
+    The models are <model_dir>/<question>.npz, loaded once per process; without a model every decision is left to
+    the LLM.
+
+    :param model_dir: Directory of the trained models
+    :param threshold: Minimum probability of a local decision
+    :param log_path: JSON lines file the LLM decisions are appended to, None to not log them
+    """
+
+    def __init__(self, model_dir: str, threshold: float = 0.9, log_path: str = None):
+        self.model_dir = model_dir
+        self.threshold = threshold
+        self.log_path = log_path
+
+        self._models: dict[str, Optional[LinearRouter]] = {}
+        self._lock = threading.Lock()
+
+    def model_path(self, question: str) -> str:
+        return os.path.join(self.model_dir, f'{question}.npz')
+
+    def get_model(self, question: str) -> Optional[LinearRouter]:
+
+        if question not in self._models:
+            with self._lock:
+                if question not in self._models:
+                    model = None
+
+                    if os.path.isfile(self.model_path(question)):
+                        try:
+                            model = LinearRouter.load(self.model_path(question))
+                        except (OSError, ValueError, KeyError) as e:
+                            warnings.warn(f'Routing model {question} unavailable: {e}')
+
+                    self._models[question] = model
+
+        return self._models[question]
+
+    def decide(self, question: str, text: str, options: list[str]) -> Optional[str]:
+
+        """
+        :param question: Routing question, the name of its model
+        :param text: What the LLM would base its decision on
+        :param options: Current answers of the question
+        :return: The local decision, None if there's no model or it isn't confident enough
+        """
+
+        model = self.get_model(question)
+
+        decision = None
+
+        if model is not None:
+            label, probability = model.predict(text)
+
+            # A label of a model trained on other options is never used
+            if probability >= self.threshold and label in options:
+                decision = label
+
+        with ROUTER_STATS_LOCK:
+            ROUTER_STATS['local' if decision is not None else 'fallback'] += 1
+
+        return decision
+
+    def log(self, question: str, text: str, label: str) -> None:
+
+        """
+        Append a decision of the LLM to the log
+        """
+
+        if self.log_path is None:
+            return
+
+        line = json.dumps({'question': question, 'label': label, 'text': text, 'time': datetime.now().isoformat()})
+
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+
+                with open(self.log_path, 'a') as f:
+                    f.write(line + '\n')
+
+        except OSError as e:
+            warnings.warn(f'Routing decision not logged: {e}')
+
+
+def read_decisions(log_path: str) -> dict[str, list[tuple[str, str]]]:
+
+    """
+    :return: The logged (text, label) of each question
+    """
+
+    decisions = {}
+
+    with open(log_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                decision = json.loads(line)
+                decisions.setdefault(decision['question'], []).append((decision['text'], decision['label']))
+
+    return decisions
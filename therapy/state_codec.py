@@ -0,0 +1,263 @@
+"""
+Compact binary encoding of the Therapy parameters (see Therapy.collect_parameters).
+
+    header   MAGIC, CODEC_VERSION (1 byte), flags (1 byte, FLAG_ZLIB)
+    body     fields: uint32 length + compact JSON of every field but the conversation
+             messages: uint32 count, then by column (see encode_messages): roles, token counts, content lengths,
+                       every content in one UTF-8 block, and the other keys of the messages as one JSON list
+
+The guidelines of the chosen therapy are stored as a reference to their evidence_based_data prompt with a digest of
+its content, instead of the full text. Data encoded as JSON (the former format) is still decoded.
+"""
+
+import hashlib
+import json
+import struct
+from array import array
+import warnings
+import zlib
+from typing import Callable
+
+MAGIC = b'TGS'
+CODEC_VERSION = 1
+FLAG_ZLIB = 1
+
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 512  # bytes, smaller bodies aren't worth a zlib header
+
+ROLES = ('system', 'user', 'assistant')
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+MESSAGE_KEYS = {'role', 'content', 'tokens'}
+
+HEADER = struct.Struct('<3sBB')
+LENGTH = struct.Struct('<I')
+MESSAGE_HEADER = struct.Struct('<BiII')  # role, tokens (-1 if unknown), content length, extras length
+
+GUIDELINES_REF = '$ref'
+
+
+class StateCodecError(ValueError):
+    pass
+
+
+def get_guidelines(therapy_type: str) -> str or None:
+
+    from .therapist import PROMPT_CACHE
+
+    try:
+        return PROMPT_CACHE.get('evidence_based_data', therapy_type)
+    except FileNotFoundError:
+        return None
+
+
+def digest(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def encode_therapy_informations(therapy_informations: dict,
+                                resolver: Callable[[str], str or None] = get_guidelines) -> dict:
+
+    """
+    Replace the guidelines by a reference when they are the current evidence_based_data of the therapy type
+    """
+
+    guidelines = therapy_informations.get('guidelines')
+
+    if not isinstance(guidelines, str) or guidelines == 'not_defined':
+        return therapy_informations
+
+    if resolver(therapy_informations['type']) != guidelines:
+        # Edited or unknown guidelines are kept inline
+        return therapy_informations
+
+    return dict(therapy_informations, guidelines={GUIDELINES_REF: therapy_informations['type'],
+                                                  'sha256': digest(guidelines)})
+
+
+def decode_therapy_informations(therapy_informations: dict,
+                                resolver: Callable[[str], str or None] = get_guidelines) -> dict:
+
+    reference = therapy_informations.get('guidelines')
+
+    if not isinstance(reference, dict):
+        return therapy_informations
+
+    guidelines = resolver(reference[GUIDELINES_REF])
+
+    if guidelines is None:
+        raise StateCodecError(f'Guidelines {reference[GUIDELINES_REF]} not found in evidence_based_data.')
+
+    if digest(guidelines) != reference['sha256']:
+        warnings.warn(f'Guidelines {reference[GUIDELINES_REF]} changed since the state was stored, '
+                      f'using the current version.')
+
+    return dict(therapy_informations, guidelines=guidelines)
+
+
+def encode_message(message: dict) -> bytes:
+
+    """
+    Encode a single message, for stores keeping the messages one by one
+    """
+
+    content = message['content'].encode()
+
+    extras = {key: value for key, value in message.items() if key not in MESSAGE_KEYS}
+    extras_data = json.dumps(extras, separators=(',', ':')).encode() if extras else b''
+
+    return MESSAGE_HEADER.pack(ROLE_CODES[message['role']],
+                               message.get('tokens', -1),
+                               len(content),
+                               len(extras_data)) + content + extras_data
+
+
+def decode_message(data: bytes or memoryview, offset: int = 0) -> tuple[dict, int]:
+
+    """
+    :return: The message and the offset of the end of the message in data
+    """
+
+    role, tokens, content_length, extras_length = MESSAGE_HEADER.unpack_from(data, offset)
+    offset += MESSAGE_HEADER.size
+
+    message = {'role': ROLES[role], 'content': str(data[offset:offset + content_length], 'utf-8')}
+    offset += content_length
+
+    if extras_length:
+        message.update(json.loads(bytes(data[offset:offset + extras_length])))
+        offset += extras_length
+
+    if tokens >= 0:
+        message['tokens'] = tokens
+
+    return message, offset
+
+
+def loads_message(data: bytes) -> dict:
+
+    """
+    Decode a single message, encoded by encode_message or as JSON
+    """
+
+    if data[:1] == b'{':
+        return json.loads(data)
+
+    return decode_message(data)[0]
+
+
+def encode_messages(messages: list[dict]) -> bytes:
+
+    """
+    Encode a list of messages column by column, so decoding is a handful of C calls and a slice per message
+    """
+
+    contents = [message['content'] for message in messages]
+    content_data = ''.join(contents).encode()
+
+    extras_data = json.dumps([{key: value for key, value in message.items() if key not in MESSAGE_KEYS}
+                              for message in messages], separators=(',', ':')).encode()
+
+    return b''.join([LENGTH.pack(len(messages)),
+                     bytes(ROLE_CODES[message['role']] for message in messages),
+                     array('i', [message.get('tokens', -1) for message in messages]).tobytes(),
+                     array('I', [len(content) for content in contents]).tobytes(),
+                     LENGTH.pack(len(content_data)), content_data,
+                     LENGTH.pack(len(extras_data)), extras_data])
+
+
+def decode_messages(data: bytes or memoryview, offset: int = 0) -> tuple[list[dict], int]:
+
+    """
+    :return: The messages and the offset of the end of the messages in data
+    """
+
+    count, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+
+    roles = bytes(data[offset:offset + count])
+    offset += count
+
+    tokens = array('i')
+    tokens.frombytes(data[offset:offset + 4 * count])
+    offset += 4 * count
+
+    lengths = array('I')
+    lengths.frombytes(data[offset:offset + 4 * count])
+    offset += 4 * count
+
+    content_length, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    content = str(data[offset:offset + content_length], 'utf-8')
+    offset += content_length
+
+    extras_length, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    extras = json.loads(bytes(data[offset:offset + extras_length]))
+    offset += extras_length
+
+    messages = []
+    position = 0
+    for role, message_tokens, length, message_extras in zip(roles, tokens, lengths, extras):
+        message = {'role': ROLES[role], 'content': content[position:position + length], **message_extras}
+
+        if message_tokens >= 0:
+            message['tokens'] = message_tokens
+
+        messages.append(message)
+        position += length
+
+    return messages, offset
+
+
+def encode_state(parameters: dict, compress: bool = True,
+                 resolver: Callable[[str], str or None] = get_guidelines) -> bytes:
+
+    fields = {field: value for field, value in parameters.items() if field != 'conversation'}
+
+    if 'therapy_informations' in fields:
+        fields['therapy_informations'] = encode_therapy_informations(fields['therapy_informations'], resolver)
+
+    fields_data = json.dumps(fields, separators=(',', ':')).encode()
+
+    body = b''.join([LENGTH.pack(len(fields_data)), fields_data,
+                     encode_messages(parameters.get('conversation', []))])
+
+    flags = 0
+
+    if compress and len(body) >= COMPRESS_MIN_SIZE:
+        body = zlib.compress(body, COMPRESS_LEVEL)
+        flags |= FLAG_ZLIB
+
+    return HEADER.pack(MAGIC, CODEC_VERSION, flags) + body
+
+
+def decode_state(data: bytes or str, resolver: Callable[[str], str or None] = get_guidelines) -> dict:
+
+    if isinstance(data, str) or data[:1] == b'{':
+        return json.loads(data)
+
+    magic, version, flags = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise StateCodecError('Not an encoded therapy state.')
+
+    if version > CODEC_VERSION:
+        raise StateCodecError(f'State encoded with codec version {version}, this version reads up to '
+                              f'{CODEC_VERSION}.')
+
+    body = memoryview(data)[HEADER.size:]
+
+    if flags & FLAG_ZLIB:
+        body = memoryview(zlib.decompress(body))
+
+    fields_length, = LENGTH.unpack_from(body)
+    offset = LENGTH.size + fields_length
+    parameters = json.loads(bytes(body[LENGTH.size:offset]))
+
+    if 'therapy_informations' in parameters:
+        parameters['therapy_informations'] = decode_therapy_informations(parameters['therapy_informations'],
+                                                                         resolver)
+
+    parameters['conversation'], _ = decode_messages(body, offset)
+
+    return parameters
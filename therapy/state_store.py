@@ -0,0 +1,445 @@
+import json
+import threading
+from typing import Callable
+
+from django.conf import settings
+
+from .state_codec import (encode_state, decode_state, encode_message, loads_message, encode_therapy_informations,
+                          decode_therapy_informations)
+
+STATE_KEY = 'therapy:state:{session_id}'  # Hash: version and one JSON value per field but the conversation
+CONVERSATION_KEY = 'therapy:state:{session_id}:conversation'  # List of messages
+
+
+class StateNotFound(KeyError):
+    pass
+
+
+class StateConflict(Exception):
+    pass
+
+
+def parse_parameters(parameters: str or dict) -> dict:
+
+    if isinstance(parameters, str):
+        parameters = json.loads(parameters)
+
+    return parameters
+
+
+def apply_delta(parameters: dict, delta: dict) -> dict:
+
+    """
+    Apply a delta of Therapy.get_delta to parameters, in place
+    :raise StateConflict: If the conversation isn't the one the delta was computed from
+    """
+
+    if len(parameters['conversation']) != delta['base_length']:
+        raise StateConflict(f"Conversation has {len(parameters['conversation'])} messages, "
+                            f"the delta expects {delta['base_length']}.")
+
+    parameters['conversation'].extend(delta['messages'])
+    parameters.update(delta['fields'])
+
+    return parameters
+
+
+class TherapyStateStore:
+
+    """
+    Server-side storage of the Therapy parameters of each session, with optimistic versioning: a commit only succeeds
+    if the state wasn't committed by someone else since it was loaded.
+    """
+
+    def __init__(self, ttl: int = None):
+        self.ttl = ttl
+
+    def create(self, session_id: str, parameters: str or dict) -> int:
+
+        """
+        Store the initial state of a session, replacing any previous one
+        :return: The version of the state
+        """
+
+        raise NotImplementedError
+
+    def load(self, session_id: str) -> tuple[dict, int]:
+
+        """
+        :return: The parameters of the session and their version
+        :raise StateNotFound: If the session has no state
+        """
+
+        raise NotImplementedError
+
+    def get_version(self, session_id: str) -> int:
+
+        """
+        :return: The version of the state of a session, without loading it
+        :raise StateNotFound: If the session has no state
+        """
+
+        raise NotImplementedError
+
+    def commit(self, session_id: str, parameters: str or dict, version: int) -> int:
+
+        """
+        Replace the state of a session if it's still at the given version
+        :return: The new version
+        :raise StateConflict: If the state was committed since it was loaded at this version
+        """
+
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def update(self, session_id: str, function: Callable[[dict], None], retries: int = 5) -> dict:
+
+        """
+        Load, modify in place with function and commit a state, retrying on conflicts
+        :return: The committed parameters
+        """
+
+        for _ in range(retries):
+            parameters, version = self.load(session_id)
+            function(parameters)
+
+            try:
+                self.commit(session_id, parameters, version)
+                return parameters
+
+            except StateConflict:
+                continue
+
+        raise StateConflict(f'Could not update the state of session {session_id} after {retries} attempts.')
+
+    def apply_delta(self, session_id: str, delta: dict, retries: int = 5) -> int:
+
+        """
+        Apply the changes of a turn (Therapy.get_delta). Fields the turn didn't touch keep their stored value, so an
+        API key or model changed by the web tier meanwhile is preserved.
+
+        :return: The new version
+        :raise StateConflict: If another turn was committed since the delta's base
+        """
+
+        for _ in range(retries):
+            parameters, version = self.load(session_id)
+
+            apply_delta(parameters, delta)
+
+            try:
+                return self.commit(session_id, parameters, version)
+
+            except StateConflict:
+                continue
+
+        raise StateConflict(f'Could not apply the delta to session {session_id} after {retries} attempts.')
+
+
+class MemoryStateStore(TherapyStateStore):
+
+    """
+    In-process store, for development and tests: the web server and the worker must be the same process
+    """
+
+    def __init__(self, ttl: int = None):
+        super().__init__(ttl)
+
+        self._states: dict[str, tuple[bytes, int]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id, parameters):
+
+        with self._lock:
+            self._states[session_id] = (encode_state(parse_parameters(parameters)), 1)
+
+        return 1
+
+    def load(self, session_id):
+
+        with self._lock:
+            if session_id not in self._states:
+                raise StateNotFound(session_id)
+
+            state, version = self._states[session_id]
+
+        return decode_state(state), version
+
+    def get_version(self, session_id):
+
+        with self._lock:
+            if session_id not in self._states:
+                raise StateNotFound(session_id)
+
+            return self._states[session_id][1]
+
+    def commit(self, session_id, parameters, version):
+
+        with self._lock:
+            if session_id not in self._states:
+                raise StateNotFound(session_id)
+
+            if self._states[session_id][1] != version:
+                raise StateConflict(session_id)
+
+            self._states[session_id] = (encode_state(parse_parameters(parameters)), version + 1)
+
+        return version + 1
+
+    def delete(self, session_id):
+
+        with self._lock:
+            self._states.pop(session_id, None)
+
+
+class RedisStateStore(TherapyStateStore):
+
+    """
+    Redis store: the version and the fields in a hash, the conversation in a list, so a delta only writes the new
+    messages and the changed fields
+    """
+
+    def __init__(self, ttl: int = None, redis_client=None):
+        super().__init__(ttl)
+
+        if redis_client is None:
+            from .redis_utils import get_redis
+
+            redis_client = get_redis()
+
+        self.redis = redis_client
+
+    @staticmethod
+    def keys(session_id: str) -> tuple[str, str]:
+        return STATE_KEY.format(session_id=session_id), CONVERSATION_KEY.format(session_id=session_id)
+
+    def _write(self, pipe, session_id: str, parameters: dict, version: int) -> None:
+
+        state_key, conversation_key = self.keys(session_id)
+
+        fields = {field: value for field, value in parameters.items() if field != 'conversation'}
+
+        pipe.delete(state_key, conversation_key)
+        pipe.hset(state_key, mapping={'version': version, **self.encode_fields(fields)})
+
+        if parameters['conversation']:
+            pipe.rpush(conversation_key, *[encode_message(message) for message in parameters['conversation']])
+
+        self._expire(pipe, state_key, conversation_key)
+
+    @staticmethod
+    def encode_fields(fields: dict) -> dict:
+
+        if 'therapy_informations' in fields:
+            fields = dict(fields, therapy_informations=encode_therapy_informations(fields['therapy_informations']))
+
+        return {field: json.dumps(value) for field, value in fields.items()}
+
+    def _expire(self, pipe, state_key: str, conversation_key: str) -> None:
+
+        if self.ttl:
+            pipe.expire(state_key, self.ttl)
+            pipe.expire(conversation_key, self.ttl)
+
+    def create(self, session_id, parameters):
+
+        pipe = self.redis.pipeline()
+        self._write(pipe, session_id, parse_parameters(parameters), 1)
+        pipe.execute()
+
+        return 1
+
+    def load(self, session_id):
+
+        state_key, conversation_key = self.keys(session_id)
+
+        # Both keys are read in one transaction, so the conversation always matches the version
+        pipe = self.redis.pipeline()
+        pipe.hgetall(state_key)
+        pipe.lrange(conversation_key, 0, -1)
+        state, conversation = pipe.execute()
+
+        if b'version' not in state:
+            raise StateNotFound(session_id)
+
+        version = int(state.pop(b'version'))
+
+        parameters = {field.decode(): json.loads(value) for field, value in state.items()}
+
+        if 'therapy_informations' in parameters:
+            parameters['therapy_informations'] = decode_therapy_informations(parameters['therapy_informations'])
+
+        parameters['conversation'] = [loads_message(message) for message in conversation]
+
+        return parameters, version
+
+    def get_version(self, session_id):
+
+        version = self.redis.hget(self.keys(session_id)[0], 'version')
+
+        if version is None:
+            raise StateNotFound(session_id)
+
+        return int(version)
+
+    def commit(self, session_id, parameters, version):
+
+        import redis
+
+        state_key, _ = self.keys(session_id)
+
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(state_key)
+
+                current = pipe.hget(state_key, 'version')
+
+                if current is None:
+                    raise StateNotFound(session_id)
+
+                if int(current) != version:
+                    raise StateConflict(session_id)
+
+                pipe.multi()
+                self._write(pipe, session_id, parse_parameters(parameters), version + 1)
+                pipe.execute()
+
+            except redis.WatchError:
+                raise StateConflict(session_id)
+
+        return version + 1
+
+    def apply_delta(self, session_id, delta, retries=5):
+
+        import redis
+
+        state_key, conversation_key = self.keys(session_id)
+
+        for _ in range(retries):
+            with self.redis.pipeline() as pipe:
+                try:
+                    pipe.watch(state_key, conversation_key)
+
+                    if not pipe.exists(state_key):
+                        raise StateNotFound(session_id)
+
+                    if pipe.llen(conversation_key) != delta['base_length']:
+                        raise StateConflict(session_id)
+
+                    pipe.multi()
+
+                    if delta['messages']:
+                        pipe.rpush(conversation_key, *[encode_message(message) for message in delta['messages']])
+
+                    if delta['fields']:
+                        pipe.hset(state_key, mapping=self.encode_fields(delta['fields']))
+
+                    pipe.hincrby(state_key, 'version', 1)
+                    self._expire(pipe, state_key, conversation_key)
+
+                    return pipe.execute()[-1 - (2 if self.ttl else 0)]
+
+                except redis.WatchError:
+                    # Concurrent write, most likely the web tier changing a field: retry on the new state
+                    continue
+
+        raise StateConflict(f'Could not apply the delta to session {session_id} after {retries} attempts.')
+
+    def delete(self, session_id):
+        self.redis.delete(*self.keys(session_id))
+
+
+class DatabaseStateStore(TherapyStateStore):
+
+    """
+    Store in the Django database, see therapy.models.TherapyState
+    """
+
+    def create(self, session_id, parameters):
+
+        from .models import TherapyState
+
+        TherapyState.objects.update_or_create(session_id=session_id,
+                                              defaults={'version': 1,
+                                                        'state': encode_state(parse_parameters(parameters))})
+
+        return 1
+
+    def load(self, session_id):
+
+        from .models import TherapyState
+
+        try:
+            state = TherapyState.objects.get(session_id=session_id)
+        except TherapyState.DoesNotExist:
+            raise StateNotFound(session_id)
+
+        return decode_state(bytes(state.state)), state.version
+
+    def get_version(self, session_id):
+
+        from .models import TherapyState
+
+        version = TherapyState.objects.filter(session_id=session_id).values_list('version', flat=True).first()
+
+        if version is None:
+            raise StateNotFound(session_id)
+
+        return version
+
+    def commit(self, session_id, parameters, version):
+
+        from django.utils import timezone
+
+        from .models import TherapyState
+
+        updated = TherapyState.objects.filter(session_id=session_id, version=version).update(
+            version=version + 1, state=encode_state(parse_parameters(parameters)), updated_at=timezone.now())
+
+        if not updated:
+            if not TherapyState.objects.filter(session_id=session_id).exists():
+                raise StateNotFound(session_id)
+
+            raise StateConflict(session_id)
+
+        return version + 1
+
+    def delete(self, session_id):
+
+        from .models import TherapyState
+
+        TherapyState.objects.filter(session_id=session_id).delete()
+
+
+STATE_STORES = {
+    'memory': MemoryStateStore,
+    'redis': RedisStateStore,
+    'database': DatabaseStateStore,
+}
+
+STATE_STORE = None
+STATE_STORE_LOCK = threading.Lock()
+
+
+def get_state_store() -> TherapyStateStore:
+
+    """
+    Process-wide store of the backend chosen by settings.THERAPY_STATE_STORE
+    """
+
+    global STATE_STORE
+
+    if STATE_STORE is None:
+        with STATE_STORE_LOCK:
+            if STATE_STORE is None:
+                backend = getattr(settings, 'THERAPY_STATE_STORE', 'redis')
+
+                if backend not in STATE_STORES:
+                    raise ValueError(f'State store {backend} does not exist. Available stores are: '
+                                     f'{list(STATE_STORES.keys())}.')
+
+                STATE_STORE = STATE_STORES[backend](ttl=getattr(settings, 'THERAPY_STATE_TTL', None))
+
+    return STATE_STORE
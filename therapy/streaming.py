@@ -0,0 +1,158 @@
+import asyncio
+import json
+import re
+import time
+from http.cookies import SimpleCookie
+
+from django.conf import settings
+
+from .redis_utils import get_redis, get_async_redis
+
+STREAM_CHANNEL = 'therapy:stream:{task_id}'
+STREAM_BUFFER = 'therapy:stream:{task_id}:buffer'  # Replayed to subscribers that connect after the first tokens
+STREAM_OWNER = 'therapy:stream:{task_id}:owner'  # Session key allowed to read the stream
+
+STREAM_TTL = 300  # seconds
+STREAM_MAX_DURATION = 180  # seconds an SSE connection can stay open
+
+STREAM_PATH = re.compile(r'^/therapy/stream/(?P<task_id>[0-9a-f-]{36})/$')
+
+
+def register_stream(task_id: str, session_key: str) -> None:
+
+    """
+    Allow the session that sent the message to read the stream of its task
+    """
+
+    get_redis().set(STREAM_OWNER.format(task_id=task_id), session_key or '', ex=STREAM_TTL)
+
+
+class StreamPublisher:
+
+    """
+    Publish the tokens of a reply on the Redis channel of its task, to be relayed to the browser by stream_application
+    """
+
+    def __init__(self, task_id: str, redis_client=None):
+        self.task_id = task_id
+        self.redis = redis_client or get_redis()
+
+        self.channel = STREAM_CHANNEL.format(task_id=task_id)
+        self.buffer = STREAM_BUFFER.format(task_id=task_id)
+
+        self.seq = 0
+
+    def publish(self, event: str, data) -> None:
+
+        self.seq += 1
+        payload = json.dumps({'seq': self.seq, 'event': event, 'data': data})
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(self.buffer, payload)
+        pipe.expire(self.buffer, STREAM_TTL)
+        pipe.publish(self.channel, payload)
+        pipe.execute()
+
+    def __call__(self, token: str) -> None:
+        self.publish('token', token)
+
+    def finish(self, error: str = None) -> None:
+
+        """
+        Tell the browser the reply is complete: the final message and state are fetched through the task result
+        """
+
+        self.publish('error' if error else 'done', error)
+
+
+def format_event(payload: dict) -> bytes:
+    return f"id: {payload['seq']}\nevent: {payload['event']}\ndata: {json.dumps(payload['data'])}\n\n".encode()
+
+
+def get_session_key(scope: dict) -> str or None:
+
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookie = SimpleCookie(value.decode('latin-1'))
+
+            if settings.SESSION_COOKIE_NAME in cookie:
+                return cookie[settings.SESSION_COOKIE_NAME].value
+
+    return None
+
+
+async def stream_application(scope, receive, send) -> None:
+
+    """
+    ASGI application serving the tokens of a task as Server-Sent Events on /therapy/stream/<task_id>/
+    """
+
+    task_id = STREAM_PATH.match(scope['path']).group('task_id')
+
+    redis_client = get_async_redis()
+
+    try:
+        owner = await redis_client.get(STREAM_OWNER.format(task_id=task_id))
+
+        if owner is None or owner.decode() != get_session_key(scope):
+            await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await send({'type': 'http.response.start',
+                    'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+
+        pubsub = redis_client.pubsub()
+        # Subscribe before replaying the buffer so no event is lost in between, duplicates are skipped by seq
+        await pubsub.subscribe(STREAM_CHANNEL.format(task_id=task_id))
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect() -> None:
+
+            # A GET first receives its (empty) request body, only http.disconnect means the browser left
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        last_seq = 0
+        deadline = time.monotonic() + STREAM_MAX_DURATION
+
+        async def forward(payload: dict) -> bool:
+
+            nonlocal last_seq
+
+            if payload['seq'] <= last_seq:
+                return False
+
+            last_seq = payload['seq']
+            await send({'type': 'http.response.body', 'body': format_event(payload), 'more_body': True})
+
+            return payload['event'] != 'token'
+
+        try:
+            finished = False
+
+            for raw in await redis_client.lrange(STREAM_BUFFER.format(task_id=task_id), 0, -1):
+                finished = await forward(json.loads(raw)) or finished
+
+            while not finished and time.monotonic() < deadline and not disconnected.is_set():
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+
+                if message is not None:
+                    finished = await forward(json.loads(message['data']))
+
+        finally:
+            watcher.cancel()
+            await pubsub.unsubscribe()
+            await pubsub.close()
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+    finally:
+        await redis_client.close()
@@ -0,0 +1,217 @@
+import asyncio
+import re
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Awaitable
+
+SUMMARY_PROMPT = 'Please summarize the following content in less than {words} words. Keep every fact, name, date ' \
+                 'and number that matters, and only answer with the summary.\n' \
+                 'CONTENT:\n{content}'
+
+WORDS_PER_TOKEN = 0.75
+MIN_CHUNK_TARGET = 64  # tokens, shorter summaries of a chunk lose too much
+
+PARAGRAPHS = re.compile(r'(?<=\n)')
+SENTENCES = re.compile(r'(?<=[.!?])\s+')
+
+SUMMARIZER_EXECUTOR = None  # Process-wide pool, created on first use. Not shared with the side queries, which call
+SUMMARIZER_EXECUTOR_LOCK = threading.Lock()  # the summarizer and would otherwise wait on their own pool
+
+
+def get_summarizer_executor(max_workers: int = 4) -> ThreadPoolExecutor:
+
+    global SUMMARIZER_EXECUTOR
+
+    if SUMMARIZER_EXECUTOR is None:
+        with SUMMARIZER_EXECUTOR_LOCK:
+            if SUMMARIZER_EXECUTOR is None:
+                SUMMARIZER_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summarizer')
+
+    return SUMMARIZER_EXECUTOR
+
+
+class Summarizer:
+
+    """
+    Map-reduce summarization: the content is split into chunks of at most chunk_tokens, the chunks are summarized in
+    parallel and their summaries joined, round after round until the content fits target_tokens or max_rounds is
+    reached. A round divides the length by at least 2, so the number of calls is bounded by the length of the content.
+
+    Chunks are packed greedily from the start on paragraph then sentence boundaries, and the target of a chunk is
+    rounded down to a power of two: when a text grows at its end (like the anamnesis), its first chunks and their
+    requests stay identical and their summaries are served by the response cache, only the tail is summarized again.
+
+    :param query: Sends the messages to the API with the given max_tokens and returns the answer's content, must be
+     deterministic (cached) for the chunk summaries to be reused
+    :param token_counter: Counts the tokens of a text
+    """
+
+    def __init__(self,
+                 query: Callable[[list[dict], int], str],
+                 token_counter: Callable[[str], int],
+                 chunk_tokens: int = 1024,
+                 max_rounds: int = 3,
+                 max_workers: int = 4):
+
+        self.query = query
+        self.get_token = token_counter
+        self.chunk_tokens = chunk_tokens
+        self.max_rounds = max_rounds
+        self.max_workers = max_workers
+
+    def split_units(self, content: str) -> list[str]:
+
+        """
+        Split on paragraphs, then sentences, then words, until every unit fits in a chunk
+        """
+
+        units = []
+
+        for paragraph in PARAGRAPHS.split(content):
+            if self.get_token(paragraph) <= self.chunk_tokens:
+                units.append(paragraph)
+                continue
+
+            for sentence in SENTENCES.split(paragraph):
+                if self.get_token(sentence) <= self.chunk_tokens:
+                    units.append(sentence + ' ')
+                    continue
+
+                words = sentence.split(' ')
+                step = max(1, int(self.chunk_tokens * WORDS_PER_TOKEN))
+                units.extend(' '.join(words[i:i + step]) + ' ' for i in range(0, len(words), step))
+
+        return [unit for unit in units if unit.strip()]
+
+    def split(self, content: str) -> list[str]:
+
+        """
+        Greedily pack the units of content into chunks of at most chunk_tokens
+        """
+
+        chunks = []
+        chunk = ''
+        chunk_tokens = 0
+
+        for unit in self.split_units(content):
+            unit_tokens = self.get_token(unit)
+
+            if chunk and chunk_tokens + unit_tokens > self.chunk_tokens:
+                chunks.append(chunk)
+                chunk, chunk_tokens = '', 0
+
+            chunk += unit
+            chunk_tokens += unit_tokens
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def chunk_target(self, n_chunks: int, content_tokens: int, target_tokens: int) -> int:
+
+        """
+        Target length of the summary of a chunk, rounded down to a power of two so it stays stable as content grows
+        """
+
+        if n_chunks == 1:
+            return target_tokens
+
+        proportional = max(MIN_CHUNK_TARGET, min(self.chunk_tokens // 2,
+                                                 target_tokens * self.chunk_tokens // content_tokens))
+
+        return 1 << (proportional.bit_length() - 1)
+
+    @staticmethod
+    def chunk_messages(chunk: str, target: int) -> list[dict]:
+        return [{'role': 'user',
+                 'content': SUMMARY_PROMPT.format(words=int(target * WORDS_PER_TOKEN), content=chunk)}]
+
+    def plan_round(self, content: str, content_tokens: int, target_tokens: int) -> tuple[list[str], int]:
+
+        chunks = self.split(content)
+
+        return chunks, self.chunk_target(len(chunks), content_tokens, target_tokens)
+
+    @staticmethod
+    def read_summary(chunk: str, summary) -> str:
+
+        if not isinstance(summary, str):
+            warnings.warn(f'Chunk could not be summarized ({summary}), keeping it as is.')
+            return chunk
+
+        return summary.strip() + '\n'
+
+    def summarize(self, content: str,
+                  target_tokens: int,
+                  return_process: bool = False) -> str or tuple[str, dict]:
+
+        """
+        :param content: Content to summarize
+        :param target_tokens: Maximum length of the summary
+        :param return_process: Also returns the tokens before and after each round, its number of chunks and of chunks
+         that couldn't be summarized (kept as they are)
+        """
+
+        content_tokens = self.get_token(content)
+        process = {}
+
+        i_round = 0
+        while content_tokens > target_tokens and i_round < self.max_rounds:
+            chunks, chunk_target = self.plan_round(content, content_tokens, target_tokens)
+
+            if len(chunks) == 1:
+                summaries = [self.query(self.chunk_messages(chunks[0], chunk_target), chunk_target)]
+            else:
+                executor = get_summarizer_executor(self.max_workers)
+                summaries = list(executor.map(lambda chunk: self.query(self.chunk_messages(chunk, chunk_target),
+                                                                       chunk_target),
+                                              chunks))
+
+            content = ''.join(self.read_summary(chunk, summary) for chunk, summary in zip(chunks, summaries)).strip()
+
+            new_content_tokens = self.get_token(content)
+            process[f'Round {i_round}'] = {'Query': content_tokens,
+                                           'Answer': new_content_tokens,
+                                           'Difference': content_tokens - new_content_tokens,
+                                           'Chunks': len(chunks),
+                                           'Failed': sum(not isinstance(summary, str) for summary in summaries)}
+
+            content_tokens = new_content_tokens
+            i_round += 1
+
+        return (content, process) if return_process else content
+
+    async def asummarize(self, content: str,
+                         target_tokens: int,
+                         return_process: bool = False,
+                         aquery: Callable[[list[dict], int], Awaitable[str]] = None) -> str or tuple[str, dict]:
+
+        """
+        Asynchronous summarize, the chunks of a round are summarized concurrently with aquery
+        """
+
+        content_tokens = self.get_token(content)
+        process = {}
+
+        i_round = 0
+        while content_tokens > target_tokens and i_round < self.max_rounds:
+            chunks, chunk_target = self.plan_round(content, content_tokens, target_tokens)
+
+            summaries = await asyncio.gather(*[aquery(self.chunk_messages(chunk, chunk_target), chunk_target)
+                                               for chunk in chunks])
+
+            content = ''.join(self.read_summary(chunk, summary) for chunk, summary in zip(chunks, summaries)).strip()
+
+            new_content_tokens = self.get_token(content)
+            process[f'Round {i_round}'] = {'Query': content_tokens,
+                                           'Answer': new_content_tokens,
+                                           'Difference': content_tokens - new_content_tokens,
+                                           'Chunks': len(chunks),
+                                           'Failed': sum(not isinstance(summary, str) for summary in summaries)}
+
+            content_tokens = new_content_tokens
+            i_round += 1
+
+        return (content, process) if return_process else content
@@ -1,17 +1,139 @@
 from __future__ import absolute_import, unicode_literals
+import warnings
 from celery import shared_task
-from .therapist import Therapy
-import json
+from celery.signals import task_postrun
+from .therapist import Therapy, PromptHandler, PARAPHRASE_POOL, SERVER_PARAMETERS, OPERATOR_API_KEY
+from .gpt_utils import GPT, APIQueryError, PRIORITY_BACKGROUND
+from .streaming import StreamPublisher
+from .redis_utils import get_redis
+from .state_store import get_state_store, StateConflict, StateNotFound
+from .therapy_pool import TherapyPool
 
+THERAPY_POOL_PARAMETERS = SERVER_PARAMETERS.get('therapy-pool', {})
 
-@shared_task
-def play_conversation_time_consuming(therapy_parameters, api_key, user_input):
+# Live Therapy objects of this worker process, see views.SESSION_RING for the routing of the sessions
+THERAPY_POOL = TherapyPool(max_objects=THERAPY_POOL_PARAMETERS.get('max-objects', 64),
+                           max_memory=THERAPY_POOL_PARAMETERS.get('max-memory-mb', 64) * 1024 * 1024,
+                           idle_timeout=THERAPY_POOL_PARAMETERS.get('idle-timeout', 900))
 
-    if isinstance(therapy_parameters, str):
-        therapy_parameters = json.loads(therapy_parameters)
+TASK_DONE_CHANNEL = 'therapy:task-done:{task_id}'
 
-    therapy_object = Therapy(api_key=api_key)
-    therapy_object.update_parameters(therapy_parameters)
 
-    return {'assistant_message': therapy_object.play_conversation(user_input),
-            'therapy_parameters': therapy_object.get_parameters()}
+def checkout_therapy(store, session_id: str):
+
+    """
+    :return: The live Therapy of a session, from the pool or rebuilt from the store, and the version of its state
+    """
+
+    version = store.get_version(session_id)
+
+    therapy_object = THERAPY_POOL.checkout(session_id, version)
+
+    if therapy_object is None:
+        therapy_parameters, version = store.load(session_id)
+
+        therapy_object = Therapy(api_key=therapy_parameters['api_key'])
+        therapy_object.update_parameters(therapy_parameters)
+
+    therapy_object.session_id = session_id
+
+    return therapy_object, version
+
+
+def commit_therapy(store, session_id: str, therapy_object, version: int) -> None:
+
+    # Only the new messages and the changed fields are written back
+    new_version = store.apply_delta(session_id, therapy_object.get_delta())
+
+    therapy_object.stream_callback = None
+    therapy_object.mark_committed()
+
+    # The object matches the stored state only if nobody else wrote it meanwhile
+    if new_version == version + 1:
+        THERAPY_POOL.checkin(session_id, therapy_object, new_version)
+
+
+@shared_task(bind=True)
+def play_conversation_time_consuming(self, session_id, user_input, stream=False):
+
+    # The state is loaded from and committed to the state store, only the session id travels through the broker
+    store = get_state_store()
+
+    therapy_object, version = checkout_therapy(store, session_id)
+
+    publisher = StreamPublisher(self.request.id) if stream else None
+    therapy_object.stream_callback = publisher
+
+    try:
+        assistant_message = therapy_object.play_conversation(user_input)
+
+        commit_therapy(store, session_id, therapy_object, version)
+
+    except Exception as e:
+        if publisher is not None:
+            publisher.finish(error=str(e))
+        raise
+
+    if publisher is not None:
+        publisher.finish()
+
+    # Old turns are summarized after the reply, on the same queue so the pooled object is reused
+    if therapy_object.MSG_Handler.memory.pending_work(len(therapy_object.MSG_Handler.conversation)):
+        fold_conversation_memory.apply_async(args=(session_id,),
+                                             queue=(self.request.delivery_info or {}).get('routing_key'))
+
+    return {'assistant_message': assistant_message}
+
+
+@shared_task(ignore_result=True)
+def fold_conversation_memory(session_id):
+
+    store = get_state_store()
+
+    therapy_object, version = checkout_therapy(store, session_id)
+
+    if not therapy_object.fold_memory():
+        THERAPY_POOL.checkin(session_id, therapy_object, version)
+        return
+
+    try:
+        commit_therapy(store, session_id, therapy_object, version)
+
+    except StateConflict:
+        # A turn was committed meanwhile: the memory is folded again after the next turn
+        return
+
+
+@task_postrun.connect(sender=play_conversation_time_consuming)
+def notify_task_done(task_id=None, state=None, **kwargs):
+
+    # Sent once the result is stored in the backend: wakes up the long-polling wait_task_status requests
+    get_redis().publish(TASK_DONE_CHANNEL.format(task_id=task_id), state or '')
+
+
+@shared_task(ignore_result=True)
+def refill_paraphrase_pool(prompt_type, prompt_name, session_id=None):
+
+    api_key = OPERATOR_API_KEY
+
+    if api_key is None and session_id is not None:
+        try:
+            api_key = get_state_store().load(session_id)[0]['api_key']
+        except StateNotFound:
+            pass
+
+    # The refill lock expires by itself
+    if api_key is None:
+        return
+
+    content = PromptHandler().get_prompt_content(prompt_type=prompt_type, prompt_name=prompt_name)
+
+    gpt = GPT(api_key=api_key)
+
+    try:
+        PARAPHRASE_POOL.fill(prompt_type, prompt_name, content,
+                             query=lambda prompt: gpt.query_API([{'role': 'user', 'content': prompt}],
+                                                                key_to_protect='Please',
+                                                                rate_priority=PRIORITY_BACKGROUND))
+    except APIQueryError as e:
+        warnings.warn(f'Paraphrase pool {prompt_type}/{prompt_name} not refilled: {e}')
@@ -1,3 +1,1328 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock, skipIf
+
+import openai
+from django.test import SimpleTestCase, TestCase
+
+from . import gpt_utils
+from .async_gpt import AsyncGPT, ClientPool
+from .circuit_breaker import CircuitBreaker
+from .gpt_utils import MessagesHandler, pack_messages, PRIORITY_PINNED
+from . import state_codec, tasks
+from .paraphrase_pool import ParaphrasePool, NAME_TAG, personalize
+from .rate_limiter import RateLimiter, PRIORITY_INTERACTIVE, PRIORITY_SIDE, PRIORITY_BACKGROUND
+from .response_cache import ResponseCache, CACHE_PREFIX
+from .resilience import APICaller, APIQueryError, is_retryable
+from .retrieval import GuidelineIndex
+from .summarizer import Summarizer
+from .user_info_extractor import UserInfoExtractor
+from .therapist import Therapy
+from .therapy_pool import TherapyPool, SessionRing, BASE_OBJECT_SIZE
+from .state_store import (MemoryStateStore, RedisStateStore, DatabaseStateStore, StateConflict, StateNotFound,
+                          TherapyStateStore, apply_delta)
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import lupa  # Runs the Lua scripts of fakeredis
+except ImportError:
+    lupa = None
+
+
+class WordEncoder:
+
+    """
+    Tokenizer of the tests, a token per word, so they don't download the tiktoken encodings
+    """
+
+    @staticmethod
+    def encode_ordinary(text: str) -> list[str]:
+        return text.split()
+
+    def encode_ordinary_batch(self, texts: list[str]) -> list[list[str]]:
+        return [self.encode_ordinary(text) for text in texts]
+
+
+def therapy_parameters() -> dict:
+
+    return {'api_key': 'sk-test',
+            'model': 'gpt-4',
+            'anamnesis': 'not_defined',
+            'therapy_informations': {'type': 'CBT', 'guidelines': 'not_defined'},
+            'conversation': [{'role': 'system', 'content': 'You are a therapist.', 'tokens': 4},
+                             {'role': 'user', 'content': 'Ça va mal 🙁', 'tokens': 5, 'time': '12:00'},
+                             {'role': 'assistant', 'content': '', 'command': 'continue_conversation'}]}
+
+
+class EncoderTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(gpt_utils.ENCODERS, {'gpt-4': WordEncoder(), 'gpt-3.5-turbo': WordEncoder()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class MessagesWindowTests(EncoderTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        rng = random.Random(4)
+
+        self.handler = MessagesHandler()
+        self.handler.load_conversation([{'role': 'user', 'content': ' '.join(['word'] * rng.randint(1, 30))}
+                                        for _ in range(60)])
+
+    def expected_window(self, start: int, end: int, token_limit: int) -> list[dict]:
+
+        window = []
+        tokens = 0
+        for message in reversed(self.handler.conversation[start:end]):
+            if tokens + message['tokens'] >= token_limit:
+                break
+
+            window.insert(0, message)
+            tokens += message['tokens']
+
+        return window
+
+    def test_window_matches_a_linear_scan(self):
+        for start, end, token_limit in ((0, 60, 100), (10, 40, 57), (0, 60, 1), (5, 5, 100), (0, 60, 10000),
+                                        (30, 80, 200), (0, 60, 0)):
+            self.assertEqual(self.handler.get_messages_window(start, end, token_limit),
+                             self.expected_window(start, end, token_limit), (start, end, token_limit))
+
+    def test_created_messages_are_indexed(self):
+        self.handler.create_message('assistant', 'one two three', time=False)
+
+        self.assertEqual(self.handler.conversation[-1]['tokens'], 3)
+        self.assertEqual(self.handler.get_last_messages(token_limit=4), self.handler.conversation[-1:])
+        self.assertEqual(self.handler.tokens_between(60, 61), 3)
+
+    def test_index_follows_a_conversation_modified_in_place(self):
+        self.handler.conversation.append({'role': 'user', 'content': 'a b', 'tokens': 2})
+
+        self.assertEqual(self.handler.tokens_between(0, 61),
+                         sum(message['tokens'] for message in self.handler.conversation))
+        self.assertEqual(self.handler.get_messages_window(0, 61, 3), self.handler.conversation[-1:])
+
+
+class PackMessagesTests(EncoderTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # 14 tokens each with the chat format
+        self.messages = [{'role': 'system', 'content': 'system', 'tokens': 10},
+                         {'role': 'user', 'content': 'CONTEXT of the client', 'tokens': 10},
+                         {'role': 'user', 'content': 'old summary', 'tokens': 10, 'priority': 1},
+                         {'role': 'assistant', 'content': 'old reply', 'tokens': 10},
+                         {'role': 'user', 'content': 'recent message', 'tokens': 10},
+                         {'role': 'user', 'content': 'recent summary', 'tokens': 10, 'priority': 1}]
+
+    def contents(self, messages: list[dict]) -> list[str]:
+        return [message['content'] for message in messages]
+
+    def test_messages_fitting_are_kept(self):
+        packing = pack_messages(self.messages, budget=100)
+
+        self.assertEqual(packing.messages, [{'role': message['role'], 'content': message['content']}
+                                            for message in self.messages])
+        self.assertEqual((packing.tokens, packing.dropped, packing.dropped_tokens), (84, [], 0))
+
+    def test_lowest_priorities_and_oldest_messages_are_dropped_first(self):
+        packing = pack_messages(self.messages, budget=70, answer_reserve=10)
+
+        self.assertEqual(self.contents(packing.dropped), ['old reply', 'recent message'])
+        self.assertEqual((packing.tokens, packing.dropped_tokens), (56, 28))
+
+        packing = pack_messages(self.messages, budget=40)
+
+        self.assertEqual(self.contents(packing.messages), ['system', 'CONTEXT of the client'])
+        self.assertEqual(packing.tokens, 28)
+
+    def test_pinned_messages_are_never_dropped(self):
+        messages = self.messages + [{'role': 'user', 'content': 'CONTEXT again', 'tokens': 10},
+                                    {'role': 'user', 'content': 'pinned', 'tokens': 10, 'priority': PRIORITY_PINNED}]
+
+        with self.assertWarns(UserWarning):
+            packing = pack_messages(messages, budget=20)
+
+        # Only the first message with the key is protected
+        self.assertEqual(self.contents(packing.messages), ['system', 'CONTEXT of the client', 'pinned'])
+
+    def test_messages_without_their_count_are_tokenized(self):
+        packing = pack_messages([{'role': 'user', 'content': 'three more words'}], budget=100)
+
+        self.assertEqual(packing.tokens, 7)
+
+
+@skipIf(fakeredis is None or lupa is None, 'fakeredis and lupa are needed to run the Lua scripts')
+class RateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.limiter = RateLimiter({'gpt-4': {'rpm': 60, 'tpm': 1000}},
+                                   max_wait={PRIORITY_INTERACTIVE: 10, PRIORITY_SIDE: 0, PRIORITY_BACKGROUND: 0},
+                                   redis_factory=lambda: self.redis)
+
+    def bucket(self, field: str) -> float:
+        return float(self.redis.hget(RateLimiter.bucket_key('key', 'gpt-4'), field))
+
+    def test_admitted_request_takes_its_tokens(self):
+        admission = self.limiter.acquire('key', 'gpt-4', 300, priority=PRIORITY_INTERACTIVE)
+
+        self.assertEqual((admission.admitted, admission.tokens, admission.waited), (True, 300, 0.0))
+        self.assertAlmostEqual(self.bucket('tokens'), 700, delta=5)
+        self.assertAlmostEqual(self.bucket('requests'), 59, delta=0.5)
+
+    def test_oversized_request_takes_what_its_priority_can(self):
+        admission = self.limiter.acquire('key', 'gpt-4', 5000, priority=PRIORITY_SIDE)
+
+        # 10% of the bucket is reserved for the interactive calls
+        self.assertEqual((admission.admitted, admission.tokens), (True, 900))
+
+        # The correction is against the 900 tokens taken, not the estimate
+        self.limiter.adjust('key', 'gpt-4', admission.tokens, 950)
+        self.assertAlmostEqual(self.bucket('tokens'), 50, delta=5)
+
+    def test_request_sent_after_max_wait_takes_its_tokens(self):
+        self.limiter.acquire('key', 'gpt-4', 900, priority=PRIORITY_INTERACTIVE)
+
+        admission = self.limiter.acquire('key', 'gpt-4', 500, priority=PRIORITY_BACKGROUND)
+
+        self.assertEqual((admission.admitted, admission.tokens), (False, 500))
+        self.assertAlmostEqual(self.bucket('tokens'), -400, delta=5)
+
+        self.limiter.adjust('key', 'gpt-4', admission.tokens, 200)
+        self.assertAlmostEqual(self.bucket('tokens'), -100, delta=5)
+
+        stats = self.limiter.fleet_stats()['gpt-4']
+        self.assertEqual((stats['interactive']['requests'], stats['interactive']['timeouts']), (1, 0))
+        self.assertEqual((stats['background']['requests'], stats['background']['timeouts']), (1, 1))
+
+    def test_waiting_request_takes_nothing(self):
+        self.limiter.acquire('key', 'gpt-4', 900, priority=PRIORITY_INTERACTIVE)
+
+        wait_ms, taken = self.limiter._scripts[0](keys=[RateLimiter.bucket_key('key', 'gpt-4'),
+                                                        RateLimiter.stats_key('gpt-4')],
+                                                  args=[60, 1000, 500, 0.3, 120000, 'background', 0, 0])
+
+        self.assertGreater(wait_ms, 0)
+        self.assertEqual(taken, 0)
+        self.assertAlmostEqual(self.bucket('tokens'), 100, delta=5)
+
+    def test_unlimited_model(self):
+        admission = self.limiter.acquire('key', 'gpt-3.5-turbo', 300)
+
+        self.assertEqual((admission.admitted, admission.tokens), (True, 0))
+        self.assertFalse(self.redis.keys())
+
+
+@skipIf(fakeredis is None or lupa is None, 'fakeredis and lupa are needed to run the Lua scripts')
+class CircuitBreakerTests(EncoderTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.redis = fakeredis.FakeRedis()
+        self.breaker = CircuitBreaker(min_calls=4, max_error_rate=0.5, max_slow_rate=0.5, latency_slo=1.0,
+                                      seconds_per_token=0.01, open_seconds=0.1, probe_interval=0.1,
+                                      probe_successes=2, redis_factory=lambda: self.redis)
+
+    def open(self) -> None:
+        for _ in range(4):
+            self.breaker.record('gpt-4', 0.1, error=openai.error.Timeout('slow'))
+
+    def probe(self) -> None:
+        time.sleep(0.11)
+        self.assertTrue(self.breaker.allow('gpt-4'))
+
+    def test_breaker_opens_on_the_error_rate_past_min_calls(self):
+        for _ in range(3):
+            self.breaker.record('gpt-4', 0.1, error=openai.error.APIConnectionError('reset'))
+
+        self.assertTrue(self.breaker.allow('gpt-4'))
+
+        self.breaker.record('gpt-4', 0.1, error=openai.error.ServiceUnavailableError('overloaded'))
+
+        self.assertFalse(self.breaker.allow('gpt-4'))
+        self.assertEqual(self.breaker.status('gpt-4'),
+                         {'state': 'open', 'opened': 1, 'calls': 4, 'error_rate': 1.0, 'slow_rate': 0.0})
+
+        # The other models have their own breaker
+        self.assertTrue(self.breaker.allow('gpt-3.5-turbo'))
+
+    def test_breaker_opens_on_the_slow_rate(self):
+        # Within the SLO with the time of their 100 tokens
+        for _ in range(4):
+            self.breaker.record('gpt-4', 1.5, tokens=100)
+
+        self.assertTrue(self.breaker.allow('gpt-4'))
+
+        for _ in range(4):
+            self.breaker.record('gpt-4', 1.5)
+
+        self.assertFalse(self.breaker.allow('gpt-4'))
+        self.assertEqual(self.breaker.status('gpt-4')['slow_rate'], 0.5)
+
+    def test_errors_of_the_request_are_not_counted(self):
+        for error in (openai.error.InvalidRequestError('too long', 'messages'), openai.error.RateLimitError('slow'),
+                      openai.error.AuthenticationError('invalid key')) * 2:
+            self.breaker.record('gpt-4', 0.1, error=error)
+
+        self.assertEqual(self.breaker.status('gpt-4')['calls'], 0)
+
+    def test_half_open_breaker_lets_a_probe_through_every_interval(self):
+        self.open()
+        self.assertFalse(self.breaker.allow('gpt-4'))
+
+        self.probe()
+        self.assertEqual(self.breaker.status('gpt-4')['state'], 'half-open')
+        self.assertFalse(self.breaker.allow('gpt-4'))
+
+        self.probe()
+
+    def test_breaker_closes_after_probe_successes(self):
+        self.open()
+        self.probe()
+
+        self.breaker.record('gpt-4', 0.1)
+        self.assertEqual(self.breaker.status('gpt-4')['state'], 'half-open')
+
+        self.breaker.record('gpt-4', 0.1)
+
+        # The outage is forgotten, the times the breaker opened are kept
+        self.assertEqual(self.breaker.status('gpt-4'),
+                         {'state': 'closed', 'opened': 1, 'calls': 0, 'error_rate': 0.0, 'slow_rate': 0.0})
+        self.assertTrue(self.breaker.allow('gpt-4'))
+
+        self.open()
+        self.assertEqual(self.breaker.status('gpt-4')['opened'], 2)
+
+    def test_bad_probe_opens_the_breaker_again(self):
+        self.open()
+        self.probe()
+
+        self.breaker.record('gpt-4', 0.1)
+        self.breaker.record('gpt-4', 5.0)
+
+        self.assertEqual(self.breaker.status('gpt-4')['state'], 'open')
+        self.assertFalse(self.breaker.allow('gpt-4'))
+
+        self.probe()
+
+    def test_turns_run_on_the_fast_model_while_the_breaker_is_open(self):
+        therapy = Therapy(api_key='sk-test')
+        limits = therapy.max_token_per_message, therapy.anamnesis_length, therapy.max_token_answer
+        turns = []
+
+        def play_turn(message: str) -> str:
+            turns.append((therapy.on_fast_model, therapy.max_token_per_message, therapy.max_token_answer))
+
+            if message == 'fail':
+                raise APIQueryError('down')
+
+            return 'reply'
+
+        self.open()
+
+        with mock.patch('therapy.therapist.CIRCUIT_BREAKER', self.breaker), \
+                mock.patch.object(therapy, 'play_turn', side_effect=play_turn):
+            self.assertEqual(therapy.play_conversation('hello'), 'reply')
+
+            with self.assertRaises(APIQueryError):
+                therapy.play_conversation('fail')
+
+            # Closed again
+            self.redis.flushall()
+            therapy.play_conversation('hello')
+
+        self.assertEqual(turns, [(True, 4096, 1024), (True, 4096, 1024), (False, limits[0], limits[2])])
+
+        # The limits of the session are restored
+        self.assertFalse(therapy.degraded)
+        self.assertEqual((therapy.max_token_per_message, therapy.anamnesis_length, therapy.max_token_answer), limits)
+
+
+class StateStoreTestsMixin:
+
+    def make_store(self) -> TherapyStateStore:
+        raise NotImplementedError
+
+    def setUp(self):
+        super().setUp()
+
+        self.store = self.make_store()
+        self.store.create('session', therapy_parameters())
+
+    def test_load_returns_the_created_state(self):
+        self.assertEqual(self.store.load('session'), (therapy_parameters(), 1))
+        self.assertEqual(self.store.get_version('session'), 1)
+
+    def test_commit_of_a_stale_version_conflicts(self):
+        parameters, version = self.store.load('session')
+
+        parameters['model'] = 'gpt-3.5-turbo'
+        self.assertEqual(self.store.commit('session', parameters, version), 2)
+
+        with self.assertRaises(StateConflict):
+            self.store.commit('session', dict(parameters, model='gpt-4'), version)
+
+        self.assertEqual(self.store.load('session')[0]['model'], 'gpt-3.5-turbo')
+
+    def test_update_retries_on_conflicts(self):
+        calls = []
+
+        def function(parameters: dict):
+            calls.append(1)
+
+            # Another process commits between the first load and its commit
+            if len(calls) == 1:
+                self.store.commit('session', dict(parameters, anamnesis='concurrent'), 1)
+
+            parameters['model'] = 'gpt-3.5-turbo'
+
+        self.store.update('session', function)
+
+        parameters, version = self.store.load('session')
+        self.assertEqual((parameters['model'], parameters['anamnesis'], version, len(calls)),
+                         ('gpt-3.5-turbo', 'concurrent', 3, 2))
+
+    def test_delta_keeps_the_fields_it_did_not_change(self):
+        # The web tier changes the API key while the turn runs
+        self.store.update('session', lambda parameters: parameters.update(api_key='sk-new'))
+
+        message = {'role': 'user', 'content': 'New message', 'tokens': 2}
+        version = self.store.apply_delta('session', {'base_length': 3, 'messages': [message],
+                                                     'fields': {'anamnesis': 'Anxious client'}})
+
+        parameters, stored_version = self.store.load('session')
+        self.assertEqual((version, stored_version), (3, 3))
+        self.assertEqual(parameters['conversation'], therapy_parameters()['conversation'] + [message])
+        self.assertEqual((parameters['api_key'], parameters['anamnesis']), ('sk-new', 'Anxious client'))
+
+    def test_delta_of_another_base_conflicts(self):
+        delta = {'base_length': 2, 'messages': [{'role': 'user', 'content': 'Late'}], 'fields': {'model': 'x'}}
+
+        with self.assertRaises(StateConflict):
+            self.store.apply_delta('session', delta)
+
+        self.assertEqual(self.store.load('session'), (therapy_parameters(), 1))
+
+    def test_missing_session(self):
+        self.store.delete('session')
+
+        with self.assertRaises(StateNotFound):
+            self.store.load('session')
+
+        with self.assertRaises(StateNotFound):
+            self.store.get_version('session')
+
+        with self.assertRaises(StateNotFound):
+            self.store.commit('session', therapy_parameters(), 1)
+
+
+class ApplyDeltaTests(SimpleTestCase):
+
+    def test_delta_is_applied_in_place(self):
+        parameters = therapy_parameters()
+        message = {'role': 'assistant', 'content': 'Hello', 'tokens': 1}
+
+        self.assertIs(apply_delta(parameters, {'base_length': 3, 'messages': [message], 'fields': {'model': 'x'}}),
+                      parameters)
+        self.assertEqual((parameters['conversation'][-1], parameters['model']), (message, 'x'))
+
+    def test_delta_of_another_base_conflicts(self):
+        with self.assertRaises(StateConflict):
+            apply_delta(therapy_parameters(), {'base_length': 4, 'messages': [], 'fields': {}})
+
+
+class StateCodecTests(SimpleTestCase):
+
+    def test_state_round_trip(self):
+        parameters = therapy_parameters()
+
+        for compress in (False, True):
+            data = state_codec.encode_state(parameters, compress=compress)
+
+            self.assertEqual(state_codec.decode_state(data), parameters)
+
+        # Only the bodies large enough are compressed
+        self.assertFalse(state_codec.HEADER.unpack_from(data)[2] & state_codec.FLAG_ZLIB)
+
+        parameters['conversation'] *= 100
+        data = state_codec.encode_state(parameters)
+
+        self.assertTrue(state_codec.HEADER.unpack_from(data)[2] & state_codec.FLAG_ZLIB)
+        self.assertEqual(state_codec.decode_state(data), parameters)
+
+    def test_messages_round_trip(self):
+        messages = therapy_parameters()['conversation']
+
+        for batch in (messages, []):
+            data = b'prefix' + state_codec.encode_messages(batch)
+
+            self.assertEqual(state_codec.decode_messages(data, 6), (batch, len(data)))
+
+        for message in messages:
+            self.assertEqual(state_codec.loads_message(state_codec.encode_message(message)), message)
+            self.assertEqual(state_codec.loads_message(json.dumps(message).encode()), message)
+
+    def test_json_states_are_decoded(self):
+        parameters = therapy_parameters()
+
+        self.assertEqual(state_codec.decode_state(json.dumps(parameters)), parameters)
+        self.assertEqual(state_codec.decode_state(json.dumps(parameters).encode()), parameters)
+
+    def test_guidelines_are_stored_as_a_reference(self):
+        guidelines = {'CBT': 'The CBT guidelines'}
+        parameters = therapy_parameters()
+        parameters['therapy_informations']['guidelines'] = guidelines['CBT']
+
+        data = state_codec.encode_state(parameters, resolver=guidelines.get)
+
+        self.assertNotIn(b'The CBT guidelines', data)
+        self.assertEqual(state_codec.decode_state(data, resolver=guidelines.get), parameters)
+
+        with self.assertWarns(UserWarning):
+            decoded = state_codec.decode_state(data, resolver={'CBT': 'New guidelines'}.get)
+        self.assertEqual(decoded['therapy_informations']['guidelines'], 'New guidelines')
+
+        with self.assertRaises(state_codec.StateCodecError):
+            state_codec.decode_state(data, resolver={}.get)
+
+        # Edited guidelines are kept inline
+        parameters['therapy_informations']['guidelines'] = 'Edited guidelines'
+        data = state_codec.encode_state(parameters, resolver=guidelines.get)
+
+        self.assertEqual(state_codec.decode_state(data, resolver={}.get), parameters)
+
+    def test_invalid_states(self):
+        data = state_codec.encode_state(therapy_parameters())
+
+        with self.assertRaises(state_codec.StateCodecError):
+            state_codec.decode_state(b'XYZ' + data[3:])
+
+        with self.assertRaises(state_codec.StateCodecError):
+            state_codec.decode_state(state_codec.HEADER.pack(state_codec.MAGIC, state_codec.CODEC_VERSION + 1, 0)
+                                     + data[state_codec.HEADER.size:])
+
+
+class MemoryStateStoreTests(StateStoreTestsMixin, SimpleTestCase):
+
+    def make_store(self) -> TherapyStateStore:
+        return MemoryStateStore()
+
+
+@skipIf(fakeredis is None, 'fakeredis is needed to test the Redis store')
+class RedisStateStoreTests(StateStoreTestsMixin, SimpleTestCase):
+
+    def make_store(self) -> TherapyStateStore:
+        return RedisStateStore(ttl=60, redis_client=fakeredis.FakeRedis())
+
+
+class DatabaseStateStoreTests(StateStoreTestsMixin, TestCase):
+
+    def make_store(self) -> TherapyStateStore:
+        return DatabaseStateStore()
+
+
+def pooled_therapy(content: str = '') -> SimpleNamespace:
+    return SimpleNamespace(MSG_Handler=SimpleNamespace(conversation=[{'role': 'user', 'content': content}]))
+
+
+class TherapyPoolTests(SimpleTestCase):
+
+    def test_therapy_is_handed_out_at_its_version_only(self):
+        pool = TherapyPool()
+        therapy = pooled_therapy()
+
+        pool.checkin('session', therapy, 2)
+        self.assertIs(pool.checkout('session', 2), therapy)
+
+        # Checked out exclusively
+        self.assertIsNone(pool.checkout('session', 2))
+
+        pool.checkin('session', therapy, 2)
+        self.assertIsNone(pool.checkout('session', 3))
+        self.assertEqual(len(pool), 0)
+
+        self.assertEqual(pool.stats, {'hits': 1, 'misses': 1, 'stale': 1, 'evictions': 0})
+
+    def test_least_recently_used_are_evicted(self):
+        pool = TherapyPool(max_objects=2)
+
+        for session_id in ('a', 'b', 'c'):
+            pool.checkin(session_id, pooled_therapy(), 1)
+
+        self.assertIsNone(pool.checkout('a', 1))
+        self.assertIsNotNone(pool.checkout('b', 1))
+        self.assertEqual(pool.stats['evictions'], 1)
+
+    def test_pool_is_bounded_in_memory(self):
+        pool = TherapyPool(max_memory=2 * BASE_OBJECT_SIZE + 1000)
+
+        pool.checkin('a', pooled_therapy(), 1)
+        pool.checkin('b', pooled_therapy('x' * 1000), 1)
+
+        self.assertEqual((len(pool), pool.memory), (1, BASE_OBJECT_SIZE + 2000))
+
+        pool.discard('b')
+        self.assertEqual((len(pool), pool.memory), (0, 0))
+
+    def test_idle_therapies_are_evicted(self):
+        pool = TherapyPool(idle_timeout=60)
+
+        with mock.patch('therapy.therapy_pool.time.monotonic', return_value=1000.0):
+            pool.checkin('a', pooled_therapy(), 1)
+
+        with mock.patch('therapy.therapy_pool.time.monotonic', return_value=1061.0):
+            self.assertIsNone(pool.checkout('a', 1))
+
+        self.assertEqual(pool.stats['evictions'], 1)
+
+
+class SessionRingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sessions = [f'session-{i}' for i in range(2000)]
+
+    def test_sessions_are_spread_over_the_queues(self):
+        ring = SessionRing(['therapy.0', 'therapy.1', 'therapy.2', 'therapy.3'])
+
+        counts = Counter(ring.get_queue(session_id) for session_id in self.sessions)
+
+        self.assertEqual(set(counts), set(ring.queues))
+        self.assertGreater(min(counts.values()), len(self.sessions) / 4 * 0.7)
+        self.assertEqual(ring.get_queue('session-1'), SessionRing(list(reversed(ring.queues))).get_queue('session-1'))
+
+    def test_only_the_sessions_of_a_changed_queue_move(self):
+        queues = ['therapy.0', 'therapy.1', 'therapy.2', 'therapy.3']
+
+        ring, removed, added = SessionRing(queues), SessionRing(queues[:3]), SessionRing(queues + ['therapy.4'])
+
+        for session_id in self.sessions:
+            queue = ring.get_queue(session_id)
+
+            if queue != 'therapy.3':
+                self.assertEqual(removed.get_queue(session_id), queue)
+
+            if added.get_queue(session_id) != 'therapy.4':
+                self.assertEqual(added.get_queue(session_id), queue)
+
+    def test_no_queue(self):
+        self.assertIsNone(SessionRing([]).get_queue('session'))
+
+
+class GuidelineIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.corpus_dir = os.path.join(directory.name, 'corpus')
+        os.makedirs(self.corpus_dir)
+
+        self.write('CBT', 'Cognitive restructuring helps the client challenge automatic negative thoughts.\n'
+                          'Behavioral activation schedules pleasant activities to fight depression.\n'
+                          'Exposure therapy reduces anxiety through gradual confrontation with feared situations.')
+        self.write('DBT', 'Distress tolerance skills help the client survive crises without making them worse.\n'
+                          'Mindfulness teaches the client to observe emotions without judgement.')
+
+        # A passage per line
+        self.index = GuidelineIndex(self.corpus_dir, os.path.join(directory.name, 'index'),
+                                    token_counter=lambda text: len(text.split()), passage_tokens=12,
+                                    check_interval=0)
+
+    def write(self, name: str, text: str) -> None:
+
+        path = os.path.join(self.corpus_dir, name)
+
+        with open(path, 'w') as f:
+            f.write(text)
+
+        # A new modification time even on filesystems with a coarse clock
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+
+    def texts(self, passages: list) -> list[str]:
+        return [passage.text.split()[0] for passage in passages]
+
+    def test_best_passages_in_the_order_of_the_corpus(self):
+        self.assertEqual(self.texts(self.index.select('anxiety in feared situations', source='CBT', k=1)),
+                         ['Exposure'])
+        self.assertEqual(self.texts(self.index.select('depression and negative thoughts', source='CBT', k=2)),
+                         ['Cognitive', 'Behavioral'])
+        self.assertEqual(self.texts(self.index.select('observe the emotions', k=1)), ['Mindfulness'])
+
+    def test_selection_fits_the_token_budget(self):
+        passages = self.index.select('depression and negative thoughts', source='CBT', k=2, token_budget=10)
+
+        self.assertEqual(len(passages), 1)
+        self.assertLessEqual(passages[0].tokens, 10)
+
+    def test_first_passages_of_the_source_without_a_match(self):
+        self.assertEqual(self.texts(self.index.select('anxiety', source='DBT', k=1)), ['Distress'])
+        self.assertEqual(self.index.select('anxiety', source='Psychodynamic'), [])
+
+    def test_index_is_rebuilt_when_the_corpus_changes(self):
+        self.assertEqual(self.texts(self.index.select('sleep hygiene', source='DBT', k=1)), ['Distress'])
+        self.assertTrue(os.path.islink(self.index.index_dir))
+
+        self.write('DBT', 'Sleep hygiene keeps regular hours.')
+
+        self.assertEqual(self.texts(self.index.select('sleep hygiene', source='DBT', k=1)), ['Sleep'])
+
+
+class UserInfoExtractorTests(SimpleTestCase):
+
+    fields = ['name', 'age', 'gender', 'occupation', 'language', 'marital_status']
+
+    def extract(self, message: str, asked_keys: list[str] = ()) -> dict:
+        return UserInfoExtractor().extract(message, list(asked_keys), self.fields)
+
+    def test_numbered_answers(self):
+        self.assertEqual(self.extract('1. Anna\n2) 34 years\n3: F\n4 - english and French, some german',
+                                      ['name', 'age', 'gender', 'language']),
+                         {'name': 'Anna', 'age': 34, 'gender': 'female', 'language': 'English, French, German'})
+
+    def test_labeled_and_unnumbered_answers(self):
+        self.assertEqual(self.extract('Age: 52\nMarital status: widow'),
+                         {'age': 52, 'marital_status': 'widowed'})
+        self.assertEqual(self.extract('Tom\nnurse', ['name', 'occupation']),
+                         {'name': 'Tom', 'occupation': 'nurse'})
+
+    def test_patterns_of_free_text(self):
+        self.assertEqual(self.extract("Hi, my name is John Smith. I'm 34 years old and I work as a software engineer, "
+                                      "I'm married and I speak English."),
+                         {'name': 'John Smith', 'age': 34, 'occupation': 'software engineer',
+                          'marital_status': 'married', 'language': 'English'})
+
+    def test_refusals(self):
+        self.assertEqual(self.extract("1. prefer not to say\n2. I'd rather not", ['name', 'gender']),
+                         {'name': 'NA', 'gender': 'NA'})
+
+    def test_values_are_kept_as_given_only_when_asked(self):
+        self.assertEqual(self.extract('Gender: it depends'), {'gender': 'it depends'})
+        self.assertEqual(self.extract('I am 5 minutes late'), {})
+
+    def test_words_continued_by_a_hyphen_are_not_values(self):
+        self.assertEqual(self.extract('I am single-handedly raising my kids.'), {})
+        self.assertEqual(self.extract("I'm a man-child, I know."), {})
+        self.assertEqual(self.extract("I'm single, and I'm a woman."), {'marital_status': 'single', 'gender': 'female'})
+
+    def test_only_the_fields_looked_for(self):
+        self.assertEqual(UserInfoExtractor().extract('My name is Lea, I am 29', [], ['age']), {'age': 29})
+
+
+class APICallerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.caller = APICaller(backoff_base=0.001, backoff_max=0.01, hedge_min_delay=0.05, hedge_max_ratio=1.0)
+        self.attempts = []
+
+    def failing(self, *errors: Exception):
+
+        def send(timeout: float) -> str:
+            self.attempts.append(timeout)
+
+            if len(self.attempts) <= len(errors):
+                raise errors[len(self.attempts) - 1]
+
+            return 'answer'
+
+        return send
+
+    def test_transient_errors_are_retried(self):
+        send = self.failing(openai.error.Timeout('slow'), openai.error.APIError('bad gateway', http_status=502))
+
+        with self.assertWarns(UserWarning):
+            self.assertEqual(self.caller.call(send, timeout=5), 'answer')
+
+        self.assertEqual(len(self.attempts), 3)
+
+    def test_other_errors_fail_at_once(self):
+        with self.assertRaises(APIQueryError) as context:
+            self.caller.call(self.failing(openai.error.InvalidRequestError('too long', 'messages')), timeout=5)
+
+        self.assertIsInstance(context.exception.__cause__, openai.error.InvalidRequestError)
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_retries_are_bounded(self):
+        with self.assertRaises(APIQueryError), self.assertWarns(UserWarning):
+            self.caller.call(self.failing(*[openai.error.APIConnectionError('reset')] * 10), timeout=5)
+
+        self.assertEqual(len(self.attempts), self.caller.max_retries + 1)
+
+        # Retry-After beyond the deadline
+        self.attempts.clear()
+        caller = APICaller(deadline=5)
+
+        with self.assertRaises(APIQueryError):
+            caller.call(self.failing(openai.error.RateLimitError('slow down', headers={'retry-after': '10'})), 5)
+
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_attempts_share_the_deadline(self):
+        self.assertEqual(self.caller.call(self.failing(), timeout=1000), 'answer')
+        self.assertLessEqual(self.attempts[0], self.caller.deadline)
+        self.assertEqual(self.caller.timeout(100), self.caller.request_timeout + 100 * self.caller.timeout_per_token)
+
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(openai.error.RateLimitError('slow down')))
+        self.assertFalse(is_retryable(openai.error.RateLimitError('quota', code='insufficient_quota')))
+        self.assertTrue(is_retryable(openai.error.APIError('conflict', http_status=409)))
+        self.assertFalse(is_retryable(openai.error.APIError('not found', http_status=404)))
+        self.assertFalse(is_retryable(openai.error.AuthenticationError('invalid key')))
+
+    def test_async_calls_are_retried(self):
+        send = self.failing(openai.error.ServiceUnavailableError('down'))
+
+        async def asend(timeout: float) -> str:
+            return send(timeout)
+
+        with self.assertWarns(UserWarning):
+            self.assertEqual(asyncio.run(self.caller.acall(asend, timeout=5)), 'answer')
+
+        self.assertEqual(len(self.attempts), 2)
+
+    def test_slow_calls_are_hedged(self):
+        for _ in range(30):
+            self.caller.latencies.record('gpt-4', 0.01)
+
+        answered = threading.Event()
+
+        def send(timeout: float) -> str:
+            self.attempts.append(timeout)
+            self.caller.mark_admitted()
+
+            if len(self.attempts) == 1:
+                answered.wait(5)
+                return 'primary'
+
+            answered.set()
+            return 'hedge'
+
+        self.assertEqual(self.caller.call(send, timeout=5, hedge_key='gpt-4'), 'hedge')
+        self.assertEqual(len(self.attempts), 2)
+
+        # A fast call isn't duplicated
+        self.attempts.clear()
+        self.assertEqual(self.caller.call(self.failing(), timeout=5, hedge_key='gpt-4'), 'answer')
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_calls_waiting_for_the_rate_limiter_are_not_hedged(self):
+        for _ in range(30):
+            self.caller.latencies.record('gpt-4', 0.01)
+
+        def send(timeout: float) -> str:
+            self.attempts.append(timeout)
+
+            # Longer than the hedge delay in the rate limiter, then a fast request
+            time.sleep(0.3)
+            self.caller.mark_admitted()
+
+            return 'answer'
+
+        self.assertEqual(self.caller.call(send, timeout=5, hedge_key='gpt-4'), 'answer')
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_calls_are_not_hedged_before_enough_latencies(self):
+        self.assertIsNone(self.caller.hedge_delay('gpt-4'))
+
+        for _ in range(30):
+            self.caller.latencies.record('gpt-4', 0.2)
+
+        self.assertEqual(self.caller.hedge_delay('gpt-4'), 0.2)
+        self.assertIsNone(APICaller(hedging=False).hedge_delay('gpt-4'))
+
+
+@skipIf(fakeredis is None, 'fakeredis is needed to test the paraphrase pools')
+class ParaphrasePoolTests(SimpleTestCase):
+
+    content = 'What brings you here today?'
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.pool = ParaphrasePool(size=4, low_water=2, max_age=3600, redis_factory=lambda: self.redis)
+
+        patcher = mock.patch.object(tasks.refill_paraphrase_pool, 'delay')
+        self.refill = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fill(self, *variants: str) -> int:
+        return self.pool.fill('prebuilts', 'ask_user_demand', self.content, query=lambda prompt: json.dumps(variants))
+
+    def get_variant(self, **kwargs) -> str or None:
+        return self.pool.get_variant('prebuilts', 'ask_user_demand', self.content, **kwargs)
+
+    def test_low_pool_queues_one_refill_with_the_session(self):
+        self.assertIsNone(self.get_variant(session_id='session'))
+        self.assertIsNone(self.get_variant(session_id='session'))
+
+        self.refill.assert_called_once_with('prebuilts', 'ask_user_demand', 'session')
+
+        # The refill releases the lock
+        self.assertEqual(self.fill('One?'), 1)
+        self.assertEqual(self.get_variant(session_id='session'), 'One?')
+        self.assertEqual(self.refill.call_count, 2)
+
+    def test_full_pool_is_not_refilled(self):
+        self.assertEqual(self.fill('One?', 'Two?', 'Three?', 'Four?', 'Five?'), 4)
+        self.assertEqual(self.fill('Six?'), 0)
+
+        self.assertIn(self.get_variant(session_id='session'), {'One?', 'Two?', 'Three?', 'Four?'})
+        self.refill.assert_not_called()
+
+    def test_refills_need_a_session_or_an_operator_key(self):
+        self.get_variant()
+        self.refill.assert_not_called()
+
+        self.pool.operator_refills = True
+        self.get_variant()
+        self.refill.assert_called_once_with('prebuilts', 'ask_user_demand', None)
+
+    def test_old_variants_are_renewed(self):
+        key = self.pool.pool_key('prebuilts', 'ask_user_demand', self.content)
+        self.redis.zadd(key, {'Old?': 0, 'Older?': 0})
+
+        self.assertIsNone(self.get_variant(session_id='session'))
+        self.assertEqual(self.fill('New?', 'Newer?', 'Newest?', 'Latest?'), 4)
+        self.assertEqual(self.redis.zcard(key), 4)
+
+    def test_invalid_variants_are_dropped(self):
+        self.assertEqual(self.fill(f'{NAME_TAG}, and {NAME_TAG}?', '  ', 'Fine?'), 1)
+        self.assertEqual(self.pool.fill('prebuilts', 'ask_user_demand', self.content, query=lambda prompt: 'Sure!'),
+                         0)
+
+    def test_variants_are_personalized(self):
+        self.fill(f'Hello {NAME_TAG}, what brings you here?')
+
+        self.assertEqual(self.get_variant(name='Anna'), 'Hello Anna, what brings you here?')
+        self.assertEqual(self.get_variant(), 'Hello what brings you here?')
+        self.assertEqual(personalize(f'{NAME_TAG}, tell me more.'), 'Tell me more.')
+
+    def test_refill_task_uses_the_key_of_the_session(self):
+        store = MemoryStateStore()
+        store.create('session', therapy_parameters())
+
+        gpt = mock.Mock()
+        gpt.return_value.query_API.return_value = json.dumps(['One?', 'Two?', 'Three?', 'Four?'])
+
+        with mock.patch.object(tasks, 'OPERATOR_API_KEY', None), mock.patch.object(tasks, 'GPT', gpt), \
+                mock.patch.object(tasks, 'PARAPHRASE_POOL', self.pool), \
+                mock.patch.object(tasks, 'get_state_store', return_value=store):
+            tasks.refill_paraphrase_pool('prebuilts', 'ask_user_demand', 'session')
+            tasks.refill_paraphrase_pool('prebuilts', 'ask_user_demand', 'unknown')
+
+        gpt.assert_called_once_with(api_key='sk-test')
+
+
+class SideQueriesTests(EncoderTestCase):
+
+    def play_turn(self, concurrent: bool, demand: str) -> dict:
+
+        """
+        Play an intake turn running the anamnesis, user informations and demand side queries, which return in a
+        random order, and get the state it ends in
+        """
+
+        therapy = Therapy(api_key='sk-test', concurrent_side_queries=concurrent)
+
+        therapy.conversation_started = therapy.user_demand_asked_once = True
+        for i in range(8):
+            therapy.MSG_Handler.create_message(role='user' if i % 2 else 'assistant', message=f'Message {i}.',
+                                               command='NA', update_conv=True)
+
+        def side_query(result):
+            def query(*args):
+                time.sleep(random.uniform(0, 0.02))
+                return result
+
+            return query
+
+        user_informations = {'name': 'Alex', 'age': 30, 'gender': 'non-binary', 'occupation': 'nurse',
+                             'language': 'English', 'marital_status': 'single'}
+
+        with mock.patch.object(therapy, 'build_anamnesis', side_effect=side_query('Anamnesis.')), \
+                mock.patch.object(therapy, 'query_user_info', side_effect=side_query(user_informations)), \
+                mock.patch.object(therapy, 'query_demand', side_effect=side_query(demand)), \
+                mock.patch.object(therapy, 'choose_therapy_type'), \
+                mock.patch.object(therapy, 'response', return_value=lambda: 'Reply.'), \
+                mock.patch('therapy.therapist.CIRCUIT_BREAKER', CircuitBreaker(enabled=False)), \
+                mock.patch('builtins.print'):
+            therapy.play_conversation('I sleep badly.')
+
+        parameters = therapy.collect_parameters()
+
+        for message in parameters['conversation']:
+            message.pop('time', None)
+
+        return parameters
+
+    def test_concurrent_and_sequential_turns_end_in_the_same_state(self):
+        for demand in ('Sleep problems.', '0', ' \n'):
+            with self.subTest(demand=demand):
+                parameters = self.play_turn(concurrent=False, demand=demand)
+
+                for _ in range(3):
+                    self.assertEqual(self.play_turn(concurrent=True, demand=demand), parameters)
+
+                self.assertEqual((parameters['anamnesis'], parameters['user_info_asked']), ('Anamnesis.', True))
+                self.assertEqual(parameters['demand_asked'], demand == 'Sleep problems.')
+                self.assertEqual(parameters['conversation'][-1]['content'], 'Reply.')
+
+
+class FoldMemoryTests(EncoderTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.therapy = Therapy(api_key='sk-test')
+
+        memory = self.therapy.MSG_Handler.memory
+        for i in range(3):
+            memory.add_segment(8 * i, 8 * i + 8, summary=' '.join([f'fact{i}'] * 300), tokens=300)
+
+    def test_summaries_are_merged(self):
+        with mock.patch.object(self.therapy.GPT, 'query_API', return_value='Merged facts.'):
+            self.assertTrue(self.therapy.fold_memory())
+
+        self.assertEqual([segment['summary'] for segment in self.therapy.MSG_Handler.memory.segments],
+                         ['Merged facts.', ' '.join(['fact2'] * 300)])
+
+    def test_summaries_are_not_merged_when_the_api_fails(self):
+        with mock.patch.object(self.therapy.GPT, 'query_API', side_effect=APIQueryError('down')), \
+                self.assertWarns(UserWarning):
+            self.assertFalse(self.therapy.fold_memory())
+
+        self.assertEqual([segment['tokens'] for segment in self.therapy.MSG_Handler.memory.segments], [300] * 3)
+
+
+class ClientPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pool = ClientPool()
+        self.addCleanup(self.pool.close)
+
+    def test_sessions_are_per_key(self):
+        async def sessions():
+            return self.pool.get_session('sk-a'), self.pool.get_session('sk-a'), self.pool.get_session('sk-b')
+
+        first, again, other = self.pool.run(sessions(), timeout=5)
+
+        self.assertIs(first, again)
+        self.assertIsNot(first, other)
+        self.assertNotIn('sk-a', self.pool._sessions)
+
+    def test_closed_session_is_replaced(self):
+        async def reopen():
+            session = self.pool.get_session('sk-a')
+            await session.close()
+            return session, self.pool.get_session('sk-a')
+
+        closed, session = self.pool.run(reopen(), timeout=5)
+
+        self.assertIsNot(closed, session)
+        self.assertFalse(session.closed)
+
+
+class AsyncGPTTests(EncoderTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.pool = ClientPool()
+        self.addCleanup(self.pool.close)
+
+        self.gpt = AsyncGPT(api_key='sk-test', pool=self.pool)
+        self.gpt.rate_limiter = RateLimiter({})
+        self.gpt.circuit_breaker = mock.Mock(spec=CircuitBreaker)
+        self.gpt.api_caller = APICaller(backoff_base=0.001, backoff_max=0.01)
+
+        self.requests = []
+
+    async def acreate(self, **query):
+        self.requests.append((query, openai.aiosession.get()))
+
+        if len(self.requests) == 1 and query['messages'][0]['content'] == 'fail once':
+            raise openai.error.APIConnectionError('reset')
+
+        return {'choices': [{'message': {'role': 'assistant', 'content': 'Hello.'}}],
+                'usage': {'prompt_tokens': 3, 'completion_tokens': 1, 'total_tokens': 4}}
+
+    async def pool_session(self, api_key: str):
+        return self.pool.get_session(api_key)
+
+    def test_query_is_sent_with_the_session_of_the_key(self):
+        with mock.patch.object(openai.ChatCompletion, 'acreate', self.acreate):
+            answer = asyncio.run(self.gpt.query_API([{'role': 'user', 'content': 'say hello'}], max_tokens=10))
+
+        self.assertEqual(answer, 'Hello.')
+        self.assertEqual(self.gpt.last_model_used, 'gpt-4')
+
+        query, session = self.requests[0]
+        self.assertEqual((query['api_key'], query['model'], query['max_tokens']), ('sk-test', 'gpt-4', 10))
+        self.assertIs(session, self.pool.run(self.pool_session('sk-test'), timeout=5))
+
+        # The session is only bound to the request's context
+        self.assertIsNone(openai.aiosession.get())
+        self.gpt.circuit_breaker.record.assert_called_once_with('gpt-4', mock.ANY, 1)
+
+    def test_transient_errors_are_retried(self):
+        with mock.patch.object(openai.ChatCompletion, 'acreate', self.acreate), self.assertWarns(UserWarning):
+            answer = asyncio.run(self.gpt.query_API([{'role': 'user', 'content': 'fail once'}], fast_model=True))
+
+        self.assertEqual(answer, 'Hello.')
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.gpt.last_model_used, 'gpt-3.5-turbo')
+        self.assertEqual(self.gpt.circuit_breaker.record.call_count, 2)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    query = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'Is this a question?'}], 'temperature': 0}
+
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=2, redis_factory=None)
+        self.computed = []
+
+    def compute(self, content: str = 'Yes.', release: threading.Event = None):
+
+        def compute() -> dict:
+            self.computed.append(content)
+
+            if release is not None:
+                release.wait(5)
+
+            if content == 'fail':
+                raise APIQueryError('down')
+
+            return {'choices': [{'message': {'role': 'assistant', 'content': content}}], 'usage': {'total_tokens': 9}}
+
+        return compute
+
+    def call_concurrently(self, cache: ResponseCache, compute, n: int) -> list:
+
+        """
+        Make n identical calls in threads, the first one computing until the others joined it
+        """
+
+        results = [None] * n
+
+        def call(i: int):
+            try:
+                results[i] = cache.get_or_compute(self.query, compute)
+            except APIQueryError as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+
+        deadline = time.monotonic() + 5
+        while cache.stats['coalesced'] < n - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        return threads, results
+
+    def test_concurrent_identical_calls_compute_once(self):
+        release = threading.Event()
+        threads, results = self.call_concurrently(self.cache, self.compute(release=release), 5)
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.computed, ['Yes.'])
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual((self.cache.stats['misses'], self.cache.stats['coalesced'], self.cache.stats['hits']),
+                         (1, 4, 4))
+
+        self.assertIs(self.cache.get_or_compute(self.query, self.compute()), results[0])
+        self.assertEqual(len(self.computed), 1)
+        self.assertEqual(self.cache.stats['saved_tokens'], 5 * 9)
+
+    def test_followers_get_the_exception_of_the_leader(self):
+        release = threading.Event()
+        threads, results = self.call_concurrently(self.cache, self.compute('fail', release=release), 3)
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.computed, ['fail'])
+        self.assertTrue(all(isinstance(result, APIQueryError) and result is results[0] for result in results))
+
+        # Errors aren't cached
+        self.assertEqual(self.cache.get_or_compute(self.query, self.compute())['usage']['total_tokens'], 9)
+        self.assertEqual(self.computed, ['fail', 'Yes.'])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        queries = [{**self.query, 'temperature': i} for i in range(3)]
+
+        self.cache.get_or_compute(queries[0], self.compute('a'))
+        self.cache.get_or_compute(queries[1], self.compute('b'))
+        self.cache.get_or_compute(queries[0], self.compute('a'))
+        self.cache.get_or_compute(queries[2], self.compute('c'))
+
+        self.cache.get_or_compute(queries[0], self.compute('a'))
+
+        self.assertEqual(self.computed, ['a', 'b', 'c'])
+        self.assertEqual(list(self.cache._entries), [ResponseCache.make_key(queries[i]) for i in (2, 0)])
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl=0.05, redis_factory=None)
+
+        cache.get_or_compute(self.query, self.compute())
+        cache.get_or_compute(self.query, self.compute())
+        time.sleep(0.06)
+        cache.get_or_compute(self.query, self.compute())
+
+        self.assertEqual(len(self.computed), 2)
+        self.assertFalse(cache._inflight)
+
+
+@skipIf(fakeredis is None, 'fakeredis is needed to test the Redis cache')
+class RedisResponseCacheTests(ResponseCacheTests):
+
+    def setUp(self):
+        super().setUp()
+
+        # Two worker processes sharing the Redis cache
+        self.redis = fakeredis.FakeRedis()
+        self.cache = ResponseCache(max_entries=2, redis_factory=lambda: self.redis)
+        self.other_cache = ResponseCache(redis_factory=lambda: self.redis)
+        self.lock_key = f'{CACHE_PREFIX}{ResponseCache.make_key(self.query)}:lock'
+
+    def test_least_recently_used_entry_is_evicted(self):
+        super().test_least_recently_used_entry_is_evicted()
+
+        # Still in Redis
+        self.cache.get_or_compute({**self.query, 'temperature': 1}, self.compute('b'))
+
+        self.assertEqual(self.computed, ['a', 'b', 'c'])
+        self.assertEqual(self.cache.stats['redis_hits'], 1)
+
+    def test_value_computed_by_another_process_is_reused(self):
+        response = self.other_cache.get_or_compute(self.query, self.compute())
+
+        self.assertEqual(self.cache.get_or_compute(self.query, self.compute()), response)
+        self.assertEqual(len(self.computed), 1)
+        self.assertEqual(self.cache.stats['redis_hits'], 1)
+
+    def test_other_process_waits_for_the_lock_holder(self):
+        release = threading.Event()
+        leader = threading.Thread(target=self.other_cache.get_or_compute,
+                                  args=(self.query, self.compute(release=release)))
+        leader.start()
+
+        deadline = time.monotonic() + 5
+        while not self.redis.exists(self.lock_key) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        follower = threading.Thread(target=self.cache.get_or_compute, args=(self.query, self.compute('other')))
+        follower.start()
+
+        time.sleep(0.1)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(self.computed, ['Yes.'])
+        self.assertEqual((self.cache.stats['coalesced'], self.cache.stats['redis_hits']), (1, 1))
+        self.assertFalse(self.redis.exists(self.lock_key))
+
+    def test_lock_of_a_dead_process_expires(self):
+        self.redis.set(self.lock_key, 1, px=100)
+
+        self.cache.get_or_compute(self.query, self.compute())
+
+        self.assertEqual(self.computed, ['Yes.'])
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+
+class SummarizerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.summarizer = Summarizer(query=self.query, token_counter=lambda text: len(text.split()), chunk_tokens=400)
+
+    def query(self, messages: list[dict], target: int) -> str:
+        self.requests.append((messages[0]['content'], target))
+
+        # A summary of half the chunk
+        words = messages[0]['content'].split('CONTENT:\n')[1].split()
+
+        return ' '.join(words[:len(words) // 2])
+
+    @staticmethod
+    def text(n_paragraphs: int, seed: int = 0) -> str:
+
+        """
+        Paragraphs of sentences of random lengths, with an unpunctuated one longer than a chunk
+        """
+
+        rng = random.Random(seed)
+        paragraphs = []
+
+        for i in range(n_paragraphs):
+            sentences = [' '.join(f'w{i}.{j}.{k}' for k in range(rng.randint(5, 60))) + '.'
+                         for j in range(rng.randint(1, 8))]
+            paragraphs.append(' '.join(sentences) + '\n')
+
+        paragraphs.insert(n_paragraphs // 2, ' '.join(f'long{k}' for k in range(1000)) + '\n')
+
+        return ''.join(paragraphs)
+
+    def test_chunks_fit_chunk_tokens(self):
+        content = self.text(30)
+        chunks = self.summarizer.split(content)
+
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(0 < len(chunk.split()) <= self.summarizer.chunk_tokens for chunk in chunks))
+
+        # Nothing is lost nor reordered
+        self.assertEqual(' '.join(chunks).split(), content.split())
+
+    def test_rounds_stop_at_max_rounds(self):
+        content = self.text(30)
+
+        summary, process = self.summarizer.summarize(content, target_tokens=10, return_process=True)
+
+        self.assertEqual(list(process), ['Round 0', 'Round 1', 'Round 2'])
+        self.assertTrue(all(summary_round['Answer'] <= summary_round['Query'] // 2 + summary_round['Chunks']
+                            for summary_round in process.values()))
+        self.assertEqual(len(summary.split()), process['Round 2']['Answer'])
+
+        # The content fitting the target ends the rounds
+        self.requests.clear()
+        self.assertEqual(self.summarizer.summarize('Short content.', target_tokens=10), 'Short content.')
+        self.assertFalse(self.requests)
+
+    def test_first_chunk_requests_are_stable_when_the_content_grows(self):
+        content = self.text(30)
+
+        self.summarizer.summarize(content, target_tokens=2400)
+        first_requests = self.requests[:len(self.summarizer.split(content))]
+
+        self.requests.clear()
+        self.summarizer.summarize(content + ' '.join(f'new{k}' for k in range(150)) + '.\n', target_tokens=2400)
+
+        # At most the last chunk, which the new content can extend, is summarized again
+        self.assertGreater(len(first_requests), 5)
+        self.assertLessEqual(len(set(first_requests) - set(self.requests)), 1)
+        self.assertEqual(len({target for _, target in first_requests}), 1)
 
-# Create your tests here.
@@ -1,8 +1,19 @@
-import tiktoken
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import threading
 import yaml
-from .gpt_utils import MessagesHandler, GPT, TimeHandling
+from .gpt_utils import MessagesHandler, GPT, TimeHandling, count_tokens, PRIORITY_PINNED, PRIORITY_INTERACTIVE, \
+    PRIORITY_BACKGROUND
+from .prompt_utils import PromptCache, PromptTemplate
+from .paraphrase_pool import ParaphrasePool
+from .conversation_memory import ConversationMemory
+from .transcript import render_lines, LEGEND
+from .retrieval import GuidelineIndex
+from .router import Router
+from .user_info_extractor import UserInfoExtractor
+from .resilience import APIQueryError
+from .circuit_breaker import CIRCUIT_BREAKER
 import warnings
 from typing import Callable
 import json
@@ -12,9 +23,13 @@ DEBUG = False
 
 BASE_DIR = os.path.join(os.getcwd(), 'therapy')
 
-ENCODER = tiktoken.encoding_for_model('text-davinci-003')
 SERVER_PARAMETERS = yaml.safe_load(open('parameters.yaml', 'r'))  # TODO Check path
 
+# Key of the operator for the API calls of no session (filling the paraphrase pools), None if it's the placeholder:
+# the sessions bring their own key
+OPERATOR_API_KEY = SERVER_PARAMETERS.get('api-key') if SERVER_PARAMETERS.get('api-key') not in (None, '', 'xxx') \
+    else None
+
 
 class TC:
     RED = '\033[31m'
@@ -29,7 +44,7 @@ class TC:
 
 def AnamnesisTooLong(anamnesis_length: int, max_length: int = 2048, loops: int = 10):
     warnings.warn(f'Anamnesis length is {anamnesis_length} tokens, which is greater than the maximum allowed length of '
-                  f"{max_length} tokens, couldn't shorten it more after {loops} loops.")
+                  f"{max_length} tokens, couldn't shorten it more after {loops} rounds.")
 
 
 def CommandNotFound(command: str, available_commands: list):
@@ -51,7 +66,75 @@ def get_hour_minute(now: datetime):
 
 def get_token(text: str):
 
-    return len(ENCODER.encode(text))
+    return count_tokens(text)
+
+
+SIDE_QUERIES_PARAMETERS = SERVER_PARAMETERS.get('side-queries', {})
+
+SIDE_QUERIES_EXECUTOR = None  # Process-wide pool, created on first use (after the Celery worker forked)
+SIDE_QUERIES_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_side_queries_executor() -> ThreadPoolExecutor:
+
+    global SIDE_QUERIES_EXECUTOR
+
+    if SIDE_QUERIES_EXECUTOR is None:
+        with SIDE_QUERIES_EXECUTOR_LOCK:
+            if SIDE_QUERIES_EXECUTOR is None:
+                SIDE_QUERIES_EXECUTOR = ThreadPoolExecutor(max_workers=SIDE_QUERIES_PARAMETERS.get('max-workers', 4),
+                                                           thread_name_prefix='side-query')
+
+    return SIDE_QUERIES_EXECUTOR
+
+
+PROMPT_CACHE = PromptCache(os.path.join(BASE_DIR, 'prompts'),
+                           check_interval=SERVER_PARAMETERS.get('prompt-cache', {}).get('check-interval', 2.0),
+                           token_counter=get_token)
+
+PARAPHRASE_POOL_PARAMETERS = SERVER_PARAMETERS.get('paraphrase-pool', {})
+
+PARAPHRASE_POOL = ParaphrasePool(size=PARAPHRASE_POOL_PARAMETERS.get('size', 8),
+                                 low_water=PARAPHRASE_POOL_PARAMETERS.get('low-water', 4),
+                                 max_age=PARAPHRASE_POOL_PARAMETERS.get('max-age', 86400),
+                                 operator_refills=OPERATOR_API_KEY is not None)
+
+# Prompts only sent to GPT to vary their wording: served from PARAPHRASE_POOL
+POOLED_PROMPTS = [('assistant', 'ask_for_example'),
+                  ('prebuilts', 'ask_user_demand'),
+                  ('prebuilts', 'end_therapy')]
+
+CONVERSATION_MEMORY_PARAMETERS = SERVER_PARAMETERS.get('conversation-memory', {})
+
+SUMMARY_HEADER = 'Summary of the earlier part of the session:\n'
+RECALL_HEADER = 'Earlier in the session, related to the last message:\n'
+RECALL_OVERHEAD = 16  # tokens of the header and the role prefixes of the recalled messages
+
+
+def new_conversation_memory() -> ConversationMemory:
+
+    return ConversationMemory(recent_messages=CONVERSATION_MEMORY_PARAMETERS.get('recent-messages', 12),
+                              segment_messages=CONVERSATION_MEMORY_PARAMETERS.get('segment-messages', 8),
+                              max_summary_tokens=CONVERSATION_MEMORY_PARAMETERS.get('max-summary-tokens', 600))
+
+
+RETRIEVAL_PARAMETERS = SERVER_PARAMETERS.get('retrieval', {})
+
+# Passages of evidence_based_data, the prompts only get the ones relevant to the current turn
+GUIDELINE_INDEX = GuidelineIndex(os.path.join(BASE_DIR, 'prompts', 'evidence_based_data'),
+                                 RETRIEVAL_PARAMETERS.get('index-dir', '.cache/guidelines-index'),
+                                 token_counter=get_token,
+                                 passage_tokens=RETRIEVAL_PARAMETERS.get('passage-tokens', 80),
+                                 check_interval=RETRIEVAL_PARAMETERS.get('check-interval', 2.0))
+
+ROUTER_PARAMETERS = SERVER_PARAMETERS.get('router', {})
+
+# Local models answering the routing questions (next action, therapy type) when they're confident enough
+ROUTER = Router(ROUTER_PARAMETERS.get('model-dir', 'models/router'),
+                threshold=ROUTER_PARAMETERS.get('threshold', 0.9),
+                log_path=ROUTER_PARAMETERS.get('log-path') if ROUTER_PARAMETERS.get('log-decisions', False) else None)
+
+USER_INFO_EXTRACTOR = UserInfoExtractor()
 
 
 class PromptHandler:
@@ -69,10 +152,24 @@ class PromptHandler:
             'evidence_based_data': self.evidence_based_path
         }
 
-        self.assistant_prompts = self.get_prompts(self.assistant_path)
-        self.system_prompts = self.get_prompts(self.system_path)
-        self.prebuilt_prompts = self.get_prompts(self.prebuilt_path)
-        self.evidence_based_prompts = self.get_prompts(self.evidence_based_path)
+        # Served by the process-wide cache: no directory listing nor file read per Therapy object
+        self.cache = PROMPT_CACHE
+
+    @property
+    def assistant_prompts(self):
+        return self.get_prompt('assistant')
+
+    @property
+    def system_prompts(self):
+        return self.get_prompt('system')
+
+    @property
+    def prebuilt_prompts(self):
+        return self.get_prompt('prebuilts')
+
+    @property
+    def evidence_based_prompts(self):
+        return self.get_prompt('evidence_based_data')
 
     @staticmethod
     def get_prompts(path: str):
@@ -84,14 +181,19 @@ class PromptHandler:
 
         path = self.prompt_type_to_path_map[prompt_type]
 
-        return self.get_prompts(path)
+        return [os.path.join(path, prompt) for prompt in self.cache.list_prompts(prompt_type)]
 
     def get_prompt_content(self, prompt_type: str, prompt_name: str):
         if prompt_type not in self.prompt_type_to_path_map:
             raise ValueError(f'Prompt type {prompt_type} does not exist.')
 
-        path = os.path.join(self.prompt_type_to_path_map[prompt_type], prompt_name)
-        return self.get_prompt_content_from_path(path)
+        return self.cache.get(prompt_type, prompt_name)
+
+    def get_template(self, prompt_type: str, prompt_name: str) -> PromptTemplate:
+        if prompt_type not in self.prompt_type_to_path_map:
+            raise ValueError(f'Prompt type {prompt_type} does not exist.')
+
+        return self.cache.get_template(prompt_type, prompt_name)
 
     @staticmethod
     def get_prompt_content_from_path(path: str):
@@ -106,18 +208,29 @@ class Therapy(object):
                  max_tokens_per_message: int = 8192,
                  max_token_answer: int = 2048,
                  anamnesis_length: int = 2048,
-                 only_fast_model: bool = False):
+                 only_fast_model: bool = False,
+                 concurrent_side_queries: bool = None):
 
         self.api_key = api_key
         self.model = model
+
+        # Id of the session in the state store, set by the tasks (see tasks.checkout_therapy)
+        self.session_id = None
+
         self.max_token_per_message = max_tokens_per_message
         self.max_token_answer = max_token_answer
         self.anamnesis_length = anamnesis_length
         self.only_fast_model = only_fast_model
 
+        # Run the independent side queries of a turn concurrently, False forces the sequential mode
+        self.concurrent_side_queries = SIDE_QUERIES_PARAMETERS.get('concurrent', True) \
+            if concurrent_side_queries is None else concurrent_side_queries
+
         if self.only_fast_model:
-            self.max_token_per_message = 4096
-            self.anamnesis_length, self.max_token_answer = 1024, 1024
+            self.apply_fast_model_limits()
+
+        # The smart model breaks its latency SLO: the turn runs on the fast model (see play_conversation)
+        self.degraded = False
 
         self.prompter = PromptHandler()
         self.timer = TimeHandling()
@@ -134,6 +247,9 @@ class Therapy(object):
             'marital_status': None,
         }
 
+        # Keys of the questions of the last ask_primary_informations, in the order they were numbered
+        self.asked_informations = []
+
         self.therapy_informations = {
             'type': 'not_defined',
             'guidelines': 'not_defined',
@@ -166,7 +282,10 @@ class Therapy(object):
 
         self.GPT = GPT(self.api_key)
 
-        self.MSG_Handler = MessagesHandler()
+        # Receives the tokens of the main reply as they are generated, see therapy.streaming
+        self.stream_callback = None
+
+        self.MSG_Handler = MessagesHandler(model=self.model, memory=new_conversation_memory())
 
         self.conversation = []
 
@@ -183,20 +302,29 @@ class Therapy(object):
         self.passed_user_name = False
         self.anamnesis_rebuild_count = 0
 
-    def get_parameters(self):
+        # State as of the last update_parameters, the base of get_delta (a new therapy has an empty base)
+        self.loaded_parameters = ({}, 0)
 
-        parameters = {
+        self._guidelines_cache = (None, '')  # ((therapy type, query), guidelines) of relevant_guidelines
+
+    def collect_parameters(self) -> dict:
+
+        return {
             'api_key': self.api_key,
             'model': self.model,
             'max_tokens_per_message': self.max_token_per_message,
             'max_token_answer': self.max_token_answer,
             'anamnesis_length': self.anamnesis_length,
             'only_fast_model': self.only_fast_model,
+            'anamnesis': self.anamnesis,
+            'demand': self.demand,
             'user_informations': self.user_informations,
+            'asked_informations': self.asked_informations,
             'therapy_informations': self.therapy_informations,
             'therapy_types': self.therapy_types,
             'user_feedbacks': self.user_feedbacks,
             'conversation': self.MSG_Handler.conversation,
+            'conversation_memory': self.MSG_Handler.memory.to_dict(),
             'conversation_started': self.conversation_started,
             'user_demand_asked_once': self.user_demand_asked_once,
             'user_info_asked': self.user_info_asked,
@@ -209,7 +337,45 @@ class Therapy(object):
             'anamnesis_rebuild_count': self.anamnesis_rebuild_count,
         }
 
-        return json.dumps(parameters)
+    def get_parameters(self):
+
+        return json.dumps(self.collect_parameters())
+
+    def snapshot_parameters(self) -> tuple[dict, int]:
+
+        """
+        Serialized value of every field but the conversation, and the length of the conversation
+        """
+
+        parameters = self.collect_parameters()
+        conversation = parameters.pop('conversation')
+
+        return {field: json.dumps(value, sort_keys=True) for field, value in parameters.items()}, len(conversation)
+
+    def mark_committed(self) -> None:
+
+        """
+        Make the current state the base of the next get_delta, once the delta was applied to the store
+        """
+
+        self.loaded_parameters = self.snapshot_parameters()
+
+    def get_delta(self) -> dict:
+
+        """
+        Changes since the last update_parameters, to be applied with state_store.apply_delta:
+        the messages appended to the conversation and the fields whose value changed
+        """
+
+        parameters = self.collect_parameters()
+        conversation = parameters.pop('conversation')
+
+        loaded_fields, base_length = self.loaded_parameters
+
+        return {'base_length': base_length,
+                'messages': conversation[base_length:],
+                'fields': {field: value for field, value in parameters.items()
+                           if loaded_fields.get(field) != json.dumps(value, sort_keys=True)}}
 
     def update_parameters(self, parameters: str or dict):
 
@@ -217,16 +383,21 @@ class Therapy(object):
             parameters = json.loads(parameters)
 
         self.api_key = parameters['api_key']
+        self.GPT.api_key = self.api_key
         self.model = parameters['model']
         self.max_token_per_message = parameters['max_tokens_per_message']
         self.max_token_answer = parameters['max_token_answer']
         self.anamnesis_length = parameters['anamnesis_length']
         self.only_fast_model = parameters['only_fast_model']
+        self.anamnesis = parameters.get('anamnesis', '')
+        self.demand = parameters.get('demand', '')
         self.user_informations = parameters['user_informations']
+        self.asked_informations = parameters.get('asked_informations', [])
         self.therapy_informations = parameters['therapy_informations']
         self.therapy_types = parameters['therapy_types']
         self.user_feedbacks = parameters['user_feedbacks']
         self.MSG_Handler.conversation = parameters['conversation']
+        self.MSG_Handler.memory.load(parameters.get('conversation_memory'))
         self.conversation_started = parameters['conversation_started']
         self.user_demand_asked_once = parameters['user_demand_asked_once']
         self.user_info_asked = parameters['user_info_asked']
@@ -238,8 +409,48 @@ class Therapy(object):
         self.passed_user_name = parameters['passed_user_name']
         self.anamnesis_rebuild_count = parameters['anamnesis_rebuild_count']
 
+        self.loaded_parameters = self.snapshot_parameters()
+
+    def apply_fast_model_limits(self) -> None:
+
+        self.max_token_per_message = 4096
+        self.anamnesis_length, self.max_token_answer = 1024, 1024
+
+    @property
+    def on_fast_model(self) -> bool:
+
+        """
+        The calls of the turn that can run on the fast model do: set by the client, or the smart model is degraded
+        """
+
+        return self.only_fast_model or self.degraded
+
     def play_conversation(self, message) -> str or tuple:
 
+        """
+        Play a turn. While the circuit breaker of the smart model is open (see CircuitBreaker), the turn runs on the
+        fast model with its limits, like a session with only_fast_model, except for the calls that need the smart
+        model (the demand check).
+        """
+
+        self.degraded = not self.only_fast_model and not CIRCUIT_BREAKER.allow(self.GPT.model)
+
+        if not self.degraded:
+            return self.play_turn(message)
+
+        limits = self.max_token_per_message, self.anamnesis_length, self.max_token_answer
+        self.apply_fast_model_limits()
+
+        try:
+            return self.play_turn(message)
+
+        finally:
+            # The limits of the session are stored, not the ones of the degraded turn
+            self.max_token_per_message, self.anamnesis_length, self.max_token_answer = limits
+            self.degraded = False
+
+    def play_turn(self, message) -> str or tuple:
+
         # Adding user message to conversation
         self.MSG_Handler.create_message(role='user',
                                         message=message,
@@ -253,20 +464,47 @@ class Therapy(object):
             self.user_feedbacks[self.timer.get_full_time()] = message
             self.next_move_ask_evaluation = False
 
-        # TODO: Thread these updates to not block the conversation
-        #  Cannot thread because when the data is sent back to the api, the parameters are saved
-        #  So, if the thread didn't finish yet, the data won't be saved in the parameters.
-        #  A solution would be to wait for all the threads to finish before sending back the data, that would improve
-        #  The speed of the app a bit but not significantly as most of the side-queries are made on the fast-model
+        # Side queries are independent LLM round trips: they all read the state as it is now, run concurrently,
+        # and are merged in a fixed order once they all returned, so both modes end up in the same state.
+        side_queries = {}
 
         # Updating anamnesis
         self.anamnesis_rebuild_count += 1
         if self.anamnesis_initiated and self.anamnesis_rebuild_count >= 5:
             self.anamnesis_rebuild_count = 0
-            self.continue_anamnesis()
+            side_queries['anamnesis'] = self.query_anamnesis_continuation
 
-        elif len(self.MSG_Handler) >= 8:
-            self.build_anamnesis()
+        elif not self.anamnesis_initiated and len(self.MSG_Handler) >= 8:
+            side_queries['anamnesis'] = self.build_anamnesis
+
+        intake = self.conversation_started and not self.therapy_ended and \
+            not (self.user_info_asked and self.demand_asked)
+
+        if intake and self.user_demand_asked_once:
+            # What the new message answers is read locally, the LLM only looks for the fields still missing
+            self.update_user_info({**self.user_informations,
+                                   **USER_INFO_EXTRACTOR.extract(message, self.asked_informations,
+                                                                 fields=self.missing_user_informations())})
+
+            if not self.user_info_asked:
+                side_queries['user_informations'] = self.query_user_info
+
+            side_queries['demand'] = self.query_demand
+
+        elif self.conversation_started and not self.therapy_ended and self.therapy_type_chosen:
+            side_queries['next_action'] = self.evaluate_whats_next
+
+        side_results = self.run_side_queries(side_queries)
+
+        if 'anamnesis' in side_results:
+            self.anamnesis = side_results['anamnesis']
+            self.anamnesis_initiated = True
+
+        if 'user_informations' in side_results:
+            self.update_user_info(side_results['user_informations'])
+
+        if 'demand' in side_results:
+            self.update_demand(side_results['demand'])
 
         # ALL THE LOGIC LIES HERE
 
@@ -279,10 +517,6 @@ class Therapy(object):
 
         elif not (self.user_info_asked and self.demand_asked):
 
-            if self.user_demand_asked_once:
-                self.check_user_info()
-                self.check_demand()
-
             command = 'choose_therapy_type' if self.user_info_asked and self.demand_asked else\
                       'ask_primary_informations'
 
@@ -292,7 +526,8 @@ class Therapy(object):
 
         else:
 
-            command = self.evaluate_whats_next()
+            # The conversation goes on when the next action couldn't be evaluated
+            command = side_results.get('next_action', 'continue_conversation')
 
         if command == 'ask_for_evaluation':
             self.next_move_ask_evaluation = True
@@ -335,6 +570,146 @@ class Therapy(object):
 
         return assistant_message
 
+    def run_side_queries(self, side_queries: dict[str, Callable]) -> dict:
+
+        """
+        Run side queries, concurrently on the process-wide pool unless the sequential mode is forced.
+        Side queries must not modify the therapy state, their results are merged by the caller.
+
+        :param side_queries: Name of the query -> function without argument
+        :return: Name of the query -> result, in the order of side_queries, without the queries whose API call failed
+        """
+
+        if not self.concurrent_side_queries or len(side_queries) < 2:
+            getters = side_queries
+
+        else:
+            executor = get_side_queries_executor()
+
+            getters = {name: executor.submit(query).result for name, query in side_queries.items()}
+
+        results = {}
+
+        for name, get in getters.items():
+            # The turn goes on without the analysis, it's made again at a later turn
+            try:
+                results[name] = get()
+            except APIQueryError as e:
+                warnings.warn(f'Side query {name} failed: {e}')
+
+        return results
+
+    def memory_messages(self, token_limit: int, recall_tokens: int = 0) -> list[dict]:
+
+        """
+        Memory view of the conversation as chat messages: the summaries in a system message, the past messages related
+        to the last client message in another (see ConversationIndex, at most recall_tokens of token_limit), then the
+        latest messages with their meta-data
+        """
+
+        summary, last_messages = self.MSG_Handler.get_memory_view(token_limit)
+
+        # Nothing to recall when the whole conversation is sent verbatim
+        if len(last_messages) < len(self.MSG_Handler.conversation):
+            summary, last_messages = self.MSG_Handler.get_memory_view(token_limit - recall_tokens)
+        else:
+            recall_tokens = 0
+
+        messages = []
+
+        if summary:
+            messages.append(self.MSG_Handler.create_message(role='system',
+                                                            message=SUMMARY_HEADER + summary,
+                                                            time=False,
+                                                            update_conv=False))
+
+        user_messages = [message['content'] for message in last_messages if message['role'] == 'user']
+
+        if recall_tokens > RECALL_OVERHEAD and user_messages:
+            # Only the messages older than the ones already sent verbatim
+            recalled = self.MSG_Handler.recall(user_messages[-1],
+                                               end=len(self.MSG_Handler.conversation) - len(last_messages),
+                                               k=CONVERSATION_MEMORY_PARAMETERS.get('recall-messages', 3),
+                                               token_limit=recall_tokens - RECALL_OVERHEAD)
+
+            if recalled:
+                messages.append(self.MSG_Handler.create_message(role='system',
+                                                                message=RECALL_HEADER + render_lines(recalled),
+                                                                time=False,
+                                                                update_conv=False))
+
+        return messages + last_messages
+
+    def memory_transcript(self, token_limit: int) -> str:
+
+        """
+        Memory view of the conversation as a compact transcript to embed in a prompt, shared by the analysis prompts
+        of a turn
+        """
+
+        return self.MSG_Handler.render_transcript(token_limit)
+
+    def fold_memory(self) -> bool:
+
+        """
+        Fold the old segments of the conversation into summaries and merge the oldest summaries when they are too
+        long. Calls the API, to be run off the hot path (see tasks.fold_conversation_memory).
+
+        :return: True if the memory changed
+        """
+
+        memory = self.MSG_Handler.memory
+        changed = False
+
+        segment_target = max(1, memory.max_summary_tokens // 4)
+
+        while (segment := memory.next_segment(len(self.MSG_Handler.conversation))) is not None:
+            try:
+                summary = self.query_segment_summary(*segment, target_tokens=segment_target)
+            except APIQueryError as e:
+                warnings.warn(f'Segment {segment} of the conversation could not be summarized: {e}')
+                return changed
+
+            memory.add_segment(*segment, summary=summary, tokens=get_token(summary))
+            changed = True
+
+        while memory.needs_merge():
+            merged, process = self.GPT.summarize('\n'.join(segment['summary'] for segment in memory.segments[:2]),
+                                                 target_tokens=segment_target,
+                                                 return_process=True,
+                                                 fast_model=True)
+
+            # The chunks that failed are kept as they are: the summaries would only be concatenated, and merged again
+            # and again until a single bloated one is left
+            if any(summary_round['Failed'] for summary_round in process.values()):
+                warnings.warn('Conversation summaries could not be merged, the API calls failed.')
+                return changed
+
+            memory.merge_oldest(merged, tokens=get_token(merged))
+            changed = True
+
+        return changed
+
+    def query_segment_summary(self, start: int, end: int, target_tokens: int) -> str:
+
+        memory = self.MSG_Handler.memory
+
+        segment_template = self.prompter.get_template(prompt_type='assistant',
+                                                      prompt_name='conversation_segment_summary')
+
+        segment_prompt = segment_template.render(
+            {'WORDS': str(int(target_tokens * 0.75)),
+             'SUMMARY': memory.segments[-1]['summary'] if memory.segments else '',
+             'TRANSCRIPT': f'{LEGEND}\n{render_lines(self.MSG_Handler.conversation[start:end])}'})
+
+        messages = [self.MSG_Handler.create_message(role='user',
+                                                    message=segment_prompt,
+                                                    time=False,
+                                                    update_conv=False)]
+
+        return self.GPT.query_API(messages=messages, key_to_protect='Hello', only_content=True, fast_model=True,
+                                  max_tokens=2 * target_tokens, rate_priority=PRIORITY_BACKGROUND)
+
     def build_context(self,
                       user_info: bool = True,
                       demand: bool = True,
@@ -356,18 +731,53 @@ class Therapy(object):
         if user_feedbacks:
             context['user_feedbacks'] = f'User feedbacks: {self.user_feedbacks}'
         if therapy_guidelines:
-            context['therapy_guidelines'] = f"Therapy guidelines: {self.therapy_informations['guidelines']}"
+            context['therapy_guidelines'] = f'Therapy guidelines: {self.relevant_guidelines()}'
 
         return str(context)
 
+    def relevant_guidelines(self) -> str:
+
+        """
+        Passages of the guidelines of the therapy type relevant to the last messages of the client and its demand,
+        within the retrieval token budget
+        """
+
+        if not self.therapy_type_chosen:
+            return self.therapy_informations['guidelines']
+
+        user_messages = [message['content'] for message in self.MSG_Handler.conversation[-6:]
+                         if message['role'] == 'user']
+        query = '\n'.join([self.demand] + user_messages[-2:])
+
+        # Shared by the prompts of a turn
+        key = (self.therapy_informations['type'], query)
+        if self._guidelines_cache[0] != key:
+            passages = GUIDELINE_INDEX.select(query,
+                                              source=self.therapy_informations['type'],
+                                              k=RETRIEVAL_PARAMETERS.get('top-k', 4),
+                                              token_budget=RETRIEVAL_PARAMETERS.get('token-budget', 300))
+
+            self._guidelines_cache = (key, '\n'.join(passage.text for passage in passages))
+
+        return self._guidelines_cache[1]
+
     def check_user_info(self, bot_tokens_count: int = 300):
 
+        self.update_user_info(self.query_user_info(bot_tokens_count=bot_tokens_count))
+
+    def query_user_info(self, bot_tokens_count: int = 300) -> dict or None:
+
         # Query GPT with all the conversation with right prompting and add the info to self.user_informations
 
         # 300 is an approximation of what will be returned by the bot
 
+        # Only the fields still missing are asked, the others are known or were read by USER_INFO_EXTRACTOR
+        missing_informations = {key: None for key in self.missing_user_informations()}
+
+        if not missing_informations:
+            return None
+
         max_pass = self.max_token_per_message - bot_tokens_count
-        token_count = 0
 
         context = self.build_context(user_info=False,
                                      demand=False,
@@ -376,33 +786,28 @@ class Therapy(object):
                                      user_feedbacks=False,
                                      therapy_guidelines=False)
 
-        system_prompt = self.prompter.get_prompt_content(prompt_type='system',
-                                                         prompt_name='system_check_prompt')
+        system_template = self.prompter.get_template(prompt_type='system',
+                                                     prompt_name='system_check_prompt')
 
-        user_info_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                            prompt_name='user_info_inference')
+        user_info_template = self.prompter.get_template(prompt_type='assistant',
+                                                        prompt_name='user_info_inference')
 
-        user_info_prompt = self.GPT.chain_replacement(tags=['### USER INFOS QUERY', '### CONTEXT ###'],
-                                                      replacements=[str(self.user_informations), context],
-                                                      content=user_info_prompt)
+        replacements = {'USER INFOS QUERY': str(missing_informations),
+                        'CONTEXT': context,
+                        'CONVERSATION': ''}
 
-        token_count += self.GPT.get_token(context)
-        token_count += self.GPT.get_token(system_prompt)
-        token_count += self.GPT.get_token(user_info_prompt)
+        token_count = system_template.static_tokens + user_info_template.count_tokens(replacements)
 
         # Check amount of conversation token left to add to the query
         tokens_left = max_pass - token_count
 
-        # Get the last messages
-        last_messages = self.MSG_Handler.get_last_messages(token_limit=tokens_left)
+        # Summaries of the older turns and the last messages
+        replacements['CONVERSATION'] = self.memory_transcript(token_limit=tokens_left)
 
-        # Convert to GPT format: not necessary but it helps save some tokens (remove meta-data)
-        last_messages = self.MSG_Handler.chat_to_GPT(last_messages)
-
-        user_info_prompt = user_info_prompt.replace('### CONVERSATION ###', str(last_messages))
+        user_info_prompt = user_info_template.render(replacements)
 
         messages = [self.MSG_Handler.create_message(role='system',
-                                                    message=system_prompt,
+                                                    message=system_template.render(),
                                                     time=False,
                                                     update_conv=False),
                     self.MSG_Handler.create_message(role='user',
@@ -415,19 +820,30 @@ class Therapy(object):
         new_dict_user_info_str = self.GPT.query_API(messages=messages,
                                                     only_content=True,
                                                     max_tokens=bot_tokens_count,
-                                                    fast_model=True)
+                                                    fast_model=True,
+                                                    deterministic=True)
 
         try:
             new_dict_user_info = ast.literal_eval(new_dict_user_info_str)
 
-            if new_dict_user_info.keys() == self.user_informations.keys():
-                self.user_informations = new_dict_user_info
+            if isinstance(new_dict_user_info, dict) and new_dict_user_info.keys() == missing_informations.keys():
+                return {**self.user_informations, **new_dict_user_info}
 
         except (SyntaxError, ValueError):
 
             warnings.warn(f"{self.GPT.last_model_used} didn't retrieved a coherent python dictionnary:\n"
                           f"\t{new_dict_user_info_str}")
 
+        return None
+
+    def missing_user_informations(self) -> list[str]:
+        return [key for key, value in self.user_informations.items() if value is None]
+
+    def update_user_info(self, new_user_informations: dict or None) -> None:
+
+        if new_user_informations is not None:
+            self.user_informations = new_user_informations
+
         self.user_info_asked = all(self.user_informations.values())
 
     def evaluate_whats_next(self):
@@ -435,16 +851,18 @@ class Therapy(object):
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        action_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                         prompt_name='action_type_inference')
+        action_template = self.prompter.get_template(prompt_type='assistant',
+                                                     prompt_name='action_type_inference')
 
-        context = self.build_context()
+        context = self.build_context(therapy_guidelines=False)
+
+        # The local model decides when it's confident, the LLM otherwise
+        if (action := ROUTER.decide('next_action', context, list(self.action_functions_for_evaluation))) is not None:
+            return action
 
         action_list_dict = dict(enumerate(self.action_functions_for_evaluation.keys()))
 
-        action_prompt = self.GPT.chain_replacement(tags=['### CONTEXT ###', '### ACTIONS LIST ###'],
-                                                   replacements=[context, str(action_list_dict)],
-                                                   content=action_prompt)
+        action_prompt = action_template.render({'CONTEXT': context, 'ACTIONS LIST': str(action_list_dict)})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -456,7 +874,10 @@ class Therapy(object):
                                                     update_conv=False)]
 
         action_type_code = self.GPT.query_API(messages=messages, only_content=True, max_tokens=10,
-                                              fast_model=self.only_fast_model)[0]
+                                              fast_model=self.on_fast_model, deterministic=True, hedge=True)[0]
+
+        if action_type_code.isdigit() and int(action_type_code) in action_list_dict:
+            ROUTER.log('next_action', context, action_list_dict[int(action_type_code)])
 
         # 3 is the default action if GPT couldn't solve the prompt properly --> continue conversation
         action_type_code = int(action_type_code) if action_type_code.isdigit() else 0
@@ -465,20 +886,20 @@ class Therapy(object):
 
     def continue_anamnesis(self):
 
+        self.anamnesis = self.query_anamnesis_continuation()
+
+    def query_anamnesis_continuation(self) -> str:
+
         # TODO: Potentially correct anamnesis
 
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        summarizer_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                             prompt_name='anamnesis_continuation_prompt')
-
-        replacements = {'### ANAMNESIS ###': self.anamnesis,
-                        '### CONTEXT ###': self.build_context()}
+        summarizer_template = self.prompter.get_template(prompt_type='assistant',
+                                                         prompt_name='anamnesis_continuation_prompt')
 
-        summarizer_prompt = self.GPT.chain_replacement(tags=list(replacements.keys()),
-                                                       replacements=list(replacements.values()),
-                                                       content=summarizer_prompt)
+        summarizer_prompt = summarizer_template.render({'ANAMNESIS': self.anamnesis,
+                                                        'CONTEXT': self.build_context()})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -490,38 +911,40 @@ class Therapy(object):
                                                     update_conv=False)]
 
         anamnesis_continuation = self.GPT.query_API(messages=messages, only_content=True,
-                                                    fast_model=self.only_fast_model)
+                                                    fast_model=self.on_fast_model,
+                                                    rate_priority=PRIORITY_BACKGROUND)
 
         # Check anamnesis length
         potential_anamnesis = self.anamnesis + anamnesis_continuation
 
-        def summarize_anamnesis(anamnesis: str, max_loop: int = 10) -> str:
+        def summarize_anamnesis(anamnesis: str, max_rounds: int = 3) -> str:
 
             """
-            Hard pass summarizer, might change later as it is not the best way to do it -- check vector database later
+            Map-reduce summary of the anamnesis, its unchanged beginning is served from the response cache
             :param anamnesis:
-            :param max_loop: The maximum queries to GPT-4 to summarize the anamnesis
+            :param max_rounds: The maximum rounds of parallel queries to summarize the anamnesis
             :return:
             """
 
             anamnesis = self.GPT.summarize(content=anamnesis,
                                            target_tokens=self.anamnesis_length,
-                                           max_loop=max_loop,
-                                           return_process=False)
+                                           max_rounds=max_rounds,
+                                           return_process=False,
+                                           fast_model=self.on_fast_model)
 
             if get_token(anamnesis) > self.anamnesis_length:
                 # warning and pass
 
                 AnamnesisTooLong(anamnesis_length=get_token(anamnesis),
                                  max_length=self.anamnesis_length,
-                                 loops=max_loop)
+                                 loops=max_rounds)
 
             return anamnesis
 
         if get_token(potential_anamnesis) > self.anamnesis_length:
-            self.anamnesis = summarize_anamnesis(potential_anamnesis, max_loop=10)
-        else:
-            self.anamnesis = potential_anamnesis
+            return summarize_anamnesis(potential_anamnesis, max_rounds=3)
+
+        return potential_anamnesis
 
     def response(self, command) -> Callable:
 
@@ -545,18 +968,41 @@ class Therapy(object):
         return self.prompter.get_prompt_content(prompt_type='prebuilts',
                                                 prompt_name='start_conversation').replace('xxx', self.therapist_name)
 
-    def ask_for_example(self) -> str:
+    def paraphrase_prompt(self, prompt_type: str, prompt_name: str) -> str:
+
+        """
+        Reworded version of a fixed prompt, taken from the paraphrase pool when it's warm, paraphrased by GPT otherwise
+        """
+
+        content = self.prompter.get_prompt_content(prompt_type=prompt_type,
+                                                   prompt_name=prompt_name)
+
+        name = self.user_informations['name']
+        first_name = name.split()[0] if isinstance(name, str) and name.strip() and name != 'NA' else None
 
-        ask_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                      prompt_name='ask_for_example')
+        variant = PARAPHRASE_POOL.get_variant(prompt_type, prompt_name, content, name=first_name,
+                                              session_id=self.session_id)
 
-        return self.GPT.paraphrase(content=ask_prompt,
-                                   context=self.build_context())
+        if variant is not None:
+            return variant
+
+        # The prompt as is is better than no message at all
+        try:
+            return self.GPT.paraphrase(content=content,
+                                       context=self.build_context())
+        except APIQueryError as e:
+            warnings.warn(f'Prompt {prompt_type}/{prompt_name} could not be paraphrased: {e}')
+            return content
+
+    def ask_for_example(self) -> str:
+
+        return self.paraphrase_prompt(prompt_type='assistant',
+                                      prompt_name='ask_for_example')
 
     def ask_primary_informations(self) -> str:
 
-        base_prompt = self.prompter.get_prompt_content(prompt_type='prebuilts',
-                                                       prompt_name='ask_primary_informations')
+        base_template = self.prompter.get_template(prompt_type='prebuilts',
+                                                   prompt_name='ask_primary_informations')
 
         info_query = self.prompter.get_prompt_content(prompt_type='prebuilts',
                                                       prompt_name='information_query')
@@ -582,13 +1028,14 @@ class Therapy(object):
         # Change base_prompt as user already responded once, assuming user gave at least one information
         if self.user_demand_asked_once:
 
-            base_prompt = self.prompter.get_prompt_content(prompt_type='prebuilts',
-                                                           prompt_name='continue_ask_primary_informations')
+            base_template = self.prompter.get_template(prompt_type='prebuilts',
+                                                       prompt_name='continue_ask_primary_informations')
 
         query_string = ''.join(
             f'{i + 1}: {v}\n' for i, v in enumerate(info_query_dict.values())
         )
-        base_prompt = base_prompt.replace('### INFORMATIONS QUERY ###', query_string)
+        self.asked_informations = list(info_query_dict)
+        base_prompt = base_template.render({'INFORMATIONS QUERY': query_string})
 
         self.user_demand_asked_once = True
 
@@ -596,12 +1043,12 @@ class Therapy(object):
 
     def ask_for_user_info(self) -> str:
 
-        user_info_prompt = self.prompter.get_prompt_content(prompt_type='prebuilts',
-                                                            prompt_name='ask_user_info')
+        user_info_template = self.prompter.get_template(prompt_type='prebuilts',
+                                                        prompt_name='ask_user_info')
 
         user_informations_query = str(list(self.user_informations.keys()))[1:-1]
 
-        user_info_prompt = user_info_prompt.replace('### USER INFOS QUERY ###', user_informations_query)
+        user_info_prompt = user_info_template.render({'USER INFOS QUERY': user_informations_query})
 
         return user_info_prompt
 
@@ -611,11 +1058,8 @@ class Therapy(object):
         Return the ask demand with context
         """
 
-        demand_prompt = self.prompter.get_prompt_content(prompt_type='prebuilts',
-                                                         prompt_name='ask_user_demand')
-
-        return self.GPT.paraphrase(content=demand_prompt,
-                                   context=self.build_context())
+        return self.paraphrase_prompt(prompt_type='prebuilts',
+                                      prompt_name='ask_user_demand')
 
     def continue_conversation(self):
 
@@ -623,21 +1067,24 @@ class Therapy(object):
         # Query GPT to get the following message with the right context and amount of messages
         # Return the following assistant message
 
-        token_count = 0
         max_pass = self.max_token_per_message - self.max_token_answer
 
         context = self.build_context()
 
-        token_count += self.GPT.get_token(context)
+        token_count = self.GPT.get_token(context)
 
-        system_prompt = self.prompter.get_prompt_content(prompt_type='system',
-                                                         prompt_name='system_specialized-therapist_prompt')
+        system_template = self.prompter.get_template(prompt_type='system',
+                                                     prompt_name='system_specialized-therapist_prompt')
+
+        system_prompt, system_tokens = system_template.render_with_tokens(
+            {'THERAPY TYPE': self.therapy_informations['type']})
 
-        system_prompt = system_prompt.replace('### THERAPY TYPE ###', self.therapy_informations['type'])
+        token_count += system_tokens
 
-        token_count += self.GPT.get_token(system_prompt)
+        # Up to a quarter of what's left for the past messages related to the client's message
+        recall_tokens = min(CONVERSATION_MEMORY_PARAMETERS.get('recall-tokens', 300), (max_pass - token_count) // 4)
 
-        last_messages = self.MSG_Handler.get_last_messages(token_limit=max_pass - token_count)
+        last_messages = self.memory_messages(token_limit=max_pass - token_count, recall_tokens=recall_tokens)
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -646,14 +1093,15 @@ class Therapy(object):
                     self.MSG_Handler.create_message(role='user',
                                                     message=context,
                                                     time=False,
-                                                    update_conv=False)]
+                                                    update_conv=False,
+                                                    priority=PRIORITY_PINNED)]
 
-        messages.extend(iter(last_messages))
-
-        messages = self.MSG_Handler.chat_to_GPT(messages)
+        # Conversation messages keep their meta-data: the packer reuses their token counts and strips the rest
+        messages.extend(last_messages)
 
         return self.GPT.query_API(
-            messages=messages, only_content=True, fast_model=self.only_fast_model
+            messages=messages, only_content=True, fast_model=self.on_fast_model, stream_callback=self.stream_callback,
+            rate_priority=PRIORITY_INTERACTIVE
         )
 
     def ask_for_evaluation(self) -> dict:
@@ -663,10 +1111,10 @@ class Therapy(object):
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        feedback_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                           prompt_name='get_feedback_answer')
+        feedback_template = self.prompter.get_template(prompt_type='assistant',
+                                                       prompt_name='get_feedback_answer')
 
-        feedback_prompt = feedback_prompt.replace('### CONTEXT ###', self.build_context())
+        feedback_prompt = feedback_template.render({'CONTEXT': self.build_context()})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -677,45 +1125,65 @@ class Therapy(object):
                                                     time=False,
                                                     update_conv=False)]
 
-        return self.GPT.query_API(messages=messages, only_content=True, fast_model=self.only_fast_model)
+        return self.GPT.query_API(messages=messages, only_content=True, fast_model=self.on_fast_model,
+                                  rate_priority=PRIORITY_INTERACTIVE)
 
     def choose_therapy_type(self):
 
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        therapy_type_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                               prompt_name='therapy_type_inference')
+        therapy_type_template = self.prompter.get_template(prompt_type='assistant',
+                                                           prompt_name='therapy_type_inference')
 
-        replacements = {'### ANAMNESIS ###': self.anamnesis,
-                        '### USER INFORMATIONS ###': str(self.user_informations)[1:-1],
-                        '### USER DEMAND ###': self.demand,
-                        '### THERAPY TRANSCRIPT ###': str(self.MSG_Handler.conversation),
-                        '### THERAPY TYPES ###':
+        replacements = {'ANAMNESIS': self.anamnesis,
+                        'USER INFORMATIONS': str(self.user_informations)[1:-1],
+                        'USER DEMAND': self.demand,
+                        'THERAPY TRANSCRIPT': '',
+                        'THERAPY TYPES':
                             str(dict(zip(self.therapy_types, range(len(self.therapy_types)))))[1:-1].replace(',', '\n')
                         }
 
-        therapy_type_prompt = self.GPT.chain_replacement(tags=list(replacements.keys()),
-                                                         replacements=list(replacements.values()),
-                                                         content=therapy_type_prompt)
+        # The transcript is the memory view of the conversation, bounded by the tokens left in the query
+        tokens_left = self.max_token_per_message - self.max_token_answer - get_token(system_prompt) - \
+            therapy_type_template.count_tokens(replacements)
 
-        messages = [self.MSG_Handler.create_message(role='system',
-                                                    message=system_prompt,
-                                                    time=False,
-                                                    update_conv=False),
-                    self.MSG_Handler.create_message(role='user',
-                                                    message=therapy_type_prompt,
-                                                    time=False,
-                                                    update_conv=False)]
+        replacements['THERAPY TRANSCRIPT'] = self.memory_transcript(token_limit=tokens_left)
+
+        routing_text = '\n'.join(replacements[key] for key in ('ANAMNESIS', 'USER INFORMATIONS', 'USER DEMAND',
+                                                               'THERAPY TRANSCRIPT'))
+
+        # The local model decides when it's confident, the LLM otherwise
+        therapy_type = ROUTER.decide('therapy_type', routing_text, self.therapy_types)
+
+        if therapy_type is None:
+            therapy_type_prompt = therapy_type_template.render(replacements)
+
+            messages = [self.MSG_Handler.create_message(role='system',
+                                                        message=system_prompt,
+                                                        time=False,
+                                                        update_conv=False),
+                        self.MSG_Handler.create_message(role='user',
+                                                        message=therapy_type_prompt,
+                                                        time=False,
+                                                        update_conv=False)]
+
+            # Query GPT for therapy type, the choice is made again at the next turn if the call failed
 
-        # Query GPT for therapy type
+            try:
+                therapy_type_code = self.GPT.query_API(messages=messages, only_content=True, max_tokens=10,
+                                                       fast_model=self.on_fast_model, deterministic=True,
+                                                       hedge=True)[0]
+            except APIQueryError as e:
+                warnings.warn(f'Therapy type could not be chosen: {e}')
+                therapy_type_code = ''
 
-        therapy_type_code = self.GPT.query_API(messages=messages, only_content=True,
-                                               max_tokens=10, fast_model=self.only_fast_model)[0]
+            if therapy_type_code.isdigit() and int(therapy_type_code) < len(self.therapy_types):
+                therapy_type = self.therapy_types[int(therapy_type_code)]
 
-        if therapy_type_code.isdigit():
+                ROUTER.log('therapy_type', routing_text, therapy_type)
 
-            therapy_type = self.therapy_types[int(therapy_type_code)]
+        if therapy_type is not None:
 
             # Get the guidelines in evidence-based data for the therapy type
 
@@ -735,12 +1203,11 @@ class Therapy(object):
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        therapy_message_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                                  prompt_name='present_therapy_type')
+        therapy_message_template = self.prompter.get_template(prompt_type='assistant',
+                                                              prompt_name='present_therapy_type')
 
-        therapy_message_prompt = self.GPT.chain_replacement(tags=['### CONTEXT ###', '### THERAPY TYPE ###'],
-                                                            replacements=[self.build_context(), therapy_type],
-                                                            content=therapy_message_prompt)
+        therapy_message_prompt = therapy_message_template.render({'CONTEXT': self.build_context(),
+                                                                  'THERAPY TYPE': therapy_type})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -751,7 +1218,8 @@ class Therapy(object):
                                                     time=False,
                                                     update_conv=False)]
 
-        return self.GPT.query_API(messages=messages, only_content=True, fast_model=True)
+        return self.GPT.query_API(messages=messages, only_content=True, fast_model=True,
+                                  rate_priority=PRIORITY_INTERACTIVE)
 
     def end_therapy(self) -> str:
 
@@ -760,26 +1228,31 @@ class Therapy(object):
 
         self.therapy_ended = True
 
-        content = self.prompter.get_prompt_content(prompt_type='prebuilts',
-                                                   prompt_name='end_therapy')
-
-        return self.GPT.paraphrase(content=content,
-                                   context=self.build_context())
+        return self.paraphrase_prompt(prompt_type='prebuilts',
+                                      prompt_name='end_therapy')
 
     def check_demand(self) -> str:
 
+        self.update_demand(self.query_demand())
+
+        return self.demand
+
+    def query_demand(self) -> str:
+
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        check_demand_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                               prompt_name='check_user_demand')
+        check_demand_template = self.prompter.get_template(prompt_type='assistant',
+                                                           prompt_name='check_user_demand')
 
-        context = self.build_context()
+        context = f'{self.build_context()}\nTranscription: '
+
+        tokens_left = self.max_token_per_message - self.max_token_answer - get_token(system_prompt) - \
+            check_demand_template.count_tokens({'CONTEXT': context})
 
-        transcript = self.MSG_Handler.conversation
-        transcript = f'{context}\nTranscription: {str(self.MSG_Handler.chat_to_GPT(transcript))}'
+        transcript = context + self.memory_transcript(token_limit=tokens_left)
 
-        check_demand_prompt = check_demand_prompt.replace('### CONTEXT ###', transcript)
+        check_demand_prompt = check_demand_template.render({'CONTEXT': transcript})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -792,16 +1265,17 @@ class Therapy(object):
 
         # Query GPT for demand
 
-        # Demand check bugs a lot on GPT-3.5, change to smart-model not fast-model
+        # Demand check bugs a lot on GPT-3.5, change to smart-model not fast-model (even when it's degraded)
 
-        demand = self.GPT.query_API(messages=messages, only_content=True, fast_model=self.only_fast_model)
+        return self.GPT.query_API(messages=messages, only_content=True, fast_model=self.only_fast_model,
+                                  deterministic=True)
 
-        if demand[0] != '0':
-            self.demand_asked = True
-        else:
-            self.demand = demand
+    def update_demand(self, demand: str) -> None:
 
-        return self.demand
+        # GPT answers "0" when it can't tell the demand yet
+        if demand and demand.strip()[:1] not in ('', '0'):
+            self.demand = demand
+            self.demand_asked = True
 
     def store_informations(self, message: str, role: str, time: str, command: str) -> None:
 
@@ -817,10 +1291,10 @@ class Therapy(object):
         system_prompt = self.prompter.get_prompt_content(prompt_type='system',
                                                          prompt_name='system_check_prompt')
 
-        anamnesis_prompt = self.prompter.get_prompt_content(prompt_type='assistant',
-                                                            prompt_name='build_anamnesis')
+        anamnesis_template = self.prompter.get_template(prompt_type='assistant',
+                                                        prompt_name='build_anamnesis')
 
-        anamnesis_prompt = anamnesis_prompt.replace('### CONTEXT ###', self.build_context())
+        anamnesis_prompt = anamnesis_template.render({'CONTEXT': self.build_context()})
 
         messages = [self.MSG_Handler.create_message(role='system',
                                                     message=system_prompt,
@@ -831,4 +1305,5 @@ class Therapy(object):
                                                     time=False,
                                                     update_conv=False)]
 
-        return self.GPT.query_API(messages=messages, only_content=True, fast_model=self.only_fast_model)
+        return self.GPT.query_API(messages=messages, only_content=True, fast_model=self.on_fast_model,
+                                  rate_priority=PRIORITY_BACKGROUND)
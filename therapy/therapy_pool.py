@@ -0,0 +1,164 @@
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+BASE_OBJECT_SIZE = 64 * 1024  # bytes, rough footprint of a Therapy without its conversation
+VIRTUAL_NODES = 160  # points of each queue on the hash ring
+
+
+def estimate_size(therapy) -> int:
+
+    """
+    Rough memory footprint of a Therapy: the contents of its conversation dominate
+    """
+
+    return BASE_OBJECT_SIZE + 2 * sum(len(message['content']) for message in therapy.MSG_Handler.conversation)
+
+
+class PooledTherapy(NamedTuple):
+    therapy: object
+    version: int
+    last_used: float
+    size: int
+
+
+class TherapyPool:
+
+    """
+    LRU pool of live Therapy objects of a worker process, keyed by session id, so consecutive turns of a session
+    skip the rebuild and the rehydration of its state.
+
+    An object is only handed out for the version of the state it was committed at: any other write to the state
+    (another worker, the web tier changing the API key) makes it stale and it's rebuilt from the store. Objects are
+    checked out exclusively during a turn, and evicted when idle for idle_timeout or when the pool exceeds max_objects
+    or max_memory.
+    """
+
+    def __init__(self, max_objects: int = 64, max_memory: int = 64 * 1024 * 1024, idle_timeout: float = 900):
+        self.max_objects = max_objects
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+
+        self._entries: OrderedDict[str, PooledTherapy] = OrderedDict()
+        self._memory = 0
+        self._lock = threading.Lock()
+
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    def _pop(self, session_id: str) -> PooledTherapy or None:
+
+        entry = self._entries.pop(session_id, None)
+
+        if entry is not None:
+            self._memory -= entry.size
+
+        return entry
+
+    def _evict(self) -> None:
+
+        now = time.monotonic()
+
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+
+            if (len(self._entries) <= self.max_objects and self._memory <= self.max_memory
+                    and now - entry.last_used <= self.idle_timeout):
+                break
+
+            self._pop(session_id)
+            self.stats['evictions'] += 1
+
+    def checkout(self, session_id: str, version: int):
+
+        """
+        Take the live Therapy of a session out of the pool
+        :param version: Current version of the session's state in the store
+        :return: The Therapy, or None if there is none or it's stale
+        """
+
+        with self._lock:
+            self._evict()
+
+            entry = self._pop(session_id)
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            if entry.version != version:
+                self.stats['stale'] += 1
+                return None
+
+            self.stats['hits'] += 1
+
+            return entry.therapy
+
+    def checkin(self, session_id: str, therapy, version: int) -> None:
+
+        """
+        Return a Therapy to the pool once its state is committed
+        :param version: Version of the state the Therapy holds
+        """
+
+        entry = PooledTherapy(therapy, version, time.monotonic(), estimate_size(therapy))
+
+        with self._lock:
+            self._pop(session_id)
+
+            self._entries[session_id] = entry
+            self._memory += entry.size
+
+            self._evict()
+
+    def discard(self, session_id: str) -> None:
+
+        with self._lock:
+            self._pop(session_id)
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._entries.clear()
+            self._memory = 0
+
+
+class SessionRing:
+
+    """
+    Consistent hash ring of the session ids onto the worker queues: the turns of a session go to the same worker, where
+    its Therapy is likely still in the pool, and adding or removing a queue only moves the sessions of that queue.
+    """
+
+    def __init__(self, queues: list[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.queues = list(queues)
+
+        self._ring = sorted((self.hash(f'{queue}#{node}'), queue)
+                            for queue in self.queues for node in range(virtual_nodes))
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get_queue(self, session_id: str) -> str or None:
+
+        """
+        :return: The queue of the session, or None when no queue is configured (default queue)
+        """
+
+        if not self._ring:
+            return None
+
+        index = bisect.bisect(self._points, self.hash(session_id)) % len(self._ring)
+
+        return self._ring[index][1]
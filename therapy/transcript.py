@@ -0,0 +1,114 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Callable
+
+ROLE_PREFIXES = {'user': 'U', 'assistant': 'T', 'system': 'S'}  # T for therapist
+SUMMARY_PREFIX = 'Summary: '
+LEGEND = '(U: client, T: therapist)'
+
+WHITESPACE = re.compile(r'\s+')
+
+TRANSCRIPT_STATS = {'renders': 0, 'cache_hits': 0, 'tokens': 0, 'repr_tokens': 0, 'saved_tokens': 0}
+TRANSCRIPT_STATS_LOCK = threading.Lock()
+
+
+def render_line(message: dict) -> str:
+
+    """
+    One line per message: the initial of the role and the text, without meta-data nor quoting
+    """
+
+    return f"{ROLE_PREFIXES.get(message['role'], message['role'])}: {WHITESPACE.sub(' ', message['content']).strip()}"
+
+
+def render_lines(messages: list[dict]) -> str:
+    return '\n'.join(render_line(message) for message in messages)
+
+
+class TranscriptRenderer:
+
+    """
+    Renders a conversation and its memory (see ConversationMemory) as a compact transcript under a hard token budget:
+    the summaries of the oldest turns, then one line per message, keeping the latest turns that fit.
+
+    Lines are rendered and counted once per message and kept between turns, and the transcript of a turn is cached by
+    budget, so the analysis prompts of a turn share one rendering.
+
+    :param token_counter: Counts the tokens of a text
+    """
+
+    def __init__(self, token_counter: Callable[[str], int]):
+        self.get_token = token_counter
+
+        self._conversation = None
+        self._lines: list[str] = []
+        self._prefix = array('q', [0])  # _prefix[i] = tokens of the i first lines, newlines included
+        self._repr_prefix = array('q', [0])  # Same for the repr of the messages, the former transcript format
+
+        self._cache: dict[int, str] = {}  # token_limit -> transcript of the current turn
+        self._cache_turn = None
+
+    def _sync(self, conversation: list[dict]) -> None:
+
+        if conversation is not self._conversation or len(conversation) < len(self._lines):
+            self._conversation = conversation
+            self._lines = []
+            self._prefix = array('q', [0])
+            self._repr_prefix = array('q', [0])
+
+        for message in conversation[len(self._lines):]:
+            line = render_line(message)
+
+            self._lines.append(line)
+            self._prefix.append(self._prefix[-1] + self.get_token(line) + 1)
+            self._repr_prefix.append(self._repr_prefix[-1] + self.get_token(repr(message)) + 1)
+
+    def render(self, conversation: list[dict], memory, token_limit: int) -> str:
+
+        """
+        :param conversation: Messages of the conversation
+        :param memory: ConversationMemory of the conversation
+        :param token_limit: Maximum length of the transcript
+        :return: The transcript
+        """
+
+        self._sync(conversation)
+
+        turn = (len(conversation), memory.folded_until, len(memory.segments))
+
+        if turn != self._cache_turn:
+            self._cache = {}
+            self._cache_turn = turn
+
+        if (transcript := self._cache.get(token_limit)) is not None:
+            with TRANSCRIPT_STATS_LOCK:
+                TRANSCRIPT_STATS['cache_hits'] += 1
+
+            return transcript
+
+        legend_tokens = self.get_token(LEGEND) + 1
+
+        summaries, summary_tokens = memory.get_summaries(token_limit // 2)
+        summary_tokens += len(summaries) * (self.get_token(SUMMARY_PREFIX) + 1)
+
+        # Latest lines after the folded segments that fit in what's left
+        start, end = memory.folded_until, len(self._lines)
+        budget = token_limit - legend_tokens - summary_tokens
+        first = bisect_left(self._prefix, self._prefix[end] - budget, start, end + 1) if budget > 0 else end
+
+        transcript = '\n'.join([LEGEND] + [SUMMARY_PREFIX + summary for summary in summaries] + self._lines[first:end])
+
+        self._cache[token_limit] = transcript
+
+        with TRANSCRIPT_STATS_LOCK:
+            tokens = legend_tokens + summary_tokens + self._prefix[end] - self._prefix[first]
+            repr_tokens = self._repr_prefix[end] - self._repr_prefix[first]
+
+            TRANSCRIPT_STATS['renders'] += 1
+            TRANSCRIPT_STATS['tokens'] += tokens
+            TRANSCRIPT_STATS['repr_tokens'] += repr_tokens
+            TRANSCRIPT_STATS['saved_tokens'] += repr_tokens - (self._prefix[end] - self._prefix[first])
+
+        return transcript
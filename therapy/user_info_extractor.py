@@ -0,0 +1,147 @@
+import re
+from typing import Optional
+
+NOT_SHARED = 'NA'  # Same as the LLM extraction (see the user_info_inference prompt)
+
+NUMBERED_ANSWER = re.compile(r'^\s*(\d{1,2})\s*[:.)\-]\s*(.*\S)?\s*$')
+LABELED_ANSWER = re.compile(r'^\s*(name|age|gender|sex|occupation|job|profession|languages?|marital status)'
+                            r'\s*[:=\-]\s*(.*\S)\s*$', re.IGNORECASE)
+REFUSAL = re.compile(r"^(na|n/a|-+|none of your business|pass|skip|prefer not( to (say|share))?|"
+                     r"i(?:'d| would) rather not( say| share)?|i don'?t want to (say|share|tell)( it| that)?)\.?$",
+                     re.IGNORECASE)
+
+# Patterns in a free message
+PATTERNS = {
+    'name': re.compile(r"\b(?:my name is|my name's|call me)\s+([A-Z][\w'\-]*(?:\s+[A-Z][\w'\-]*){0,2})"),
+    'age': re.compile(r"\b(?:i am|i'm|im|aged?)\s+(\d{1,3})\b(?!\s*(?:%|percent|kg|cm|min|hour|day|week|month))"
+                      r"|\b(\d{1,3})\s*(?:years?|yrs?|y/?o)\s*old\b|\b(\d{1,3})\s*y/?o\b", re.IGNORECASE),
+    'occupation': re.compile(r"\bi (?:work as|am working as|'m working as)\s+(?:an?\s+)?([\w\- ]{2,40}?)(?=[.,;\n]|$)",
+                             re.IGNORECASE),
+    'language': re.compile(r"\bi speak\s+([\w ,]{2,60}?)(?=[.;\n]|$)", re.IGNORECASE),
+    'gender': re.compile(r"\bi(?: am|'m)\s+(?:an?\s+)?"
+                         r"(male|female|man|woman|non-?binary|trans(?:gender| man| woman))(?![\w-])", re.IGNORECASE),
+    'marital_status': re.compile(r"\bi(?: am|'m)\s+(single|married|divorced|widowed|separated|engaged)(?![\w-])",
+                                 re.IGNORECASE),
+}
+
+LABEL_KEYS = {'name': 'name', 'age': 'age', 'gender': 'gender', 'sex': 'gender', 'occupation': 'occupation',
+              'job': 'occupation', 'profession': 'occupation', 'language': 'language', 'languages': 'language',
+              'marital status': 'marital_status'}
+
+GENDERS = {'male': 'male', 'man': 'male', 'm': 'male', 'boy': 'male', 'female': 'female', 'woman': 'female',
+           'f': 'female', 'girl': 'female', 'non-binary': 'non-binary', 'nonbinary': 'non-binary',
+           'non binary': 'non-binary', 'enby': 'non-binary', 'agender': 'agender', 'genderfluid': 'genderfluid',
+           'trans man': 'trans man', 'trans woman': 'trans woman', 'transgender': 'transgender'}
+
+MARITAL_STATUSES = {'single': 'single', 'married': 'married', 'divorced': 'divorced', 'widowed': 'widowed',
+                    'widow': 'widowed', 'widower': 'widowed', 'separated': 'separated', 'engaged': 'engaged',
+                    'in a relationship': 'in a relationship', 'partnered': 'in a relationship',
+                    'in a civil partnership': 'civil partnership', 'civil partnership': 'civil partnership'}
+
+LANGUAGES = {'english', 'french', 'german', 'spanish', 'italian', 'portuguese', 'dutch', 'swedish', 'norwegian',
+             'danish', 'finnish', 'polish', 'czech', 'russian', 'ukrainian', 'greek', 'turkish', 'arabic', 'hebrew',
+             'persian', 'farsi', 'hindi', 'urdu', 'bengali', 'punjabi', 'tamil', 'chinese', 'mandarin', 'cantonese',
+             'japanese', 'korean', 'vietnamese', 'thai', 'indonesian', 'malay', 'tagalog', 'swahili', 'romanian',
+             'hungarian', 'albanian', 'serbian', 'croatian', 'catalan'}
+
+
+def lookup(value: str, table: dict) -> Optional[str]:
+
+    """
+    The canonical value of the first known word (or group of up to 3 words) of value
+    """
+
+    words = re.findall(r"[a-z][a-z'\-]*", value.lower())
+
+    for i, word in enumerate(words):
+        for candidate in (' '.join(words[i:i + 3]), ' '.join(words[i:i + 2]), word):
+            if candidate in table:
+                return table[candidate]
+
+    return None
+
+
+def normalize(key: str, answer: str, direct: bool) -> Optional[str or int]:
+
+    """
+    :param key: Field of the user informations
+    :param answer: Text given for the field
+    :param direct: The text answers a question about this field, so it's kept as is when it can't be normalized
+    :return: The value of the field, None if the answer doesn't give it
+    """
+
+    answer = answer.strip().strip('.').strip()
+
+    if not answer:
+        return None
+
+    if REFUSAL.match(answer):
+        return NOT_SHARED
+
+    if key == 'age':
+        ages = [int(age) for age in re.findall(r'\b\d{1,3}\b', answer) if 5 <= int(age) <= 120]
+        return ages[0] if ages else None
+
+    if key == 'gender':
+        return lookup(answer, GENDERS) or (answer if direct else None)
+
+    if key == 'marital_status':
+        return lookup(answer, MARITAL_STATUSES) or (answer if direct else None)
+
+    if key == 'language':
+        languages = [word for word in re.findall(r'[a-z]+', answer.lower()) if word in LANGUAGES]
+        return ', '.join(dict.fromkeys(language.capitalize() for language in languages)) or \
+            (answer if direct else None)
+
+    # Free text fields, a direct answer longer than a few words isn't a name or an occupation
+    return answer if len(answer) <= 60 else None
+
+
+class UserInfoExtractor:
+
+    """
+    Deterministic extraction of the user informations from a single new message, before asking the LLM for the
+    fields it leaves missing. It reads:
+      - the answers numbered like the questions of ask_primary_informations (the keys asked, in order, are given),
+        or one answer per line when there are as many lines as questions
+      - labeled answers ("age: 34")
+      - a few patterns of free text ("my name is ...", "I'm 34 years old", "I work as ...", "I'm married")
+
+    Values are normalized with lookups of known values (genders, marital statuses, languages); an explicit refusal
+    gives "NA", like the LLM extraction.
+    """
+
+    def extract(self, message: str, asked_keys: list[str], fields: list[str]) -> dict:
+
+        """
+        :param message: New message of the client
+        :param asked_keys: Keys of the numbered questions of the last ask_primary_informations
+        :param fields: Fields of the user informations to look for
+        :return: The fields found in the message and their value
+        """
+
+        found = {}
+
+        def add(key: Optional[str], answer: str, direct: bool) -> None:
+            if key in fields and key not in found and (value := normalize(key, answer, direct)) is not None:
+                found[key] = value
+
+        lines = [line for line in message.splitlines() if line.strip()]
+
+        for line in lines:
+            if (numbered := NUMBERED_ANSWER.match(line)) and 0 < int(numbered.group(1)) <= len(asked_keys):
+                add(asked_keys[int(numbered.group(1)) - 1], numbered.group(2) or '', direct=True)
+
+            elif labeled := LABELED_ANSWER.match(line):
+                add(LABEL_KEYS[labeled.group(1).lower()], labeled.group(2), direct=True)
+
+        # Unnumbered answers, one per question
+        if not found and len(asked_keys) > 1 and len(lines) == len(asked_keys):
+            for key, line in zip(asked_keys, lines):
+                add(key, line, direct=True)
+
+        for key, pattern in PATTERNS.items():
+            if match := pattern.search(message):
+                add(key, next(group for group in match.groups() if group), direct=False)
+
+        return found
@@ -1,26 +1,63 @@
 from django.shortcuts import render
 from .therapist import Therapy
 from django.http import JsonResponse
+from django.conf import settings
 from django.core.cache import cache
 import yaml
 import openai
-import json
-from .tasks import play_conversation_time_consuming
+import time
+import uuid
+from .tasks import play_conversation_time_consuming, TASK_DONE_CHANNEL
+from .streaming import register_stream
+from .redis_utils import get_redis
+from .state_store import get_state_store, StateNotFound
+from .therapy_pool import SessionRing
 from celery.result import AsyncResult
 
 SERVER_PARAMETERS = yaml.safe_load(open('parameters.yaml', 'r'))
 
+TASK_WAIT_TIMEOUT = SERVER_PARAMETERS.get('task-wait', {}).get('timeout', 20)  # seconds
+TASK_RETRY_AFTER = SERVER_PARAMETERS.get('task-wait', {}).get('retry-after', 250)  # milliseconds
+
+# Session-affine routing of the turns onto the worker queues therapy.0 ... therapy.<n - 1>, see tasks.THERAPY_POOL
+SESSION_RING = SessionRing([f'therapy.{i}' for i in range(SERVER_PARAMETERS.get('therapy-pool', {}).get('queues', 0))])
+
 
 def home(request):
     request.session['therapist_state'] = {'Object': 'Shutdown'}
     return render(request, 'home.html')
 
 
-def chat(request):
+def new_therapy_session(request) -> str:
+
+    """
+    Store the state of a new therapy in the state store and link it to the browser session
+    """
+
+    session_id = uuid.uuid4().hex
 
     therapy_object = Therapy(api_key=SERVER_PARAMETERS['api-key'])
 
-    request.session['therapist_parameters'] = therapy_object.get_parameters()
+    get_state_store().create(session_id, therapy_object.get_parameters())
+
+    request.session['therapy_session_id'] = session_id
+
+    return session_id
+
+
+def get_therapy_session(request) -> str:
+
+    session_id = request.session.get('therapy_session_id')
+
+    if session_id is None:
+        session_id = new_therapy_session(request)
+
+    return session_id
+
+
+def chat(request):
+
+    new_therapy_session(request)
 
     request.session['api-key'] = ''
 
@@ -28,7 +65,7 @@ def chat(request):
 
     request.session['first_message_sent'] = False
 
-    return render(request, 'chat.html')
+    return render(request, 'chat.html', {'streaming': getattr(settings, 'THERAPY_STREAMING', False)})
 
 
 def api_message(request):
@@ -36,7 +73,7 @@ def api_message(request):
     if request.method != 'POST':
         return JsonResponse({'response': 'Invalid request method'}, status=400)
 
-    therapy_parameters = request.session.get('therapist_parameters')
+    session_id = get_therapy_session(request)
 
     first_msg = request.session.get('first_message_sent')
 
@@ -51,13 +88,22 @@ def api_message(request):
 
         user_input = request.POST.get('input_text', '')
 
+        # The reply tokens are streamed on /therapy/stream/<task_id>/ when the browser asks for it and the server
+        # serves the stream
+        stream = request.POST.get('stream') == '1' and getattr(settings, 'THERAPY_STREAMING', False)
+
         # assistant_message = therapy_object.play_conversation(user_input)  # This is the original time-consuming line
 
-        task = play_conversation_time_consuming.delay(therapy_parameters,
-                                                      request.session.get('api-key'),
-                                                      user_input)
+        task = play_conversation_time_consuming.apply_async(args=(session_id, user_input, stream),
+                                                            queue=SESSION_RING.get_queue(session_id))
         task_id = task.id
 
+        if stream:
+            if request.session.session_key is None:
+                request.session.save()
+
+            register_stream(task_id, request.session.session_key)
+
         return JsonResponse({'respone': None, 'task_id': task_id}, status=202)
 
     else:
@@ -66,17 +112,52 @@ def api_message(request):
 
 def check_task_status(request):
 
-    task = AsyncResult(request.POST.get('task_id'))
+    return task_status_response(request, AsyncResult(request.POST.get('task_id')))
+
+
+def wait_task_status(request):
+
+    """
+    Long-polling version of check_task_status: blocks until the task is done or TASK_WAIT_TIMEOUT is reached.
+    A pending answer comes with a 'retry_after' hint (ms) for the next call.
+    """
+
+    if request.method != 'POST':
+        return JsonResponse({'response': 'Invalid request method'}, status=400)
+
+    task_id = request.POST.get('task_id')
+
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+
+    try:
+        # Subscribe before checking the state so a task finishing in between isn't missed
+        pubsub.subscribe(TASK_DONE_CHANNEL.format(task_id=task_id))
+
+        task = AsyncResult(task_id)
+
+        if task.state not in {'SUCCESS', 'FAILURE', 'REVOKED'}:
+            deadline = time.monotonic() + TASK_WAIT_TIMEOUT
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                if pubsub.get_message(timeout=remaining) is not None:
+                    break
+
+    finally:
+        pubsub.close()
+
+    return task_status_response(request, AsyncResult(task_id))
+
+
+def task_status_response(request, task: AsyncResult) -> JsonResponse:
 
     if task.state == 'PENDING':
         response = {'state': task.state,
-                    'status': 'Pending...'}
+                    'status': 'Pending...',
+                    'retry_after': TASK_RETRY_AFTER}
     elif task.state == 'SUCCESS':
 
+        # The worker already committed the new state to the state store
         assistant_message = task.result['assistant_message']
-        therapy_parameters = task.result['therapy_parameters']
-
-        request.session['therapist_parameters'] = therapy_parameters
 
         if isinstance(assistant_message, tuple) or isinstance(assistant_message, list):
             response = {'response': assistant_message[0], 'user_name': assistant_message[1]}
@@ -89,7 +170,8 @@ def check_task_status(request):
 
     else:
         response = {'state': task.state,
-                    'status': str(task.info)}
+                    'status': str(task.info),
+                    'retry_after': TASK_RETRY_AFTER}
 
     return JsonResponse(response)
 
@@ -102,8 +184,8 @@ def update_api_key(request):
     api_key = request.POST.get('api_key', '')
 
     try:
-        openai.api_key = api_key
         openai.Completion.create(
+            api_key=api_key,
             model='ada',
             prompt='This is a test',
             max_tokens=1,
@@ -118,18 +200,14 @@ def update_api_key(request):
 
         valid_gpt4 = check_GPT4(request, api_key)
 
-        therapy_parameters = request.session.get('therapist_parameters')
-
-        if isinstance(therapy_parameters, str):
-
-            therapy_parameters = json.loads(therapy_parameters)
+        def set_api_key(therapy_parameters):
 
-        therapy_parameters['api_key'] = api_key
+            therapy_parameters['api_key'] = api_key
 
-        if not valid_gpt4:
-            therapy_parameters['only_fast_model'] = True
+            if not valid_gpt4:
+                therapy_parameters['only_fast_model'] = True
 
-        request.session['therapist_parameters'] = therapy_parameters
+        update_therapy_session(request, set_api_key)
 
         request.session['api-key'] = api_key
 
@@ -148,14 +226,9 @@ def update_api_key(request):
 
 def check_GPT4(request, api_key):
 
-    therapy_parameters = request.session['therapist_parameters']
-
-    if isinstance(therapy_parameters, str):
-        therapy_parameters = json.loads(therapy_parameters)
-
     try:
-        openai.api_key = api_key
         openai.ChatCompletion.create(
+            api_key=api_key,
             model='gpt-4',
             messages=[{'role': 'user', 'content': 'This is a test'}],
             max_tokens=1)
@@ -173,41 +246,47 @@ def update_model(request):
     if request.method != 'POST':
         return JsonResponse({'response': 'Invalid request method'}, status=400)
 
-    therapy_parameters = request.session.get('therapist_parameters')
-
     model_requested = request.POST.get('model', '')
 
     if model_requested == 'GPT3.5':
 
-        return sub_update_model(True, therapy_parameters, request)
+        return sub_update_model(True, request)
 
     elif model_requested == 'GPT4':
 
-        return sub_update_model(False, therapy_parameters, request)
+        return sub_update_model(False, request)
 
     else:
 
         return JsonResponse({'response': 'Invalid model'}, status=400)
 
 
-def sub_update_model(model, therapy_parameters, request):
+def sub_update_model(model, request):
 
-    if isinstance(therapy_parameters, str):
+    update_therapy_session(request, lambda therapy_parameters: therapy_parameters.update(only_fast_model=model))
 
-        therapy_parameters = json.loads(therapy_parameters)
+    return JsonResponse({'response': 'Model updated'}, status=200)
 
-    therapy_parameters['only_fast_model'] = model
 
-    request.session['therapist_parameters'] = therapy_parameters
+def update_therapy_session(request, function) -> None:
 
-    return JsonResponse({'response': 'Model updated'}, status=200)
+    """
+    Apply function to the stored parameters of the session's therapy, starting a new therapy if it expired
+    """
+
+    try:
+        get_state_store().update(get_therapy_session(request), function)
+
+    except StateNotFound:
+        get_state_store().update(new_therapy_session(request), function)
 
 
 def download_data(request):
 
-    therapy_parameters = request.session.get('therapist_parameters')
+    try:
+        therapy_parameters, _ = get_state_store().load(get_therapy_session(request))
 
-    if isinstance(therapy_parameters, str):
-        therapy_parameters = json.loads(therapy_parameters)
+    except StateNotFound:
+        therapy_parameters = {}
 
     return JsonResponse({'response': therapy_parameters}, status=200)